@@ -13,6 +13,10 @@ class CravatAnnotator(BaseAnnotator):
         data/example_annotator.sqlite using the sqlite3 python module. The
         sqlite3.Connection object is stored as self.dbconn, and the
         sqlite3.Cursor object is stored as self.cursor.
+
+        The small lookup tables listed under preload_tables in RNAseq.yml
+        are loaded by BaseAnnotator before setup is called, and are in
+        self.preloaded.
         """
 
         #pass
@@ -54,10 +58,7 @@ class CravatAnnotator(BaseAnnotator):
 
         # get position
         hugo = input_data['hugo']
-        sql = 'SELECT someVariable FROM someTable WHERE hugo="' + hugo + '"'
-
-        self.cursor.execute(sql)
-        query_result = self.cursor.fetchone()
+        query_result = self.preloaded['someTable'].get(hugo)
         if query_result is not None:
             c_len = query_result[0]
             var_position = input_data['pos']/c_len
@@ -69,10 +70,9 @@ class CravatAnnotator(BaseAnnotator):
 
         ### get reference
         verbose_ref = ''
+        nucleotide_names = self.preloaded['nucleotide_names']
         for abbv in input_data['ref_base']:
-            verbose_ref_query = 'select full_name from nucleotide_names where abbreviation="%s"' %abbv
-            self.cursor.execute(verbose_ref_query)
-            verbose_ref_result = self.cursor.fetchone()
+            verbose_ref_result = nucleotide_names.get(abbv)
             if verbose_ref_result is not None:
                 verbose_ref += verbose_ref_result[0]
         out['verbose_ref'] = verbose_ref
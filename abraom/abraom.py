@@ -1,13 +1,23 @@
 import sys
 from cravat import BaseAnnotator
 from cravat import InvalidData
-from pyliftover import LiftOver
+from cravat import ConfigurationError
+from cravat.popfreq_db import chrom_to_int
+from cravat.popfreq_db import FrequencyArrays
+from cravat.popfreq_db import get_filter_path
+from cravat.popfreq_db import load_frequency_filter
+from cravat.popfreq_db import query_frequency_regions
+from cravat.popfreq_db import variant_key
+from cravat.popfreq_db import frequency_dbs
 
 import sqlite3
 import os
+import time
 
 class CravatAnnotator(BaseAnnotator):
 
+    batch_keys_sql = 'CREATE TEMP TABLE IF NOT EXISTS batch_keys (idx INTEGER PRIMARY KEY, chrom_int INT, pos INT, ref TEXT, alt TEXT);'
+
     def setup(self):
         """
         Set up data sources.
@@ -15,8 +25,47 @@ class CravatAnnotator(BaseAnnotator):
         data/example_annotator.sqlite using the sqlite3 python module. The
         sqlite3.Connection object is stored as self.dbconn, and the
         sqlite3.Cursor object is stored as self.cursor.
+
+        annotate_batch matches its input lines through a temporary key table.
+        BaseAnnotator gives each thread its own connection, so the table is
+        created for each connection that annotate_batch runs on.
+
+        Queries use ? placeholders and constant SQL, so that sqlite3 reuses
+        their prepared statements.
+
+        ABRaOM is on hg19. assembly in abraom.yml picks the table queried:
+        abraom for hg19, or abraom_hg38, lifted at build time (see
+        build_abraom.py --chain), for hg38. A database without the table of
+        the assembly is a ConfigurationError, since matching positions
+        against the other assembly's table gives wrong results. The queries
+        are made once here for the table.
+
+        With preload set in abraom.yml, the whole table is instead loaded
+        into NumPy arrays (see FrequencyArrays) and no queries are made.
+
+        With a Bloom filter of the table next to the database (see
+        popfreq_db.py filter), variants which are certainly not in the table
+        are not looked up, and the run log has the number of lookups
+        skipped. presence_filter: false in abraom.yml turns it off.
         """
-        pass
+        self.cursor.execute(self.batch_keys_sql)
+        self.table = self._get_table(self.conf.get('assembly', 'hg38'))
+        self.select_sql = 'SELECT allele_freq FROM {} WHERE chrom_int=? AND pos=? AND ref=? AND alt=?;'.format(self.table)
+        self.batch_sql = 'SELECT b.idx, a.allele_freq FROM batch_keys AS b JOIN {} AS a ON a.chrom_int=b.chrom_int AND a.pos=b.pos AND a.ref=b.ref AND a.alt=b.alt;'.format(self.table)
+        self.sorted_sql = 'SELECT pos, ref, alt, allele_freq FROM {} WHERE chrom_int=? ORDER BY pos;'.format(self.table)
+        self.freq_arrays = None
+        if self.conf.get('preload', False):
+            try:
+                start_time = time.time()
+                self.freq_arrays = FrequencyArrays.from_db(self.dbconn, self.table, ['allele_freq'])
+                self.logger.info('preloaded {} variants in {:0.3f}s, {:0.1f} MB'.format(
+                    self.freq_arrays.num_rows, time.time() - start_time,
+                    self.freq_arrays.nbytes / 1024 / 1024))
+            except ImportError as e:
+                self.logger.warning('preload disabled: {}'.format(e))
+        self.presence_filter = None
+        if self.freq_arrays is None and self.conf.get('presence_filter', True):
+            self.presence_filter = self._load_presence_filter()
 
     def annotate(self, input_data, secondary_data=None):
         """
@@ -28,43 +77,150 @@ class CravatAnnotator(BaseAnnotator):
         line. input_data includes the following keys:
             ('uid', 'chrom', 'pos', 'ref_base', 'alt_base')
 
-        keys in the annotator database (one flat table):
-        CHR  Start  ID   REF  ALT    Frequencies
+        keys in the annotator database (one flat table, compiled with
+        popfreq_db.py):
+        chrom_int  pos  ref  alt  allele_freq
 
         should return a dictionary with keys matching the column names
         defined in example_annotator.yml. Extra column names will be ignored,
         and absent column names will be filled with None.
         """
-        out = {}
-
         # get input details
-        input_chrom = input_data['chrom'].lower()
+        input_chrom = chrom_to_int(input_data['chrom'])
         input_pos = input_data['pos']
         input_ref = input_data['ref_base']
         input_alt = input_data['alt_base']
 
+        if input_chrom is None:
+            return self._build_output(None)
 
-        sql_q = 'SELECT  Frequencies FROM abraom WHERE CHR="%s" AND Start=%s AND REF="%s" and ALT="%s";' \
-                %(input_chrom, input_pos, input_ref, input_alt)
+        if self.freq_arrays is not None:
+            return self._build_output(self.freq_arrays.lookup(input_chrom, input_pos, input_ref, input_alt))
 
+        if self.presence_filter is not None:
+            self.add_row_run_count('variants checked by presence filter')
+            if variant_key(input_chrom, input_pos, input_ref, input_alt) not in self.presence_filter:
+                self.add_row_run_count('lookups skipped by presence filter')
+                return self._build_output(None)
 
-        self.cursor.execute(sql_q)
+        self.cursor.execute(self.select_sql, (input_chrom, input_pos, input_ref, input_alt))
         sql_q_result = self.cursor.fetchone()
 
+        return self._build_output(sql_q_result)
 
-        allele_freq = ''
-
+    def annotate_batch(self, input_data_list, secondary_data=None):
+        """
+        Batched form of annotate. BaseAnnotator.run calls this with chunks of
+        input lines in place of one annotate call per line, and expects one
+        output dictionary per input line, in the same order.
+
+        The chunk's keys are loaded into the batch_keys temporary table and
+        matched against the ABRaOM table with a single join, or looked up all
+        at once in the preloaded arrays. Keys not in the presence filter are
+        left out, and the join is skipped if none are left.
+        """
+        if self.freq_arrays is not None:
+            sql_q_results = self.freq_arrays.lookup_many(
+                [chrom_to_int(input_data['chrom']) for input_data in input_data_list],
+                [input_data['pos'] for input_data in input_data_list],
+                [input_data['ref_base'] for input_data in input_data_list],
+                [input_data['alt_base'] for input_data in input_data_list])
+            return [self._build_output(sql_q_result) for sql_q_result in sql_q_results]
+
+        batch_keys = [(idx, chrom_to_int(input_data['chrom']), input_data['pos'],
+                       input_data['ref_base'], input_data['alt_base'])
+                      for idx, input_data in enumerate(input_data_list)]
+        if self.presence_filter is not None:
+            batch_keys = self._filter_batch_keys(batch_keys)
+            if not batch_keys:
+                return [self._build_output(None) for _ in input_data_list]
+
+        self.cursor.execute(self.batch_keys_sql)
+        self.cursor.execute('DELETE FROM batch_keys;')
+        self.cursor.executemany('INSERT INTO batch_keys VALUES (?, ?, ?, ?, ?);', batch_keys)
+
+        self.cursor.execute(self.batch_sql)
+
+        # Like fetchone in annotate, only the first match of a line is used.
+        sql_q_results = {}
+        for row in self.cursor.fetchall():
+            if row[0] not in sql_q_results:
+                sql_q_results[row[0]] = row[1:]
+
+        return [self._build_output(sql_q_results.get(idx))
+                for idx in range(len(input_data_list))]
+
+    def get_sorted_records(self, chrom):
+        """
+        Used by BaseAnnotator's merge join mode (--sorted). Streams the
+        ABRaOM records of a chromosome in position order, as tuples starting
+        with the position.
+        """
+        return self.dbconn.execute(self.sorted_sql, (chrom_to_int(chrom),))
 
-        if sql_q_result:
-            allele_freq += sql_q_result[0]
-            #print(allele_freq)
-            out['allele_freq'] = allele_freq
+    def annotate_merged(self, input_data, records, secondary_data=None):
+        """
+        Merge join counterpart of annotate. records are the rows from
+        get_sorted_records at the position of input_data.
+        """
+        for record in records:
+            if record[1] == input_data['ref_base'] and record[2] == input_data['alt_base']:
+                return self._build_output(record[3:])
+        return self._build_output(None)
 
+    def query_regions(self, regions):
+        """
+        Used by BaseAnnotator's region mode (--regions). Yields the ABRaOM
+        records at positions in regions, with their outputs. Each merged
+        region is one range seek on the table (see
+        popfreq_db.query_frequency_regions).
+        """
+        for record in query_frequency_regions(self.dbconn, self.table,
+                                              ['allele_freq'], regions):
+            yield record[:4] + (self._build_output(record[4:]),)
+
+    def _get_table(self, assembly):
+        tables = frequency_dbs['abraom']['assembly_tables']
+        table = tables.get(assembly)
+        if table is None:
+            raise ConfigurationError('assembly must be one of {}, not {}'.format(
+                ', '.join(sorted(tables)), assembly))
+        sql_q = 'SELECT 1 FROM sqlite_master WHERE type=? AND name=?;'
+        if self.dbconn.execute(sql_q, ('table', table)).fetchone() is None:
+            raise ConfigurationError('{} table for assembly {} not in the database, '\
+                'build it with build_abraom.py --chain'.format(table, assembly))
+        return table
+
+    def _load_presence_filter(self):
+        filter_path = get_filter_path(self.db_pool.db_path, self.table)
+        try:
+            presence_filter = load_frequency_filter(self.dbconn, filter_path, self.table)
+        except (IOError, ValueError) as e:
+            self.logger.warning('presence filter disabled: {}'.format(e))
+            return None
+        if presence_filter is not None:
+            self.logger.info('presence filter of {} variants, {:0.1f} KiB'.format(
+                presence_filter.num_keys, presence_filter.nbytes / 1024))
+        return presence_filter
+
+    def _filter_batch_keys(self, batch_keys):
+        # Keeps the batch_keys rows whose variants may be in the table.
+        maybe_present = self.presence_filter.contains_many(
+            [variant_key(*batch_key[1:]) for batch_key in batch_keys])
+        kept = [batch_key for batch_key, present in zip(batch_keys, maybe_present)
+                if present]
+        self.add_run_count('variants checked by presence filter', len(batch_keys))
+        self.add_run_count('lookups skipped by presence filter', len(batch_keys) - len(kept))
+        return kept
+
+    def _build_output(self, sql_q_result):
+        out = {}
 
+        if sql_q_result:
+            out['allele_freq'] = sql_q_result[0]
         else :
             out['allele_freq'] = 9999.99
 
-
         return out
 
 
@@ -0,0 +1,108 @@
+"""
+Builds the ABRaOM annotator database from the ABRaOM release file
+(ABRaOM_60+_SABE_609_exomes_annotated, plain or gzipped).
+
+Only PASS records are kept. Chr, Start, Ref and Alt are the first four
+columns and the allele frequency is column 15 (both 1-based, as for cut -f),
+which replaces
+
+    grep PASS ABRaOM_60+_SABE_609_exomes_annotated | cut -f 1,2,3,4,15
+
+The records are streamed into popfreq_db.write_frequency_db, which bulk
+loads them in one unjournaled transaction and builds the clustered table
+afterwards.
+
+    python build_abraom.py ABRaOM_60+_SABE_609_exomes_annotated.gz data/abraom.sqlite
+
+ABRaOM is on hg19. With --chain hg19ToHg38.over.chain.gz, the variants are
+also lifted to hg38 into the abraom_hg38 table, which the annotator uses for
+hg38 inputs.
+
+A Bloom filter of each table is written next to the database (see
+popfreq_db.py filter), sized with --fp-rate and --filter-max-kb, unless
+--no-filter is given.
+"""
+import argparse
+import gzip
+import sys
+import time
+from cravat.liftover import ChainIndex
+from cravat.popfreq_db import add_filter_arguments
+from cravat.popfreq_db import frequency_dbs
+from cravat.popfreq_db import lift_frequency_table
+from cravat.popfreq_db import write_frequency_db
+from cravat.popfreq_db import write_filter_from_args
+from cravat.popfreq_db import write_frequency_store
+
+def open_source(path):
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt')
+    else:
+        return open(path)
+
+def read_pass_records(path, freq_column=15, filter_column=None):
+    """
+    Yields (chrom, pos, ref, alt, freq) of the PASS records in path.
+    freq_column and filter_column are 1-based. Without filter_column, a
+    record passes if any of its fields is PASS. Lines whose position is not
+    a number, such as the header, are skipped.
+    """
+    with open_source(path) as f:
+        for line in f:
+            toks = line.rstrip('\r\n').split('\t')
+            if filter_column:
+                if toks[filter_column - 1] != 'PASS':
+                    continue
+            elif 'PASS' not in toks:
+                continue
+            if not toks[1].isdigit():
+                continue
+            yield toks[0], int(toks[1]), toks[2], toks[3], toks[freq_column - 1]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the ABRaOM database from an ABRaOM release.')
+    parser.add_argument('source', help='ABRaOM release file, plain or gzipped.')
+    parser.add_argument('output_db', help='Compiled database to write.')
+    parser.add_argument('--freq-column', dest='freq_column', type=int, default=15,
+                        help='1-based column of the allele frequency. Default 15.')
+    parser.add_argument('--filter-column', dest='filter_column', type=int,
+                        help='1-based column which must be PASS. '\
+                             +'Default is any column.')
+    parser.add_argument('--store', dest='store_dir',
+                        help='Also write the memory-mapped store here.')
+    parser.add_argument('--chain', dest='chain',
+                        help='hg19 to hg38 chain file, to also write the '\
+                             +'abraom_hg38 table.')
+    parser.add_argument('--no-filter', dest='no_filter', action='store_true',
+                        help='Do not write the Bloom filters.')
+    add_filter_arguments(parser)
+    args = parser.parse_args()
+    db_def = frequency_dbs['abraom']
+    start_time = time.time()
+    records = read_pass_records(args.source, freq_column=args.freq_column,
+                                filter_column=args.filter_column)
+    num_rows = write_frequency_db(args.output_db, db_def['table'],
+                                  db_def['freq_columns'], records)
+    print('{} rows written to {} in {:0.1f}s'.format(num_rows, args.output_db,
+                                                    time.time() - start_time))
+    if args.chain:
+        start_time = time.time()
+        lifted_table = db_def['assembly_tables']['hg38']
+        num_variants, num_rows = lift_frequency_table(args.output_db, db_def['table'],
+            db_def['freq_columns'], lifted_table, ChainIndex.load(args.chain))
+        print('{} of {} variants lifted to {} in {:0.1f}s'.format(num_rows,
+            num_variants, lifted_table, time.time() - start_time))
+    if not args.no_filter:
+        write_filter_from_args(args.output_db, db_def['table'], args)
+        if args.chain:
+            write_filter_from_args(args.output_db, lifted_table, args)
+    if args.store_dir:
+        write_frequency_store(args.output_db, db_def['table'],
+                              db_def['freq_columns'], args.store_dir)
+        print('store written to {}'.format(args.store_dir))
+
+if __name__ == '__main__':
+    main()
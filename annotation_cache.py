@@ -0,0 +1,264 @@
+"""
+Result cache for BaseAnnotator. Input lines which repeat the same key, such
+as the same variant in several samples of a cohort, are annotated once and
+the other copies are served from the cache.
+
+The cache is enabled in the module yml:
+
+    cache:
+      size: 100000
+      key_columns: [chrom, pos, ref_base, alt_base]
+
+size is the number of results held. When full, the least recently used
+result is evicted. key_columns default to the input columns other than the
+id column.
+
+The cache is shared by the thread workers of --pipeline, so lookups and
+updates hold a lock.
+
+With persistent set under cache, results also go to a PersistentCache on
+disk, which later jobs read before annotating.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+class ResultCache(object):
+
+    # Returned by get when the key is not in the cache. None is a valid
+    # result (annotate may return None to write nothing).
+    missing = object()
+
+    def __init__(self, size, key_columns):
+        if size < 1:
+            raise ValueError('Cache size must be at least 1, not %d' %size)
+        self.size = size
+        self.key_columns = key_columns
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, input_data):
+        return tuple([input_data[col_name] for col_name in self.key_columns])
+
+    # Returns a copy of the cached result of key, or ResultCache.missing.
+    # BaseAnnotator fills in the id column of the result it writes, so
+    # results are copied on the way in and out.
+    def get(self, key):
+        with self._lock:
+            try:
+                result = self.results[key]
+            except KeyError:
+                self.misses += 1
+                return self.missing
+            self.results.move_to_end(key)
+            self.hits += 1
+        if result is None:
+            return None
+        return dict(result)
+
+    def put(self, key, result):
+        if result is not None:
+            result = dict(result)
+        with self._lock:
+            self.results[key] = result
+            self.results.move_to_end(key)
+            if len(self.results) > self.size:
+                self.results.popitem(last=False)
+
+    # Counts a hit which did not need a lookup, such as a key repeated in
+    # a batch.
+    def count_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    # Adds the hits and misses of another copy of the cache, such as a
+    # process worker's.
+    def add_counts(self, hits, misses):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        if lookups:
+            hit_rate = self.hits / lookups
+        else:
+            hit_rate = 0.0
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': hit_rate,
+                'size': len(self.results)}
+
+class PersistentCache(object):
+    """
+    On-disk result cache shared by jobs, under a module's ResultCache:
+
+        cache:
+          size: 100000
+          persistent:
+            path: ~/.cache/cravat/annotation_cache.sqlite
+            max_size_mb: 1024
+
+    Entries are content-addressed: a result is stored under a hash of the
+    cache's namespace and its key, and the namespace is a hash of the
+    annotator name and version, the key columns, the module conf and the
+    sizes and modification times of the annotator's data files. A new
+    version, conf or database makes the old entries unreachable, and they
+    are evicted like any other unused entries.
+
+    The cache is one sqlite database in WAL mode, so jobs can read and
+    write it at the same time. Writes and last-used times are buffered and
+    written in batches. When the entries take more than max_size_mb, the
+    least recently used ones are deleted. Forked workers open their own
+    connection.
+    """
+
+    # Entries written in one transaction.
+    flush_size = 1000
+    # Keys in one IN (...) lookup.
+    lookup_size = 500
+
+    def __init__(self, path, namespace, max_bytes):
+        self.path = path
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._pid = None
+        self._conn = None
+        self._parent_conns = []
+        self._pending = {}
+        self._touched = set()
+        dir_path = os.path.dirname(path)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        conn = self._get_conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS entries (key BLOB PRIMARY KEY, '\
+                     'result TEXT, size INT, last_used INT) WITHOUT ROWID;')
+        conn.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);')
+
+    @staticmethod
+    def make_namespace(*parts):
+        """
+        Hash of parts, which must be JSON serializable.
+        """
+        encoded = json.dumps(parts, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(encoded, digest_size=16).digest()
+
+    def _get_conn(self):
+        # sqlite connections must not be used across fork, so a forked
+        # worker opens its own, and keeps the inherited one referenced so
+        # that it is not closed here.
+        if self._pid != os.getpid():
+            if self._conn is not None:
+                self._parent_conns.append(self._conn)
+            self._conn = sqlite3.connect(self.path, timeout=30,
+                                         isolation_level=None,
+                                         check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL;')
+            self._conn.execute('PRAGMA synchronous=NORMAL;')
+            self._pid = os.getpid()
+            self._pending = {}
+            self._touched = set()
+        return self._conn
+
+    def _hash_key(self, key):
+        encoded = json.dumps(key, default=str).encode()
+        return hashlib.blake2b(self.namespace + encoded, digest_size=16).digest()
+
+    def get_many(self, keys):
+        """
+        Returns {key: result} of the keys which are in the cache.
+        """
+        hashed = {}
+        for key in keys:
+            hashed[self._hash_key(key)] = key
+        found = {}
+        with self._lock:
+            conn = self._get_conn()
+            for hashed_key in list(hashed):
+                if hashed_key in self._pending:
+                    found[hashed[hashed_key]] = json.loads(self._pending[hashed_key])
+                    del hashed[hashed_key]
+            hashed_keys = list(hashed)
+            for start in range(0, len(hashed_keys), self.lookup_size):
+                chunk = hashed_keys[start:start + self.lookup_size]
+                sql_q = 'SELECT key, result FROM entries WHERE key IN ({});'\
+                    .format(', '.join(['?'] * len(chunk)))
+                for hashed_key, result in conn.execute(sql_q, chunk):
+                    found[hashed[hashed_key]] = json.loads(result)
+                    self._touched.add(hashed_key)
+        return found
+
+    def get(self, key):
+        found = self.get_many([key])
+        return found.get(key, ResultCache.missing)
+
+    def put(self, key, result):
+        encoded = json.dumps(result)
+        with self._lock:
+            self._get_conn()
+            self._pending[self._hash_key(key)] = encoded
+            if len(self._pending) >= self.flush_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        conn = self._get_conn()
+        if not self._pending and not self._touched:
+            return
+        # In microseconds, so that entries written by earlier flushes in
+        # the same second are evicted first.
+        now = int(time.time() * 1000000)
+        conn.execute('BEGIN IMMEDIATE;')
+        try:
+            conn.executemany('UPDATE entries SET last_used=? WHERE key=?;',
+                             ((now, hashed_key) for hashed_key in self._touched))
+            conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?);',
+                             ((hashed_key, encoded, len(encoded), now)
+                              for hashed_key, encoded in self._pending.items()))
+            if self._pending:
+                self._evict(conn)
+            conn.execute('COMMIT;')
+        except Exception:
+            conn.execute('ROLLBACK;')
+            raise
+        self._pending = {}
+        self._touched = set()
+
+    def _get_used_bytes(self, conn):
+        page_size = conn.execute('PRAGMA page_size;').fetchone()[0]
+        page_count = conn.execute('PRAGMA page_count;').fetchone()[0]
+        freelist_count = conn.execute('PRAGMA freelist_count;').fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def _evict(self, conn):
+        # Deletes the least recently used entries until the used pages are
+        # at most 90% of max_bytes. Freed pages are reused by later
+        # entries, so the file stops growing at about max_bytes.
+        if self._get_used_bytes(conn) <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        while self._get_used_bytes(conn) > target:
+            num_deleted = conn.execute('DELETE FROM entries WHERE key IN '\
+                '(SELECT key FROM entries ORDER BY last_used LIMIT ?);',
+                (self.flush_size,)).rowcount
+            if num_deleted == 0:
+                break
+
+    def close(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            self._flush()
+            self._conn.close()
+            self._conn = None
+            self._pid = None
@@ -1,8 +1,14 @@
 import logging
 import os
 import time
-import traceback
 import argparse
+import asyncio
+import concurrent.futures
+import itertools
+import multiprocessing
+import shutil
+import tempfile
+import threading
 from .inout import CravatReader
 from .inout import CravatWriter
 from .inout import AllMappingsParser
@@ -15,20 +21,55 @@ from .constants import all_mappings_col_name
 from .constants import mapping_parser_name
 from .exceptions import InvalidData
 from .exceptions import ConfigurationError
+from .exceptions import BadFormatError
+from .annotation_cache import ResultCache
+from .annotation_cache import PersistentCache
+from .profiler import Profiler
+from .profiler import ProfilingCursor
+from .columnar import ColumnarWriter
+from .error_aggregator import ErrorAggregator
+from .error_aggregator import WorkerError
+from .connection_pool import ConnectionPool
+from .pipeline import Pipeline
+from .pipeline import valid_worker_types
+from .regions import read_bed
 import sqlite3
 import json
 import cravat.cravat_util as cu
 
+# The annotator whose gene_summary_finish the summary worker processes
+# call. It is set before the workers are forked, so it does not need to be
+# pickled.
+_summary_annotator = None
+
+def _finish_gene_summaries(items):
+    return [_summary_annotator.gene_summary_finish(hugo, state) for hugo, state in items]
+
 class BaseAnnotator(object):
 
     valid_levels = ['variant','gene']
     valid_input_formats = ['crv','crx','crg']
+    valid_output_formats = ['text', 'columnar']
     id_col_defs = {'variant':crv_def[0],
                    'gene':crg_def[0]}
     default_input_columns = {'crv':[x['name'] for x in crv_def],
                              'crx':[x['name'] for x in crx_def],
                              'crg':[x['name'] for x in crg_def]}
     required_conf_keys = ['level', 'output_columns']
+    # Leading columns of --regions output: chrom, pos, ref_base, alt_base.
+    region_col_defs = crv_def[1:5]
+    default_persistent_cache_path = os.path.join(
+        os.environ.get('XDG_CACHE_HOME', os.path.join('~', '.cache')),
+        'cravat', 'annotation_cache.sqlite')
+    # Conf keys which do not change results, left out of the persistent
+    # cache's namespace.
+    cache_neutral_conf_keys = ['cache', 'logging_level', 'pipeline', 'batch_size',
+                               'fast_rows', 'output_format', 'sorted_input', 'db',
+                               'max_error_samples', 'max_distinct_errors',
+                               'columnar_block_rows', 'columnar_compression',
+                               'summary_workers']
+    # Genes sent to a summary worker process at a time.
+    gene_summary_chunk_size = 100
 
     def __init__(self, cmd_args, status_writer):
         try:
@@ -50,6 +91,18 @@ class BaseAnnotator(object):
             self.output_basename = None
             self.plain_output = None
             self.job_conf_path = None
+            self.sorted_input = False
+            self.workers = 1
+            self.profile = False
+            self.profiler = None
+            self.output_format = None
+            self.pipeline_workers = None
+            self.pipeline_worker_type = None
+            self.pipeline_queue_depth = None
+            self.regions_mode = False
+            self.run_counts = {}
+            self._run_counts_lock = threading.Lock()
+            self._reset_row_run_counts()
             self.parse_cmd_args(cmd_args)
             # Make output dir if it doesn't exist
             if not(os.path.exists(self.output_dir)):
@@ -66,11 +119,60 @@ class BaseAnnotator(object):
                 self.annotator_display_name = self.conf['title']
             else:
                 self.annotator_display_name = os.path.basename(self.annotator_dir).upper()
+            self.batch_size = int(self.conf.get('batch_size', 1000))
+            self.fast_rows = bool(self.conf.get('fast_rows', False))
+            self.error_aggregator = ErrorAggregator(
+                max_samples=int(self.conf.get('max_error_samples', 5)),
+                max_errors=int(self.conf.get('max_distinct_errors', 100)))
+            if self.output_format is None:
+                self.output_format = self.conf.get('output_format', 'text')
+            if self.output_format not in self.valid_output_formats:
+                err_msg = 'Invalid output_format %s, select from %s' \
+                    %(self.output_format, ', '.join(self.valid_output_formats))
+                raise ConfigurationError(err_msg)
+            if self.conf.get('sorted_input', False):
+                self.sorted_input = True
+            self._setup_pipeline_conf()
+            self.db_pool = None
             self.dbconn = None
             self.cursor = None
+            self.result_cache = None
+            self.persistent_cache = None
+            self.persistent_cache_path = None
+            # {lnum: .err record} of the sample lines of a --workers shard
+            self._shard_error_records = None
         except Exception as e:
             self._log_exception(e)
 
+    # The database connection and cursor of the current thread, from
+    # self.db_pool. Without a database, they are plain attributes, which
+    # modules may set in setup.
+    @property
+    def dbconn(self):
+        if self.db_pool is not None:
+            return self.db_pool.get_connection()
+        return self._dbconn
+
+    @dbconn.setter
+    def dbconn(self, conn):
+        if self.db_pool is not None:
+            self.db_pool.set_connection(conn)
+        else:
+            self._dbconn = conn
+
+    @property
+    def cursor(self):
+        if self.db_pool is not None:
+            return self.db_pool.get_cursor()
+        return self._cursor
+
+    @cursor.setter
+    def cursor(self, cursor):
+        if self.db_pool is not None:
+            self.db_pool.set_cursor(cursor)
+        else:
+            self._cursor = cursor
+
     def _log_exception(self, e, halt=True):
         if halt:
             raise e
@@ -108,6 +210,30 @@ class BaseAnnotator(object):
         except Exception as e:
             self._log_exception(e)
 
+    # Pipeline options, from the command line or the pipeline section of
+    # the module conf:
+    #
+    #   pipeline:
+    #     workers: 4           # annotate workers, 0 disables the pipeline
+    #     worker_type: thread  # or process
+    #     queue_depth: 16      # chunks read but not yet written
+    #     chunk_size: 100      # lines per chunk without annotate_batch
+    def _setup_pipeline_conf(self):
+        pipeline_conf = self.conf.get('pipeline') or {}
+        if self.pipeline_workers is None:
+            self.pipeline_workers = int(pipeline_conf.get('workers', 0))
+        if self.pipeline_worker_type is None:
+            self.pipeline_worker_type = pipeline_conf.get('worker_type', 'thread')
+        if self.pipeline_queue_depth is None:
+            self.pipeline_queue_depth = int(pipeline_conf.get('queue_depth', 16))
+        self.pipeline_chunk_size = int(pipeline_conf.get('chunk_size', 100))
+        if self.pipeline_worker_type not in valid_worker_types:
+            err_msg = 'Invalid pipeline worker_type %s, select from %s' \
+                %(self.pipeline_worker_type, ', '.join(valid_worker_types))
+            raise ConfigurationError(err_msg)
+        if self.pipeline_queue_depth < 1 or self.pipeline_chunk_size < 1:
+            raise ConfigurationError('Pipeline queue_depth and chunk_size must be at least 1')
+
     def _define_cmd_parser(self):
         try:
             parser = argparse.ArgumentParser()
@@ -132,6 +258,48 @@ class BaseAnnotator(object):
                                 action='store_true',
                                 dest='plainoutput',
                                 help='Skip column definition writing')
+            parser.add_argument('--sorted',
+                                action='store_true',
+                                dest='sorted_input',
+                                help='Input is sorted by chrom and pos. '\
+                                     +'Enables merge join annotation.')
+            parser.add_argument('--workers',
+                                dest='workers',
+                                type=int,
+                                default=1,
+                                help='Number of worker processes. The input is '\
+                                     +'split into this many shards.')
+            parser.add_argument('--output-format',
+                                dest='output_format',
+                                choices=self.valid_output_formats,
+                                help='text (default) or columnar, a typed '\
+                                     +'binary format. See columnar.py.')
+            parser.add_argument('--profile',
+                                action='store_true',
+                                dest='profile',
+                                help='Time the stages of the run and write them '\
+                                     +'to <name>.<annotator>.profile.json.')
+            parser.add_argument('--pipeline',
+                                dest='pipeline_workers',
+                                type=int,
+                                help='Number of annotate workers. Input reading, '\
+                                     +'annotation and output writing run '\
+                                     +'concurrently. 0 (default) disables.')
+            parser.add_argument('--pipeline-type',
+                                dest='pipeline_worker_type',
+                                choices=valid_worker_types,
+                                help='thread (default) or process annotate workers.')
+            parser.add_argument('--queue-depth',
+                                dest='pipeline_queue_depth',
+                                type=int,
+                                help='Chunks in flight in the pipeline. Default 16.')
+            parser.add_argument('--regions',
+                                action='store_true',
+                                dest='regions_mode',
+                                help='Input is a BED file. Writes the module\'s '\
+                                     +'records in its regions to '\
+                                     +'<name>.<annotator>.regions instead of '\
+                                     +'annotating.')
             self.cmd_arg_parser = parser
         except Exception as e:
             self._log_exception(e)
@@ -152,6 +320,14 @@ class BaseAnnotator(object):
                 self.output_dir = parsed_args.output_dir
 
             self.plain_output = parsed_args.plainoutput
+            self.sorted_input = parsed_args.sorted_input
+            self.workers = max(parsed_args.workers, 1)
+            self.profile = parsed_args.profile
+            self.output_format = parsed_args.output_format
+            self.pipeline_workers = parsed_args.pipeline_workers
+            self.pipeline_worker_type = parsed_args.pipeline_worker_type
+            self.pipeline_queue_depth = parsed_args.pipeline_queue_depth
+            self.regions_mode = parsed_args.regions_mode
             self.output_basename = os.path.basename(self.primary_input_path)
             if parsed_args.name:
                 self.output_basename = parsed_args.name
@@ -170,63 +346,735 @@ class BaseAnnotator(object):
             self.status_writer.queue_status_update('status', 'Started {} ({})'.format(self.conf['title'], self.annotator_name))
         try:
             start_time = time.time()
-            self.logger.info('started: %s'%time.asctime(time.localtime(start_time)))
-            print('        {}: started at {}'.format(self.annotator_name, time.asctime(time.localtime(start_time))))
-            self.base_setup()
-            last_status_update_time = time.time()
-            for lnum, line, input_data, secondary_data in self._get_input():
-                try:
-                    if self.update_status_json_flag:
-                        cur_time = time.time()
-                        if lnum % 10000 == 0 or cur_time - last_status_update_time > 3:
-                            self.status_writer.queue_status_update('status', 'Running {} ({}): line {}'.format(self.conf['title'], self.annotator_name, lnum))
-                            last_status_update_time = cur_time
-                    if secondary_data == {}:
-                        output_dict = self.annotate(input_data)
-                    else:
-                        output_dict = self.annotate(input_data, secondary_data)
-                    # This enables summarizing without writing for now.
-                    if output_dict == None:
-                        continue
-                    # Preserves the first column
-                    output_dict[self._id_col_name] = input_data[self._id_col_name]
-                    # Fill absent columns with empty strings
-                    for output_col in self.conf['output_columns']:
-                        col_name = output_col['name']
-                        if col_name not in output_dict:
-                            output_dict[col_name] = ''
-                    self.output_writer.write_data(output_dict)
-                except Exception as e:
-                    self._log_runtime_exception(lnum, line, input_data, e)
-
-            # This does summarizing.
-            self.postprocess()
-
-            self.base_cleanup()
-            end_time = time.time()
-            self.logger.info('finished: {0}'.format(time.asctime(time.localtime(end_time))))
-            print('        {}: finished at {}'.format(self.annotator_name, time.asctime(time.localtime(end_time))))
-            run_time = end_time - start_time
-            self.logger.info('runtime: {0:0.3f}s'.format(run_time))
-            print('        {}: runtime {:0.3f}s'.format(self.annotator_name, run_time))
-            if self.update_status_json_flag:
-                version = self.conf.get('version', 'unknown')
-                self.status_writer.add_annotator_version_to_status_json(self.annotator_name, version)
-                self.status_writer.queue_status_update('status', 'Finished {} ({})'.format(self.conf['title'], self.annotator_name))
+            if self.regions_mode:
+                self._run_regions(start_time)
+                self._close_run_log()
+                return
+            self._start_run(start_time)
+            if self.workers > 1 \
+                    and 'fork' in multiprocessing.get_all_start_methods():
+                self._run_shards()
+            else:
+                self._annotate_input(self._get_input())
+                if self.result_cache is not None:
+                    self._log_cache_stats(self.result_cache.hits,
+                                          self.result_cache.misses)
+            self._finish_run(start_time)
         except Exception as e:
             self._log_exception(e)
+        self._close_run_log()
+
+    # The parts of run before and after annotation, also used by
+    # fused_runner.py.
+    def _start_run(self, start_time):
+        self.logger.info('started: %s'%time.asctime(time.localtime(start_time)))
+        print('        {}: started at {}'.format(self.annotator_name, time.asctime(time.localtime(start_time))))
+        if self.profile:
+            self.profiler = Profiler()
+        self.base_setup()
+        self.last_status_update_time = time.time()
+
+    def _finish_run(self, start_time):
+        self._log_error_summary()
+        self._log_run_counts()
+        self._report_persistent_cache()
+
+        # This does summarizing.
+        self.postprocess()
+
+        self.base_cleanup()
+        if self.profiler is not None:
+            self._write_profile()
+        end_time = time.time()
+        self.logger.info('finished: {0}'.format(time.asctime(time.localtime(end_time))))
+        print('        {}: finished at {}'.format(self.annotator_name, time.asctime(time.localtime(end_time))))
+        run_time = end_time - start_time
+        self.logger.info('runtime: {0:0.3f}s'.format(run_time))
+        print('        {}: runtime {:0.3f}s'.format(self.annotator_name, run_time))
+        self._queue_finished_status()
+
+    # Records the module version in the job status and marks it finished.
+    def _queue_finished_status(self):
+        if self.update_status_json_flag:
+            version = self.conf.get('version', 'unknown')
+            self.status_writer.add_annotator_version_to_status_json(self.annotator_name, version)
+            self.status_writer.queue_status_update('status', 'Finished {} ({})'.format(self.conf['title'], self.annotator_name))
+
+    # --regions run. The input is a BED file, whose regions are passed to
+    # query_regions, and the records it yields are written with their
+    # positions, alleles and output columns. The run has no input reader,
+    # cache or workers.
+    def _run_regions(self, start_time):
+        self.logger.info('started: %s'%time.asctime(time.localtime(start_time)))
+        print('        {}: started at {}'.format(self.annotator_name, time.asctime(time.localtime(start_time))))
+        regions = read_bed(self.primary_input_path)
+        self.secondary_readers = {}
+        self._open_db_connection()
+        self._preload_tables()
+        self.setup()
+        self.output_path = os.path.join(self.output_dir,
+            '.'.join([self.output_basename, self.annotator_name, 'regions']))
+        writer = CravatWriter(self.output_path)
+        writer.write_meta_line('name', self.annotator_name)
+        writer.write_meta_line('displayname', self.annotator_display_name)
+        for col_index, col_def in enumerate(self.region_col_defs
+                                            + self.conf['output_columns'][1:]):
+            writer.add_column(col_index, col_def)
+        writer.write_definition()
+        num_records = 0
+        for chrom, pos, ref_base, alt_base, output_dict in self.query_regions(regions):
+            output_dict = dict(output_dict)
+            output_dict.update(chrom=chrom, pos=pos, ref_base=ref_base,
+                               alt_base=alt_base)
+            writer.write_data(output_dict)
+            num_records += 1
+        writer.close()
+        self.logger.info('{} records in {} regions written to {}'.format(
+            num_records, len(regions), self.output_path))
+        if self.dbconn is not None:
+            self.close_db_connection()
+        self.cleanup()
+        end_time = time.time()
+        self.logger.info('finished: {0}'.format(time.asctime(time.localtime(end_time))))
+        print('        {}: finished at {}'.format(self.annotator_name, time.asctime(time.localtime(end_time))))
+        run_time = end_time - start_time
+        self.logger.info('runtime: {0:0.3f}s'.format(run_time))
+        print('        {}: runtime {:0.3f}s'.format(self.annotator_name, run_time))
+        self._queue_finished_status()
+
+    def _close_run_log(self):
         if hasattr(self, 'log_handler'):
             self.log_handler.close()
         if self.output_basename == '__dummy__':
             os.remove(self.log_path)
 
+    def _annotate_input(self, rows):
+        if self._use_merge_join():
+            self._annotate_merge_join(rows)
+        else:
+            self._annotate_rows(rows)
+
+    # Splits the primary input into byte ranges of whole lines, annotates
+    # each range in a forked worker process and appends the workers'
+    # output files to this annotator's, in input order.
+    def _run_shards(self):
+        shard_dir = tempfile.mkdtemp(prefix='.{}.{}.'.format(self.output_basename,
+                                                             self.annotator_name),
+                                     dir=self.output_dir)
+        try:
+            shards = self._split_primary_input(self.workers)
+            mp_context = multiprocessing.get_context('fork')
+            progress = mp_context.Array('l', len(shards), lock=False)
+            # Result cache hits and misses of each worker
+            cache_counts = mp_context.Array('l', 2 * len(shards), lock=False)
+            procs = []
+            for shard_index, shard in enumerate(shards):
+                proc = mp_context.Process(target=self._run_shard,
+                                          args=(shard_dir, shard_index, shard,
+                                                progress, cache_counts))
+                proc.start()
+                procs.append(proc)
+            self.logger.info('started {} workers'.format(len(procs)))
+            while any(proc.is_alive() for proc in procs):
+                time.sleep(0.5)
+                self._update_running_status(sum(progress))
+            for proc in procs:
+                proc.join()
+            failed = [i for i, proc in enumerate(procs) if proc.exitcode != 0]
+            if failed:
+                raise Exception('Worker(s) for shard(s) %s failed' \
+                    %', '.join([str(i) for i in failed]))
+            if self.result_cache is not None:
+                self._log_cache_stats(sum(cache_counts[0::2]),
+                                      sum(cache_counts[1::2]))
+            for shard_index in range(len(shards)):
+                shard_path = os.path.join(shard_dir, '{}.errors.json'.format(shard_index))
+                with open(shard_path) as f:
+                    self.error_aggregator.merge(json.load(f))
+                shard_path = os.path.join(shard_dir, '{}.counts.json'.format(shard_index))
+                with open(shard_path) as f:
+                    self._add_run_counts(json.load(f))
+            if self.profiler is not None:
+                for shard_index in range(len(shards)):
+                    shard_path = os.path.join(shard_dir, '{}.profile.json'.format(shard_index))
+                    with open(shard_path) as f:
+                        self.profiler.merge(json.load(f))
+            shard_output_paths = [os.path.join(shard_dir, '{}.out'.format(shard_index))
+                                  for shard_index in range(len(shards))]
+            # CravatWriter writes the titles along with the first data line.
+            if any(os.path.getsize(path) > 0 for path in shard_output_paths):
+                self.output_writer.write_titles()
+            self.output_writer.close()
+            with open(self.output_path, 'ab') as wf:
+                for shard_path in shard_output_paths:
+                    with open(shard_path, 'rb') as f:
+                        shutil.copyfileobj(f, wf)
+            # Only the samples kept by the merged aggregator go to the .err
+            # file, so that it has max_error_samples lines per error as
+            # without workers.
+            error_records = {}
+            for shard_index in range(len(shards)):
+                shard_path = os.path.join(shard_dir, '{}.samples.json'.format(shard_index))
+                with open(shard_path) as f:
+                    error_records.update((lnum, record) for lnum, record in json.load(f))
+            sample_lnums = sorted(lnum for error in self.error_aggregator.errors.values()
+                                  for lnum, _ in error['samples'])
+            for lnum in sample_lnums:
+                self.error_logger.error(error_records[lnum])
+        finally:
+            shutil.rmtree(shard_dir, ignore_errors=True)
+
+    # Returns (start, end, lines_before) byte ranges covering the data
+    # lines of the primary input, plus the header lines which precede them.
+    def _split_primary_input(self, num_shards):
+        with open(self.primary_input_path, 'rb') as f:
+            header = b''
+            while True:
+                data_start = f.tell()
+                l = f.readline()
+                if not l.startswith(b'#'):
+                    break
+                header += l
+            size = os.fstat(f.fileno()).st_size
+            bounds = [data_start]
+            for i in range(1, num_shards):
+                offset = data_start + (size - data_start) * i // num_shards
+                if offset <= bounds[-1]:
+                    continue
+                f.seek(offset - 1)
+                f.readline()
+                if f.tell() < size:
+                    bounds.append(f.tell())
+            bounds.append(size)
+            # Line numbers as counted by CravatReader, so that lnums in
+            # the workers match those of a single process run.
+            f.seek(0)
+            lines_before = 0
+            shards = []
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                while f.tell() < start:
+                    block = f.read(min(1 << 20, start - f.tell()))
+                    lines_before += block.count(b'\n')
+                shards.append((start, end, lines_before))
+        self._shard_header = header
+        return shards
+
+    def _run_shard(self, shard_dir, shard_index, shard, progress, cache_counts):
+        try:
+            start, end, lines_before = shard
+            self.update_status_json_flag = False
+            shard_input_path = os.path.join(shard_dir, '{}.input'.format(shard_index))
+            with open(self.primary_input_path, 'rb') as f, \
+                    open(shard_input_path, 'wb') as wf:
+                wf.write(self._shard_header)
+                f.seek(start)
+                remaining = end - start
+                while remaining > 0:
+                    block = f.read(min(1 << 20, remaining))
+                    wf.write(block)
+                    remaining -= len(block)
+            lnum_offset = lines_before - self._shard_header.count(b'\n')
+            self.primary_input_path = shard_input_path
+            self._setup_primary_input()
+            shard_output_path = os.path.join(shard_dir, '{}.out'.format(shard_index))
+            if self.output_format == 'columnar':
+                self.output_writer = self._make_columnar_writer(shard_output_path,
+                                                                include_definition=False)
+            else:
+                self.output_writer = CravatWriter(shard_output_path,
+                                                  include_definition=False,
+                                                  include_titles=False)
+            for col_index, col_def in enumerate(self.conf['output_columns']):
+                self.output_writer.add_column(col_index, col_def)
+            # Sample lines are kept for the parent, which writes those of
+            # the merged errors to the .err file.
+            for handler in self.error_logger.handlers[:]:
+                self.error_logger.removeHandler(handler)
+            self._shard_error_records = {}
+            # The connections inherited from the parent process are left
+            # alone, and kept referenced so that they are not closed here.
+            self._parent_db_pool = self.db_pool
+            self._open_db_connection()
+            for fetcher in self.secondary_readers.values():
+                fetcher.reopen()
+            self.run_counts = {}
+            self._reset_row_run_counts()
+            self.setup()
+            if self.profiler is not None:
+                self.profiler.reset()
+                self._instrument()
+            def shard_rows():
+                for count, (lnum, line, input_data, secondary_data) in enumerate(self._get_input()):
+                    if count % 1000 == 0:
+                        progress[shard_index] = count
+                    yield lnum + lnum_offset, line, input_data, secondary_data
+            self._annotate_input(shard_rows())
+            if self.result_cache is not None:
+                cache_counts[2 * shard_index] = self.result_cache.hits
+                cache_counts[2 * shard_index + 1] = self.result_cache.misses
+            self._close_persistent_cache()
+            if self.profiler is not None:
+                self.profiler.write(os.path.join(shard_dir, '{}.profile.json'.format(shard_index)))
+            with open(os.path.join(shard_dir, '{}.errors.json'.format(shard_index)), 'w') as wf:
+                json.dump(self.error_aggregator.get_state(), wf)
+            with open(os.path.join(shard_dir, '{}.samples.json'.format(shard_index)), 'w') as wf:
+                json.dump(list(self._shard_error_records.items()), wf)
+            self._collect_row_run_counts()
+            with open(os.path.join(shard_dir, '{}.counts.json'.format(shard_index)), 'w') as wf:
+                json.dump(self.run_counts, wf)
+            self.output_writer.close()
+            for fetcher in self.secondary_readers.values():
+                fetcher.close()
+        except Exception as e:
+            self.logger.exception(e)
+            raise
+
+    def _use_merge_join(self):
+        return self.sorted_input \
+            and self.conf['level'] == 'variant' \
+            and hasattr(self, 'get_sorted_records') \
+            and hasattr(self, 'annotate_merged')
+
+    # Merge join for input sorted by chrom and pos. get_sorted_records(chrom)
+    # streams the module's records of a chromosome as tuples starting with
+    # pos, in ascending pos order, and annotate_merged gets the records at
+    # the position of each input line. Once an input line is out of order,
+    # it and the rest of the input go through _annotate_rows instead.
+    def _annotate_merge_join(self, rows):
+        rows = iter(rows)
+        done_chroms = set()
+        cur_chrom = None
+        last_pos = None
+        record_groups = None
+        group = None
+        for row in rows:
+            lnum, line, input_data, secondary_data = row
+            chrom = input_data['chrom']
+            pos = input_data['pos']
+            if chrom is None or pos is None:
+                self._annotate_row(lnum, line, input_data, secondary_data)
+                continue
+            if chrom != cur_chrom:
+                if chrom in done_chroms:
+                    break
+                done_chroms.add(chrom)
+                cur_chrom = chrom
+                last_pos = None
+                record_groups = itertools.groupby(self.get_sorted_records(chrom),
+                                                  key=lambda record: record[0])
+                group = next(record_groups, None)
+            elif pos < last_pos:
+                break
+            last_pos = pos
+            while group is not None and group[0] < pos:
+                group = next(record_groups, None)
+            if group is not None and group[0] == pos:
+                # Materialize so that input lines at the same position
+                # all see the records.
+                if not isinstance(group[1], list):
+                    group = (group[0], list(group[1]))
+                records = group[1]
+            else:
+                records = []
+            try:
+                self._update_running_status(lnum)
+                if secondary_data == {}:
+                    output_dict = self.annotate_merged(input_data, records)
+                else:
+                    output_dict = self.annotate_merged(input_data, records,
+                                                       secondary_data)
+                self._write_output(input_data, output_dict)
+            except Exception as e:
+                self._log_runtime_exception(lnum, line, input_data, e)
+        else:
+            return
+        self.logger.info('input is not sorted at line {}. Merge join stopped.'.format(lnum))
+        self._annotate_rows(itertools.chain([row], rows))
+
+    # Annotates (lnum, line, input_data, secondary_data) rows and writes
+    # the results. Modules which define annotate_batch get their rows in
+    # chunks of batch_size instead of one annotate call per line.
+    def _annotate_rows(self, rows):
+        if self.pipeline_workers > 0:
+            self._annotate_pipelined(rows)
+        elif self._use_batches():
+            for chunk in self._chunk_rows(rows, self.batch_size):
+                self._annotate_chunk(chunk)
+        else:
+            for lnum, line, input_data, secondary_data in rows:
+                self._annotate_row(lnum, line, input_data, secondary_data)
+
+    def _use_batches(self):
+        return self.batch_size > 1 and hasattr(self, 'annotate_batch')
+
+    def _chunk_rows(self, rows, chunk_size):
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _annotate_row(self, lnum, line, input_data, secondary_data):
+        self._update_running_status(lnum)
+        output_dict, error = self._compute_row(input_data, secondary_data)
+        self._write_result(lnum, line, input_data, output_dict, error)
+
+    # Returns (output_dict, None), or (None, exception) if annotate failed.
+    # The exception is logged when the line's result is written.
+    def _compute_row(self, input_data, secondary_data):
+        try:
+            if secondary_data == {}:
+                return self._annotate_cached(input_data), None
+            else:
+                return self.annotate(input_data, secondary_data), None
+        except Exception as e:
+            return None, e
+
+    def _write_result(self, lnum, line, input_data, output_dict, error):
+        if error is not None:
+            self._log_runtime_exception(lnum, line, input_data, error)
+            return
+        try:
+            self._write_output(input_data, output_dict)
+        except Exception as e:
+            self._log_runtime_exception(lnum, line, input_data, e)
+
+    def _write_results(self, chunk, results):
+        for (lnum, line, input_data, _), (output_dict, error) in zip(chunk, results):
+            self._write_result(lnum, line, input_data, output_dict, error)
+
+    # annotate, through the result cache if the module has one. Lines with
+    # secondary data are not cached, since their results depend on it.
+    def _annotate_cached(self, input_data):
+        if self.result_cache is None:
+            return self.annotate(input_data)
+        key = self.result_cache.get_key(input_data)
+        output_dict = self.result_cache.get(key)
+        if output_dict is ResultCache.missing:
+            output_dict = self._get_persistent([key]).get(key, ResultCache.missing)
+            if output_dict is ResultCache.missing:
+                output_dict = self.annotate(input_data)
+                self._put_persistent({key: output_dict})
+            self.result_cache.put(key, output_dict)
+        return output_dict
+
+    # annotate_batch, through the result cache. Only the lines missing from
+    # the cache, and then from the persistent cache, are passed to
+    # annotate_batch, and lines repeated within the chunk are passed once.
+    def _annotate_batch_cached(self, input_data_list):
+        cache = self.result_cache
+        keys = [cache.get_key(input_data) for input_data in input_data_list]
+        output_dicts = []
+        miss_indexes = {}
+        for idx, key in enumerate(keys):
+            if key in miss_indexes:
+                cache.count_hit()
+                output_dicts.append(ResultCache.missing)
+                continue
+            output_dict = cache.get(key)
+            if output_dict is ResultCache.missing:
+                miss_indexes[key] = idx
+            output_dicts.append(output_dict)
+        if not miss_indexes:
+            return output_dicts
+        miss_results = self._get_persistent(list(miss_indexes))
+        annotate_keys = [key for key in miss_indexes if key not in miss_results]
+        if annotate_keys:
+            annotated_output_dicts = self.annotate_batch(
+                [input_data_list[miss_indexes[key]] for key in annotate_keys])
+            if len(annotated_output_dicts) != len(annotate_keys):
+                raise Exception('annotate_batch returned %d results for %d lines' \
+                    %(len(annotated_output_dicts), len(annotate_keys)))
+            annotated = dict(zip(annotate_keys, annotated_output_dicts))
+            self._put_persistent(annotated)
+            miss_results.update(annotated)
+        for key, output_dict in miss_results.items():
+            cache.put(key, output_dict)
+        for idx, key in enumerate(keys):
+            if output_dicts[idx] is ResultCache.missing:
+                output_dict = miss_results[key]
+                if output_dict is not None and idx != miss_indexes[key]:
+                    output_dict = dict(output_dict)
+                output_dicts[idx] = output_dict
+        return output_dicts
+
+    # Looks keys up in the persistent cache, if there is one, and returns
+    # {key: result} of the ones found. A persistent cache which fails is
+    # left out for the rest of the run, since results can always be
+    # annotated instead.
+    def _get_persistent(self, keys):
+        cache = self.persistent_cache
+        if cache is None or not keys:
+            return {}
+        try:
+            found = cache.get_many(keys)
+        except sqlite3.Error as e:
+            self._disable_persistent_cache(e)
+            return {}
+        self.add_run_count('persistent cache hits', len(found))
+        self.add_run_count('persistent cache misses', len(keys) - len(found))
+        return found
+
+    def _put_persistent(self, results):
+        cache = self.persistent_cache
+        if cache is None:
+            return
+        try:
+            for key, output_dict in results.items():
+                cache.put(key, output_dict)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self._disable_persistent_cache(e)
+
+    def _close_persistent_cache(self, flush_only=False):
+        cache = self.persistent_cache
+        if cache is None:
+            return
+        try:
+            if flush_only:
+                cache.flush()
+            else:
+                cache.close()
+        except sqlite3.Error as e:
+            self._disable_persistent_cache(e)
+
+    def _disable_persistent_cache(self, e):
+        if self.persistent_cache is not None:
+            self.persistent_cache = None
+            self.logger.warning('persistent cache disabled: {}'.format(e))
+
+    def _report_persistent_cache(self):
+        if self.persistent_cache_path is None:
+            return
+        hits = self.run_counts.get('persistent cache hits', 0)
+        misses = self.run_counts.get('persistent cache misses', 0)
+        lookups = hits + misses
+        hit_rate = hits / lookups if lookups else 0.0
+        if self.update_status_json_flag:
+            self.status_writer.queue_status_update(
+                '{}_persistent_cache'.format(self.annotator_name),
+                {'hits': hits, 'misses': misses, 'hit_rate': hit_rate})
+
+    def _log_cache_stats(self, hits, misses):
+        lookups = hits + misses
+        if lookups:
+            hit_rate = 100.0 * hits / lookups
+        else:
+            hit_rate = 0.0
+        self.logger.info('result cache: {} hits, {} misses ({:0.1f}% hits)'\
+            .format(hits, misses, hit_rate))
+
+    # Adds count to the run count name. Modules use run counts for events
+    # worth reporting at the end of the run, such as queries they skipped.
+    # Counts from workers are summed, and logged by _log_run_counts.
+    def add_run_count(self, name, count=1):
+        with self._run_counts_lock:
+            self.run_counts[name] = self.run_counts.get(name, 0) + count
+
+    # add_run_count for counts made on every row. The count goes to a dict
+    # of the calling thread, without the lock, and is added to run_counts
+    # by _collect_row_run_counts when annotation is done.
+    def add_row_run_count(self, name, count=1):
+        counts = getattr(self._row_run_counts, 'counts', None)
+        if counts is None:
+            counts = self._row_run_counts.counts = {}
+            with self._run_counts_lock:
+                self._row_run_count_dicts.append(counts)
+        counts[name] = counts.get(name, 0) + count
+
+    def _reset_row_run_counts(self):
+        self._row_run_counts = threading.local()
+        self._row_run_count_dicts = []
+
+    def _collect_row_run_counts(self):
+        with self._run_counts_lock:
+            for counts in self._row_run_count_dicts:
+                for name, count in counts.items():
+                    self.run_counts[name] = self.run_counts.get(name, 0) + count
+                counts.clear()
+
+    def _add_run_counts(self, run_counts):
+        for name, count in run_counts.items():
+            self.add_run_count(name, count)
+
+    def _log_run_counts(self):
+        self._collect_row_run_counts()
+        for name in sorted(self.run_counts):
+            self.logger.info('{}: {}'.format(name, self.run_counts[name]))
+
+    def _annotate_chunk(self, chunk):
+        self._update_running_status(chunk[-1][0])
+        results = self._compute_chunk([(row[2], row[3]) for row in chunk])
+        self._write_results(chunk, results)
+
+    # Annotates (input_data, secondary_data) pairs with annotate_batch, or
+    # annotate for modules without batches, and returns a
+    # (output_dict, error) result per pair as _compute_row does.
+    def _compute_chunk(self, pairs):
+        if self._use_batches():
+            input_data_list = [pair[0] for pair in pairs]
+            secondary_data_list = [pair[1] for pair in pairs]
+            try:
+                if any(secondary_data_list):
+                    output_dicts = self.annotate_batch(input_data_list,
+                                                       secondary_data_list)
+                elif self.result_cache is not None:
+                    output_dicts = self._annotate_batch_cached(input_data_list)
+                else:
+                    output_dicts = self.annotate_batch(input_data_list)
+                if len(output_dicts) != len(pairs):
+                    raise Exception('annotate_batch returned %d results for %d lines' \
+                        %(len(output_dicts), len(pairs)))
+                return [(output_dict, None) for output_dict in output_dicts]
+            except Exception as e:
+                # Redo the chunk line by line so that errors are logged
+                # against the lines which caused them.
+                self._log_exception(e, halt=False)
+        return [self._compute_row(input_data, secondary_data)
+                for input_data, secondary_data in pairs]
+
+    # Runs _compute_chunk in a pipeline of pipeline_workers workers, with
+    # the input read in another thread and the results written here in
+    # input order. See pipeline.py.
+    def _annotate_pipelined(self, rows):
+        if self._use_batches():
+            chunk_size = self.batch_size
+        else:
+            chunk_size = self.pipeline_chunk_size
+        process_workers = self.pipeline_worker_type == 'process'
+        def items():
+            for chunk in self._chunk_rows(rows, chunk_size):
+                if process_workers and self.fast_rows:
+                    # InputRecord classes are made at run time and cannot
+                    # be pickled.
+                    pairs = [(dict(row[2]), row[3]) for row in chunk]
+                else:
+                    pairs = [(row[2], row[3]) for row in chunk]
+                yield chunk, pairs
+        def write(chunk, result):
+            self._update_running_status(chunk[-1][0])
+            if process_workers:
+                result, cache_counts, run_counts = result
+                if cache_counts is not None:
+                    self.result_cache.add_counts(*cache_counts)
+                self._add_run_counts(run_counts)
+            self._write_results(chunk, result)
+        if process_workers:
+            self._sent_errors = set()
+            func = self._compute_pipeline_chunk
+        else:
+            func = self._compute_chunk
+        pipeline = Pipeline(func,
+                            self.pipeline_workers,
+                            self.pipeline_queue_depth,
+                            worker_type=self.pipeline_worker_type)
+        self.logger.info('pipeline: {} {} workers, queue depth {}'.format(
+            self.pipeline_workers, self.pipeline_worker_type, self.pipeline_queue_depth))
+        pipeline.run(items(), write)
+
+    # _compute_chunk in a process worker. Results are pickled, so errors
+    # are sent as WorkerErrors, with the traceback only the first time this
+    # worker sends each error. The result cache hits and misses and the run
+    # counts of the chunk are sent along.
+    def _compute_pipeline_chunk(self, pairs):
+        cache = self.result_cache
+        if cache is not None:
+            hits, misses = cache.hits, cache.misses
+        run_counts = dict(self.run_counts)
+        results = []
+        for output_dict, error in self._compute_chunk(pairs):
+            if error is not None:
+                error_key = (type(error).__name__, ErrorAggregator.get_location(error))
+                error = WorkerError.from_exception(
+                    error, include_traceback=error_key not in self._sent_errors)
+                self._sent_errors.add(error_key)
+            results.append((output_dict, error))
+        if cache is not None:
+            cache_counts = (cache.hits - hits, cache.misses - misses)
+        else:
+            cache_counts = None
+        # Pool workers are not told when the run ends.
+        self._close_persistent_cache(flush_only=True)
+        self._collect_row_run_counts()
+        run_counts = dict([(name, count - run_counts.get(name, 0))
+                           for name, count in self.run_counts.items()
+                           if count != run_counts.get(name, 0)])
+        return results, cache_counts, run_counts
+
+    def _write_output(self, input_data, output_dict):
+        # This enables summarizing without writing for now.
+        if output_dict == None:
+            return
+        if self.fast_rows:
+            self._write_output_fast(input_data, output_dict)
+            return
+        # Preserves the first column
+        output_dict[self._id_col_name] = input_data[self._id_col_name]
+        # Fill absent columns with empty strings
+        for output_col in self.conf['output_columns']:
+            col_name = output_col['name']
+            if col_name not in output_dict:
+                output_dict[col_name] = ''
+        self.output_writer.write_data(output_dict)
+
+    # fast_rows counterpart of the column filling above. The first line goes
+    # through write_data, which writes the definition and titles. The rest
+    # are written positionally, in output column order: text lines are
+    # formatted as CravatWriter.write_data would and written straight to the
+    # output file.
+    def _write_output_fast(self, input_data, output_dict):
+        if self._fast_output_writer is not self.output_writer:
+            self._fast_output_writer = self.output_writer
+            output_dict[self._id_col_name] = input_data[self._id_col_name]
+            self.output_writer.write_data(output_dict)
+            return
+        get = output_dict.get
+        values = [input_data[self._id_col_name]]
+        values.extend([get(col_name) for col_name in self._output_col_names])
+        self._write_row(values)
+
+    def _write_row(self, values):
+        if self.output_format == 'columnar':
+            self.output_writer.write_row(values)
+        else:
+            self.output_writer.wf.write('\t'.join(['' if value is None else str(value)
+                                                   for value in values]) + '\n')
+
+    def _update_running_status(self, lnum):
+        if self.profiler is not None:
+            self.profiler.tick(lnum)
+        if self.update_status_json_flag:
+            cur_time = time.time()
+            if lnum % 10000 == 0 or cur_time - self.last_status_update_time > 3:
+                self.status_writer.queue_status_update('status', 'Running {} ({}): line {}'.format(self.conf['title'], self.annotator_name, lnum))
+                self.last_status_update_time = cur_time
+
     def postprocess (self):
         pass
 
+    # Per-gene summaries of this module's variant columns, for reports.
+    #
+    # Modules which define gene_summary_fold summarize incrementally:
+    #   gene_summary_init(hugo) returns the starting state of a gene,
+    #   gene_summary_fold(state, d) folds variant d into the state and
+    #   returns the new state, and
+    #   gene_summary_finish(hugo, state) returns the summary of the gene,
+    #   or None to leave it out.
+    # Only the states are held. The finish calls run in summary_workers
+    # forked processes (conf, default cpu count), which get the states in
+    # chunks of gene_summary_chunk_size genes, so states and summaries must
+    # be picklable. Without fork, or with one worker, they run here.
+    #
+    # Otherwise the variant columns of each gene are collected with
+    # build_gene_collection and summarized with summarize_by_gene.
     async def get_gene_summary_data (self, cf):
         cols = [self.annotator_name + '__' + coldef['name'] \
                 for coldef in self.conf['output_columns']]
         cols[0] = 'base__hugo'
+        if hasattr(self, 'gene_summary_fold'):
+            return await self._get_folded_gene_summary_data(cf, cols)
         gene_collection = {}
         async for d in cf.get_variant_iterator_filtered_uids_cols(cols):
             hugo = d['hugo']
@@ -242,26 +1090,78 @@ class BaseAnnotator(object):
             out = self.summarize_by_gene(hugo, gene_collection)
             if out == None:
                 continue
-            row = []
-            for col in cols[1:]:
-                if col in out:
-                    val = out[col]
-                else:
-                    val = None
-                row.append(val)
             data[hugo] = out
         return data
 
+    async def _get_folded_gene_summary_data (self, cf, cols):
+        states = {}
+        async for d in cf.get_variant_iterator_filtered_uids_cols(cols):
+            hugo = d['hugo']
+            if hugo == None:
+                continue
+            if hugo in states:
+                state = states[hugo]
+            else:
+                state = self.gene_summary_init(hugo)
+            states[hugo] = self.gene_summary_fold(state, d)
+        hugos = list(states)
+        max_workers = int(self.conf.get('summary_workers', os.cpu_count() or 1))
+        if max_workers > 1 and len(hugos) > 1 \
+                and 'fork' in multiprocessing.get_all_start_methods():
+            outs = await self._finish_gene_summaries_forked(hugos, states, max_workers)
+        else:
+            outs = [self.gene_summary_finish(hugo, states.pop(hugo)) for hugo in hugos]
+        data = {}
+        for hugo, out in zip(hugos, outs):
+            if out == None:
+                continue
+            data[hugo] = out
+        return data
+
+    async def _finish_gene_summaries_forked (self, hugos, states, max_workers):
+        global _summary_annotator
+        _summary_annotator = self
+        loop = asyncio.get_event_loop()
+        chunk_size = self.gene_summary_chunk_size
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                    mp_context=multiprocessing.get_context('fork')) as executor:
+                futures = []
+                for start in range(0, len(hugos), chunk_size):
+                    items = [(hugo, states.pop(hugo))
+                             for hugo in hugos[start:start + chunk_size]]
+                    futures.append(loop.run_in_executor(executor,
+                                                        _finish_gene_summaries,
+                                                        items))
+                chunk_outs = await asyncio.gather(*futures)
+        finally:
+            _summary_annotator = None
+        return list(itertools.chain.from_iterable(chunk_outs))
+
+    # Counts the error in self.error_aggregator. The traceback of the first
+    # line with each distinct error goes to the log, and the first
+    # max_error_samples lines with it to the .err file, or to
+    # self._shard_error_records in a --workers shard.
     def _log_runtime_exception (self, lnum, line, input_data, e):
         try:
-            err_str = traceback.format_exc().rstrip()
-            if err_str not in self.unique_excs:
-                self.unique_excs.append(err_str)
-                self.logger.error(err_str)
-            self.error_logger.error('\n[{:d}]{}\n({})\n#'.format(lnum, line[:-1], str(e)))
+            error, is_new, is_sample = self.error_aggregator.add(e, lnum=lnum)
+            if is_new:
+                self.logger.error(error['traceback'])
+            if is_sample:
+                record = '\n[{:d}]{}\n({})\n#'.format(lnum, line.rstrip('\r\n'), str(e))
+                if self._shard_error_records is not None:
+                    self._shard_error_records[lnum] = record
+                else:
+                    self.error_logger.error(record)
         except Exception as e:
             self._log_exception(e, halt=False)
 
+    def _log_error_summary (self):
+        if self.error_aggregator.num_lines == 0:
+            return
+        for summary_line in self.error_aggregator.get_summary_lines():
+            self.logger.error(summary_line)
+
     # Setup function for the base_annotator, different from self.setup() 
     # which is intended to be for the derived annotator.
     def base_setup(self):
@@ -270,7 +1170,12 @@ class BaseAnnotator(object):
             self._setup_secondary_inputs()
             self._setup_outputs()
             self._open_db_connection()
+            self._preload_tables()
+            self._setup_result_cache()
             self.setup()
+            if self.profiler is not None:
+                self._instrument()
+                self._instrument_methods()
         except Exception as e:
             self._log_exception(e)
 
@@ -301,6 +1206,8 @@ class BaseAnnotator(object):
                         self.primary_input_reader.override_column(col_index,
                                                                   col_name,
                                                                   data_type=data_type)
+            if self.fast_rows:
+                self._setup_fast_rows()
         except Exception as e:
             self._log_exception(e)
 
@@ -323,9 +1230,13 @@ class BaseAnnotator(object):
                                                        ['match_columns']\
                                                        ['secondary']
                 use_columns = self.conf['secondary_inputs'][sec_name]['use_columns']
+                fetch_mode = self.conf['secondary_inputs'][sec_name]\
+                                                          .get('fetch_mode', 'memory')
                 fetcher = SecondaryInputFetcher(sec_input_path,
                                                 key_col,
-                                                fetch_cols=use_columns)
+                                                fetch_cols=use_columns,
+                                                mode=fetch_mode,
+                                                index_dir=self.output_dir)
                 self.secondary_readers[sec_name] = fetcher
         except Exception as e:
             self._log_exception(e)
@@ -354,13 +1265,20 @@ class BaseAnnotator(object):
                 '.'.join([self.output_basename, 
                 self.annotator_name,
                 'err']))
-            if self.plain_output:
+            # Columnar files always have their definition.
+            plain_output = self.plain_output and self.output_format == 'text'
+            if self.output_format == 'columnar':
+                self.output_path += '.col'
+            if plain_output:
                 self.output_writer = CravatWriter(self.output_path, 
                                                   include_definition = False,
                                                   include_titles = True,
                                                   titles_prefix = '')
             else:
-                self.output_writer = CravatWriter(self.output_path)
+                if self.output_format == 'columnar':
+                    self.output_writer = self._make_columnar_writer(self.output_path)
+                else:
+                    self.output_writer = CravatWriter(self.output_path)
                 self.output_writer.write_meta_line('name',
                                                    self.annotator_name)
                 self.output_writer.write_meta_line('displayname',
@@ -370,26 +1288,222 @@ class BaseAnnotator(object):
                 self.output_writer.add_column(col_index, col_def)
                 if not(col_def.get('aggregate', True)):
                     skip_aggregation.append(col_def['name'])
-            if not(self.plain_output):
+            if not(plain_output):
                 self.output_writer.write_definition(self.conf)
                 self.output_writer.write_meta_line('no_aggregate',
                                                    ','.join(skip_aggregation))
         except Exception as e:
                 self._log_exception(e)
 
+    # Block size and compression can be set with columnar_block_rows and
+    # columnar_compression (zlib or none) in the conf.
+    def _make_columnar_writer(self, path, include_definition=True):
+        compression = self.conf.get('columnar_compression', 'zlib')
+        if compression == 'none':
+            compression = None
+        return ColumnarWriter(path,
+                              include_definition=include_definition,
+                              block_rows=int(self.conf.get('columnar_block_rows', 65536)),
+                              compression=compression)
+
+    # Opens the first of data/<annotator>.sqlite and
+    # /ext/resource/newarch/<annotator>.sqlite which exists, through a
+    # ConnectionPool which gives each thread its own connection. The db
+    # section of the module conf sets how:
+    #
+    #   db:
+    #     read_only: true       # mode=ro URI
+    #     immutable: false      # immutable=1 URI, for files which never change
+    #     mmap_size: 268435456  # bytes of the file read through mmap
+    #     cache_size: -65536    # pages, or KiB if negative
+    #     query_only: false     # also rejects temp tables, so off by default
+    #     cached_statements: 256
     def _open_db_connection (self):
         db_dirs = [self.data_dir,
                    os.path.join('/ext', 'resource', 'newarch')]
-        db_path = None
+        self.db_pool = None
         for db_dir in db_dirs:
             db_path = os.path.join(db_dir, self.annotator_name + '.sqlite')
             if os.path.exists(db_path):
-                self.dbconn = sqlite3.connect(db_path)
-                self.cursor = self.dbconn.cursor()
+                db_conf = self.conf.get('db', {})
+                pragmas = [('mmap_size', int(db_conf.get('mmap_size', 268435456)))]
+                if 'cache_size' in db_conf:
+                    pragmas.append(('cache_size', int(db_conf['cache_size'])))
+                if db_conf.get('query_only', False):
+                    pragmas.append(('query_only', 'ON'))
+                self.db_pool = ConnectionPool(db_path,
+                    read_only=db_conf.get('read_only', True),
+                    immutable=db_conf.get('immutable', False),
+                    pragmas=pragmas,
+                    cached_statements=int(db_conf.get('cached_statements', 256)))
+                break
+
+    # Loads the tables listed under preload_tables in the module conf into
+    # self.preloaded, so that annotate can use them without queries:
+    #
+    #   preload_tables:
+    #     nucleotide_names:
+    #       key: abbreviation
+    #       columns: [full_name]
+    #
+    # self.preloaded['nucleotide_names'] maps each abbreviation to the
+    # tuple of its columns, as fetchone would return them. The first row of
+    # a repeated key is kept.
+    def _preload_tables (self):
+        self.preloaded = {}
+        preload_conf = self.conf.get('preload_tables') or {}
+        if preload_conf and self.dbconn is None:
+            err_msg = 'preload_tables %s need data/%s.sqlite, which was not found' \
+                %(', '.join(preload_conf), self.annotator_name)
+            raise ConfigurationError(err_msg)
+        for table, table_def in preload_conf.items():
+            if 'key' not in table_def or not table_def.get('columns'):
+                err_msg = 'preload_tables %s needs a key and columns' %table
+                raise ConfigurationError(err_msg)
+            # Checked here, as sqlite takes a quoted name which is not a
+            # column for a string.
+            table_columns = [row[1] for row in
+                             self.dbconn.execute('PRAGMA table_info("{}");'.format(table))]
+            if not table_columns:
+                err_msg = 'Preload table %s not in data/%s.sqlite' \
+                    %(table, self.annotator_name)
+                raise ConfigurationError(err_msg)
+            missing_columns = [col for col in [table_def['key']] + list(table_def['columns'])
+                               if col not in table_columns]
+            if missing_columns:
+                err_msg = 'Columns of preload table %s not found: %s' \
+                    %(table, ', '.join(missing_columns))
+                raise ConfigurationError(err_msg)
+            columns = ', '.join(['"{}"'.format(col) for col in table_def['columns']])
+            sql_q = 'SELECT "{}", {} FROM "{}";'.format(table_def['key'], columns, table)
+            rows = {}
+            for row in self.dbconn.execute(sql_q):
+                if row[0] not in rows:
+                    rows[row[0]] = row[1:]
+            self.preloaded[table] = rows
+            self.logger.info('preloaded {} rows of {}'.format(len(rows), table))
+
+    # Sets up the result cache if the module conf has one:
+    #
+    #   cache:
+    #     size: 100000
+    #     key_columns: [chrom, pos, ref_base, alt_base]
+    #
+    # key_columns default to the input columns other than uid.
+    #
+    # With persistent, results are also kept on disk for later jobs (see
+    # PersistentCache):
+    #
+    #     persistent:
+    #       path: ~/.cache/cravat/annotation_cache.sqlite
+    #       max_size_mb: 1024
+    def _setup_result_cache (self):
+        self.result_cache = None
+        self.persistent_cache = None
+        self.persistent_cache_path = None
+        cache_conf = self.conf.get('cache')
+        if not cache_conf:
+            return
+        if cache_conf is True:
+            cache_conf = {}
+        key_columns = cache_conf.get('key_columns',
+            [col_name for col_name in self.conf['input_columns']
+             if col_name != crv_def[0]['name']])
+        missing_columns = set(key_columns) - set(self.conf['input_columns'])
+        if missing_columns:
+            err_msg = 'Cache key columns not in input_columns: %s' \
+                %', '.join(missing_columns)
+            raise ConfigurationError(err_msg)
+        self.result_cache = ResultCache(int(cache_conf.get('size', 100000)),
+                                        key_columns)
+        persistent_conf = cache_conf.get('persistent')
+        if not persistent_conf:
+            return
+        if persistent_conf is True:
+            persistent_conf = {}
+        path = os.path.expanduser(persistent_conf.get('path',
+            self.default_persistent_cache_path))
+        max_size_mb = float(persistent_conf.get('max_size_mb', 1024))
+        if max_size_mb <= 0:
+            raise ConfigurationError('Persistent cache max_size_mb must be positive')
+        module_conf = dict([(k, v) for k, v in self.conf.items()
+                            if k not in self.cache_neutral_conf_keys])
+        namespace = PersistentCache.make_namespace(self.annotator_name,
+            self.conf.get('version'), key_columns, module_conf,
+            self._get_data_fingerprint())
+        try:
+            self.persistent_cache = PersistentCache(path, namespace,
+                                                    int(max_size_mb * 1024 * 1024))
+        except (sqlite3.Error, OSError) as e:
+            self.logger.warning('persistent cache disabled: {}'.format(e))
+            return
+        self.persistent_cache_path = path
+        self.logger.info('persistent cache: {}'.format(path))
+
+    # Paths, sizes and modification times of the annotator's data files
+    # and database, so that a rebuilt database gets new persistent cache
+    # entries.
+    def _get_data_fingerprint (self):
+        paths = set()
+        for dir_path, _, file_names in os.walk(self.data_dir):
+            for file_name in file_names:
+                if not file_name.endswith(('-wal', '-shm', '-journal', '.tmp')):
+                    paths.add(os.path.abspath(os.path.join(dir_path, file_name)))
+        if self.db_pool is not None:
+            paths.add(os.path.abspath(self.db_pool.db_path))
+        fingerprint = []
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            fingerprint.append([path, stat.st_size, stat.st_mtime_ns])
+        return fingerprint
+
+    # Wraps the input reader, output writer and database connection of the
+    # run with self.profiler (--profile). Also used in forked workers, which
+    # have their own. Done after setup, so that setup sees the plain
+    # sqlite3 connection and cursor.
+    def _instrument (self):
+        profiler = self.profiler
+        if self.fast_rows:
+            self.primary_input_reader._loop_data = profiler.wrap_iter('read',
+                self.primary_input_reader._loop_data)
+        else:
+            self.primary_input_reader.loop_data = profiler.wrap_iter('read',
+                self.primary_input_reader.loop_data)
+        self.output_writer.write_data = profiler.wrap('write',
+            self.output_writer.write_data)
+        if self.db_pool is not None:
+            self.db_pool.wrap(lambda target: ProfilingCursor(target, profiler))
+        elif self.dbconn is not None:
+            self.dbconn = ProfilingCursor(self.dbconn, profiler)
+            self.cursor = ProfilingCursor(self.cursor, profiler)
+
+    def _instrument_methods (self):
+        self._get_input = self.profiler.wrap_iter('input', self._get_input)
+        self._write_row = self.profiler.wrap('write', self._write_row)
+        for method_name in ('annotate', 'annotate_batch', 'annotate_merged'):
+            if hasattr(self, method_name):
+                setattr(self, method_name,
+                        self.profiler.wrap('annotate', getattr(self, method_name)))
+
+    def _write_profile (self):
+        profile_path = os.path.join(self.output_dir,
+            '.'.join([self.output_basename, self.annotator_name, 'profile.json']))
+        self.profiler.write(profile_path)
+        self.logger.info('profile written to {}'.format(profile_path))
+        if self.update_status_json_flag:
+            self.status_writer.queue_status_update(
+                '{}_profile'.format(self.annotator_name),
+                self.profiler.get_summary())
 
     def close_db_connection (self):
-        self.cursor.close()
-        self.dbconn.close()
+        if self.db_pool is not None:
+            self.db_pool.close()
+        else:
+            self.cursor.close()
+            self.dbconn.close()
 
     def remove_log (self):
         pass
@@ -401,12 +1515,24 @@ class BaseAnnotator(object):
     def setup(self):
         pass
 
+    # Placeholder for modules with region queries (--regions), intended to
+    # be overridden in derived class. regions is a list of (chrom, start,
+    # end) tuples in BED coordinates (see regions.py). Yields (chrom, pos,
+    # ref_base, alt_base, output_dict) for each of the module's records
+    # in the regions, output_dict having the module's output columns.
+    def query_regions(self, regions):
+        raise ConfigurationError('%s does not support region queries' \
+            %self.annotator_name)
+
     def base_cleanup(self):
         try:
             self.output_writer.close()
             #self.invalid_file.close()
             if self.dbconn != None:
                 self.close_db_connection()
+            for fetcher in self.secondary_readers.values():
+                fetcher.close()
+            self._close_persistent_cache()
             self.cleanup()
         except Exception as e:
             self._log_exception(e)
@@ -438,42 +1564,164 @@ class BaseAnnotator(object):
             self.error_logger.addHandler(error_log_handler)
         except Exception as e:
             self._log_exception(e)
-        self.unique_excs = []
 
     # Gets the input dict from both the input file, and 
     # any depended annotators depended annotator feature not complete.
     def _get_input(self):
+        if self.fast_rows:
+            yield from self._get_fast_input()
+            return
         for lnum, line, reader_data in self.primary_input_reader.loop_data():
             try:
-                input_data = {}
-                for col_name in self.conf['input_columns']:
-                    input_data[col_name] = reader_data[col_name]
-                if all_mappings_col_name in input_data:
-                    input_data[mapping_parser_name] = \
-                        AllMappingsParser(input_data[all_mappings_col_name])
-                secondary_data = {}
-                for annotator_name, fetcher in self.secondary_readers.items():
-                    input_key_col = self.conf['secondary_inputs']\
-                                              [annotator_name]\
-                                               ['match_columns']\
-                                                ['primary']
-                    input_key_data = input_data[input_key_col]
-                    secondary_data[annotator_name] = fetcher.get(input_key_data)
+                input_data, secondary_data = self._make_input(reader_data)
                 yield lnum, line, input_data, secondary_data
             except Exception as e:
-                self._log_runtime_error(lnum, e)
+                self._log_runtime_exception(lnum, line, {}, e)
                 continue
 
+    # Returns (input_data, secondary_data) of an input line read by
+    # CravatReader.loop_data, with input_data an InputRecord in fast_rows
+    # mode. fused_runner.py reads each line once for several annotators
+    # and has each of them make its own input with this.
+    def _make_input(self, reader_data):
+        input_columns = self.conf['input_columns']
+        if self.fast_rows:
+            values = [reader_data[col_name] for col_name in input_columns]
+            if all_mappings_col_name in input_columns:
+                values.append(AllMappingsParser(reader_data[all_mappings_col_name]))
+            input_data = self._input_record_class(values)
+        else:
+            input_data = {}
+            for col_name in input_columns:
+                input_data[col_name] = reader_data[col_name]
+            if all_mappings_col_name in input_data:
+                input_data[mapping_parser_name] = AllMappingsParser(input_data[all_mappings_col_name])
+        secondary_data = {}
+        for annotator_name, fetcher in self.secondary_readers.items():
+            input_key_col = self.conf['secondary_inputs']\
+                                      [annotator_name]\
+                                       ['match_columns']\
+                                        ['primary']
+            input_key_data = input_data[input_key_col]
+            secondary_data[annotator_name] = fetcher.get(input_key_data)
+        return input_data, secondary_data
+
+    # fast_rows counterpart of _get_input. Lines are split and converted
+    # with the precompiled column indexes and types of the input columns,
+    # and each becomes an InputRecord instead of a reader dict plus an
+    # input_data dict.
+    def _get_fast_input(self):
+        record_class = self._input_record_class
+        converters = self._input_converters
+        num_columns = len(self.primary_input_reader.columns)
+        has_mappings = mapping_parser_name in record_class._col_indexes
+        mappings_index = record_class._col_indexes.get(all_mappings_col_name)
+        no_secondary_data = {}
+        for lnum, line in self.primary_input_reader._loop_data():
+            try:
+                toks = line.split('\t')
+                if len(toks) < num_columns:
+                    raise BadFormatError('Too few columns. Received %s. Expected %s. data was [%s]' \
+                        %(len(toks), num_columns, line))
+                values = [None if toks[tok_index] == '' \
+                          else (toks[tok_index] if convert is None else convert(toks[tok_index]))
+                          for tok_index, convert in converters]
+                if has_mappings:
+                    values.append(AllMappingsParser(values[mappings_index]))
+                input_data = record_class(values)
+                if self.secondary_readers:
+                    secondary_data = {}
+                    for annotator_name, fetcher in self.secondary_readers.items():
+                        input_key_col = self.conf['secondary_inputs']\
+                                                  [annotator_name]\
+                                                   ['match_columns']\
+                                                    ['primary']
+                        secondary_data[annotator_name] = fetcher.get(input_data[input_key_col])
+                else:
+                    secondary_data = no_secondary_data
+                yield lnum, line, input_data, secondary_data
+            except Exception as e:
+                self._log_runtime_exception(lnum, line, {}, e)
+                continue
+
+    # Precompiles the input parsing and output formatting of fast_rows.
+    def _setup_fast_rows(self):
+        col_indexes = {}
+        col_types = {}
+        for col_index, col_def in self.primary_input_reader.columns.items():
+            col_indexes[col_def['name']] = col_index
+            col_types[col_def['name']] = col_def['type']
+        type_converters = {'string': None, 'int': int, 'float': float}
+        self._input_converters = [(col_indexes[col_name], type_converters[col_types[col_name]])
+                                  for col_name in self.conf['input_columns']]
+        record_col_names = list(self.conf['input_columns'])
+        if all_mappings_col_name in record_col_names:
+            record_col_names.append(mapping_parser_name)
+        self._input_record_class = InputRecord.for_columns(record_col_names)
+        self._output_col_names = tuple([col_def['name']
+                                        for col_def in self.conf['output_columns'][1:]])
+        self._fast_output_writer = None
+
     def annotate (self, input_data):
         sys.stdout.write('        annotate method should be implemented. ' +\
                 'Exiting ' + self.annotator_display_name + '...\n')
         exit(-1)
 
+# Input line of the fast_rows mode. It is a tuple of the input column values,
+# which can also be read by column name like the input_data dict of the
+# default mode: input_data['pos'], input_data.get('hugo'), 'pos' in
+# input_data and dict(input_data) all work. Records cannot be modified.
+class InputRecord(tuple):
+    __slots__ = ()
+    _col_indexes = {}
+
+    @classmethod
+    def for_columns(cls, col_names):
+        col_indexes = {col_name: i for i, col_name in enumerate(col_names)}
+        return type('InputRecord', (cls,), {'__slots__': (), '_col_indexes': col_indexes})
+
+    def __getitem__(self, key):
+        if key.__class__ is str:
+            return tuple.__getitem__(self, self._col_indexes[key])
+        return tuple.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return key in self._col_indexes
+
+    def get(self, key, default=None):
+        try:
+            return tuple.__getitem__(self, self._col_indexes[key])
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._col_indexes.keys()
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return zip(self._col_indexes, self)
+
+# Fetches the rows of a secondary input by key column value.
+#
+# mode is how the rows are held:
+#   memory  the whole input is loaded into a dict.
+#   disk    the rows are written to a temporary sqlite index in index_dir
+#           and fetched from it by key.
+#   stream  the input is read along with the primary input, for when both
+#           are sorted by the key. Only the rows of the current key are
+#           held. If keys are requested or found out of order, the fetcher
+#           switches to disk mode.
 class SecondaryInputFetcher():
+    valid_modes = ['memory', 'disk', 'stream']
+
     def __init__(self,
                  input_path,
                  key_col,
-                 fetch_cols=[]):
+                 fetch_cols=[],
+                 mode='memory',
+                 index_dir=None):
         self.key_col = key_col
         self.input_path = input_path
         self.input_reader = CravatReader(self.input_path)
@@ -491,8 +1739,25 @@ class SecondaryInputFetcher():
             self.fetch_cols = fetch_cols
         else:
             self.fetch_cols = valid_cols
+        if mode not in self.valid_modes:
+            err_msg = 'Invalid fetch_mode %s, select from %s' \
+                %(mode, ', '.join(self.valid_modes))
+            raise ConfigurationError(err_msg)
+        self.mode = mode
+        self.index_dir = index_dir
+        self.index_path = None
+        self.index_conn = None
+        # Connections inherited from the parent process, kept referenced so
+        # that they are not closed in the child.
+        self._parent_conns = []
+        self.owns_index = False
         self.data = {}
-        self.load_input()
+        if self.mode == 'memory':
+            self.load_input()
+        elif self.mode == 'disk':
+            self.index_input()
+        elif self.mode == 'stream':
+            self.start_stream()
 
     def load_input(self):
         for _, line, all_col_data in self.input_reader.loop_data():
@@ -503,12 +1768,97 @@ class SecondaryInputFetcher():
                 fetch_col_data[col] = all_col_data[col]
             self.data[key_data].append(fetch_col_data)
 
+    def index_input(self):
+        fd, self.index_path = tempfile.mkstemp(prefix='.secondary.',
+                                               suffix='.sqlite',
+                                               dir=self.index_dir)
+        os.close(fd)
+        self.owns_index = True
+        self.index_conn = sqlite3.connect(self.index_path, isolation_level=None)
+        self.index_conn.execute('PRAGMA journal_mode=OFF;')
+        self.index_conn.execute('PRAGMA synchronous=OFF;')
+        self.index_conn.execute('BEGIN;')
+        self.index_conn.execute('CREATE TABLE secondary (key, data TEXT);')
+        self.index_conn.executemany('INSERT INTO secondary VALUES (?, ?);',
+            ((all_col_data[self.key_col],
+              json.dumps([all_col_data[col] for col in self.fetch_cols]))
+             for _, _, all_col_data in self.input_reader.loop_data()))
+        self.index_conn.execute('CREATE INDEX secondary_key ON secondary (key);')
+        self.index_conn.execute('COMMIT;')
+
+    def start_stream(self):
+        self.stream = self._loop_key_groups()
+        self.stream_group = next(self.stream, None)
+        self.last_key = None
+
+    # Yields (key, rows) for each run of rows with the same key.
+    def _loop_key_groups(self):
+        key_data = None
+        rows = []
+        for _, line, all_col_data in self.input_reader.loop_data():
+            if rows and all_col_data[self.key_col] != key_data:
+                yield key_data, rows
+                rows = []
+            key_data = all_col_data[self.key_col]
+            rows.append(dict([(col, all_col_data[col]) for col in self.fetch_cols]))
+        if rows:
+            yield key_data, rows
+
+    def _get_streamed(self, key_data):
+        try:
+            if self.last_key is not None and key_data < self.last_key:
+                raise ValueError('primary input out of order')
+            self.last_key = key_data
+            while self.stream_group is not None and self.stream_group[0] < key_data:
+                prev_key = self.stream_group[0]
+                self.stream_group = next(self.stream, None)
+                if self.stream_group is not None and self.stream_group[0] < prev_key:
+                    raise ValueError('secondary input out of order')
+        except (TypeError, ValueError):
+            self.mode = 'disk'
+            self.index_input()
+            return self.get(key_data)
+        if self.stream_group is not None and self.stream_group[0] == key_data:
+            return self.stream_group[1]
+        else:
+            return []
+
+    # Needed after a fork, as the sqlite connection and input file handle
+    # of the parent process must not be shared.
+    def reopen(self):
+        if self.mode == 'disk':
+            if self.index_conn is not None:
+                self._parent_conns.append(self.index_conn)
+            self.index_conn = sqlite3.connect(self.index_path)
+            self.owns_index = False
+        elif self.mode == 'stream':
+            self.start_stream()
+
+    def close(self):
+        if self.index_conn is not None:
+            self.index_conn.close()
+            self.index_conn = None
+        if self.owns_index and os.path.exists(self.index_path):
+            os.remove(self.index_path)
+
     def get(self, key_data):
+        if self.mode == 'disk':
+            return [dict(zip(self.fetch_cols, json.loads(data))) for data, in
+                    self.index_conn.execute('SELECT data FROM secondary WHERE key=? ORDER BY rowid;',
+                                            (key_data,))]
+        elif self.mode == 'stream':
+            return self._get_streamed(key_data)
         if key_data in self.data:
             return self.data[key_data]
         else:
             return []
 
     def get_values (self, key_data, key_column):
-        ret = [v[key_column] for v in self.data[key_data]]
+        if self.mode == 'memory':
+            rows = self.data[key_data]
+        else:
+            rows = self.get(key_data)
+            if not rows:
+                raise KeyError(key_data)
+        ret = [v[key_column] for v in rows]
         return ret
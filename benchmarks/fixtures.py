@@ -0,0 +1,164 @@
+"""
+Synthetic inputs and fixture databases for the annotator benchmarks.
+
+Database variants are at even positions and missing input variants at odd
+positions, so the hit rate of an input is exactly the one asked for.
+Everything is generated from a seed and is the same from run to run.
+"""
+import json
+import random
+import sqlite3
+from cravat.inout import CravatWriter
+from cravat.constants import crv_def
+from cravat.constants import crx_def
+from cravat.constants import crg_def
+from cravat.popfreq_db import frequency_dbs
+from cravat.popfreq_db import write_frequency_db
+
+chroms = ['chr' + str(i) for i in range(1, 23)] + ['chrX', 'chrY']
+chrom_order = {chrom: i for i, chrom in enumerate(chroms)}
+bases = 'ACGT'
+nucleotide_names = [('A', 'Adenine'),
+                    ('C', 'Cytosine'),
+                    ('G', 'Guanine'),
+                    ('T', 'Thymine')]
+sort_orders = ['sorted', 'random']
+
+def _random_variant(rnd, parity):
+    chrom = rnd.choice(chroms)
+    pos = rnd.randrange(1, 50000000) * 2 + parity
+    ref = rnd.choice(bases)
+    alt = rnd.choice(bases.replace(ref, ''))
+    return chrom, pos, ref, alt
+
+def _sort_key(variant):
+    return chrom_order[variant[0]], variant[1]
+
+def make_db_variants(num_variants, seed=0):
+    """
+    Returns num_variants distinct (chrom, pos, ref, alt), sorted, all at
+    even positions.
+    """
+    rnd = random.Random(seed)
+    variants = set()
+    while len(variants) < num_variants:
+        variants.add(_random_variant(rnd, 0))
+    return sorted(variants, key=_sort_key)
+
+def make_input_variants(db_variants, num_variants, hit_rate=0.5,
+                        sort_order='random', seed=1):
+    """
+    Returns num_variants input variants. A fraction hit_rate of them are
+    drawn from db_variants (with repeats, as in multi-sample inputs), and
+    the rest are at odd positions, so never in the database.
+    """
+    if sort_order not in sort_orders:
+        raise ValueError('sort_order must be one of %s' %', '.join(sort_orders))
+    rnd = random.Random(seed)
+    num_hits = int(round(num_variants * hit_rate))
+    variants = [rnd.choice(db_variants) for _ in range(num_hits)]
+    variants.extend(_random_variant(rnd, 1) for _ in range(num_variants - num_hits))
+    if sort_order == 'sorted':
+        variants.sort(key=_sort_key)
+    else:
+        rnd.shuffle(variants)
+    return variants
+
+def make_genes(num_genes):
+    return ['GENE{}'.format(i) for i in range(1, num_genes + 1)]
+
+def _write_input(path, col_defs, rows):
+    writer = CravatWriter(path)
+    for col_index, col_def in enumerate(col_defs):
+        writer.add_column(col_index, col_def)
+    writer.write_definition()
+    for row in rows:
+        writer.write_data(row)
+    writer.close()
+
+def write_crv(path, variants):
+    _write_input(path, crv_def,
+                 ({'uid': uid, 'chrom': chrom, 'pos': pos, 'ref_base': ref,
+                   'alt_base': alt}
+                  for uid, (chrom, pos, ref, alt) in enumerate(variants, 1)))
+
+def write_crx(path, variants, genes, seed=2):
+    """
+    crx input, with each variant in one of genes.
+    """
+    rnd = random.Random(seed)
+    def rows():
+        for uid, (chrom, pos, ref, alt) in enumerate(variants, 1):
+            gene_index = rnd.randrange(len(genes))
+            hugo = genes[gene_index]
+            transcript = 'ENST{:011d}'.format(gene_index + 1)
+            all_mappings = {hugo: [['', '', 'MIS', transcript, '']]}
+            yield {'uid': uid, 'chrom': chrom, 'pos': pos, 'ref_base': ref,
+                   'alt_base': alt, 'hugo': hugo, 'transcript': transcript,
+                   'so': 'MIS', 'all_mappings': json.dumps(all_mappings)}
+    _write_input(path, crx_def, rows())
+
+def write_crg(path, genes, seed=3):
+    rnd = random.Random(seed)
+    _write_input(path, crg_def,
+                 ({'hugo': hugo, 'num_variants': rnd.randrange(1, 20),
+                   'so': 'MIS'}
+                  for hugo in genes))
+
+def write_abraom_db(path, variants, seed=4):
+    """
+    ABRaOM database, with the same records in the table of each assembly,
+    so that abraom runs whatever its assembly conf.
+    """
+    rnd = random.Random(seed)
+    db_def = frequency_dbs['abraom']
+    records = [variant + (round(rnd.random(), 6),) for variant in variants]
+    for i, table in enumerate(sorted(set(db_def['assembly_tables'].values()))):
+        num_rows = write_frequency_db(path, table, db_def['freq_columns'],
+                                      records, replace=(i == 0))
+    return num_rows
+
+def write_hgdp_db(path, variants, seed=5):
+    rnd = random.Random(seed)
+    db_def = frequency_dbs['hgdp']
+    records = (variant + tuple(round(rnd.random(), 6)
+                               for _ in db_def['freq_columns'])
+               for variant in variants)
+    return write_frequency_db(path, db_def['table'], db_def['freq_columns'],
+                              records)
+
+def write_rnaseq_db(path, genes, hit_rate=0.5, seed=6):
+    """
+    RNAseq database. A fraction hit_rate of genes have a length in
+    someTable.
+    """
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE nucleotide_names (abbreviation TEXT, full_name TEXT);')
+    conn.executemany('INSERT INTO nucleotide_names VALUES (?, ?);',
+                     nucleotide_names)
+    conn.execute('CREATE TABLE someTable (hugo TEXT, someVariable INT);')
+    conn.executemany('INSERT INTO someTable VALUES (?, ?);',
+                     ((hugo, rnd.randrange(1000, 2000000))
+                      for hugo in genes[:int(round(len(genes) * hit_rate))]))
+    conn.execute('CREATE INDEX someTable_hugo ON someTable (hugo);')
+    conn.commit()
+    conn.close()
+
+def write_genelists_db(path, genes, list_names, hit_rate=0.5, seed=7):
+    """
+    Gene list index, as built by build_genelists.py. A fraction hit_rate of
+    genes are in one or more of list_names.
+    """
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE lists (bit INTEGER PRIMARY KEY, name TEXT, title TEXT, source TEXT, num_genes INT);')
+    conn.executemany('INSERT INTO lists VALUES (?, ?, ?, ?, ?);',
+                     ((bit, name, name, name, None)
+                      for bit, name in enumerate(list_names)))
+    conn.execute('CREATE TABLE gene_lists (hugo TEXT PRIMARY KEY, mask INT) WITHOUT ROWID;')
+    conn.executemany('INSERT INTO gene_lists VALUES (?, ?);',
+                     ((hugo, rnd.randrange(1, 1 << len(list_names)))
+                      for hugo in genes[:int(round(len(genes) * hit_rate))]))
+    conn.commit()
+    conn.close()
@@ -0,0 +1,251 @@
+"""
+Benchmarks the abraom, hgdp, RNAseq and genelists annotators end to end.
+
+For each module, a copy of the module with a fixture database and a
+synthetic input are made in a work directory. The annotator is then run
+through BaseAnnotator.run, in a fresh process per run, with a stub status
+writer and module confs read from the module copies. No Open-CRAVAT job or
+installed modules are needed, only the cravat package with this
+repository's base_annotator.py and popfreq_db.py.
+
+    python benchmarks/run_benchmarks.py --variants 100000 --hit-rate 0.2 \\
+        --order sorted --repeat 3 -o results.json -- --sorted
+
+Arguments after -- are passed to the annotators. The results are a JSON
+list with one entry per module and run:
+    variants_per_sec           input lines per second
+    latency_p50, latency_p99   seconds between consecutive output lines,
+                               which is the per line cost of annotate
+                               (and of its chunk, in batch mode). None
+                               with --workers, where the lines are written
+                               by the workers.
+    peak_rss_kb
+"""
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+import yaml
+import fixtures
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Input format and job conf of each module. RNAseq reads hugo, pos and
+# ref_base, which are all in crx files, so it is run on crx.
+module_defs = {
+    'abraom': {'input_format': 'crv', 'conf': {}},
+    'hgdp': {'input_format': 'crv', 'conf': {}},
+    'RNAseq': {'input_format': 'crx', 'conf': {'input_format': 'crx'}},
+    'genelists': {'input_format': 'crg', 'conf': {}},
+}
+
+class StubStatusWriter(object):
+
+    def __init__(self):
+        self.status = {}
+
+    def queue_status_update(self, k, v):
+        self.status[k] = v
+
+    def add_annotator_version_to_status_json(self, annotator_name, version):
+        self.status.setdefault('annotator_version', {})[annotator_name] = version
+
+# Reads module confs from the yml next to each module, updated with the
+# module's section of the job conf.
+class ModuleConfigLoader(object):
+
+    def __init__(self, job_conf_path=None):
+        self.job_conf = {}
+        if job_conf_path:
+            with open(job_conf_path) as f:
+                self.job_conf = yaml.safe_load(f) or {}
+
+    def get_module_conf(self, module_name):
+        with open(os.path.join(ModuleConfigLoader.module_dir, module_name + '.yml')) as f:
+            conf = yaml.safe_load(f)
+        conf.update(self.job_conf.get(module_name, {}))
+        return conf
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+def get_peak_rss_kb():
+    if resource is None:
+        return None
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return peak_rss
+
+def run_annotator(module_main, input_path, output_dir, job_conf_path, module_args):
+    """
+    Runs one annotator in this process and returns its metrics.
+    """
+    import cravat.base_annotator
+    ModuleConfigLoader.module_dir = os.path.dirname(module_main)
+    cravat.base_annotator.ConfigLoader = ModuleConfigLoader
+    spec = importlib.util.spec_from_file_location('benchmarked_module', module_main)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    cmd_args = [module_main, input_path, '-d', output_dir, '-n', 'bench',
+                '-c', job_conf_path] + module_args
+    annotator = module.CravatAnnotator(cmd_args, StubStatusWriter())
+    output_times = []
+    write_output = annotator._write_output
+    def timed_write_output(input_data, output_dict):
+        output_times.append(time.perf_counter())
+        write_output(input_data, output_dict)
+    annotator._write_output = timed_write_output
+    start_time = time.perf_counter()
+    annotator.run()
+    run_time = time.perf_counter() - start_time
+    latencies = [t2 - t1 for t1, t2 in zip(output_times, output_times[1:])]
+    return {'runtime': run_time,
+            'latency_p50': percentile(latencies, 0.5),
+            'latency_p99': percentile(latencies, 0.99),
+            'peak_rss_kb': get_peak_rss_kb()}
+
+def prepare_module(module_name, work_dir, db_variants, genes, hit_rate):
+    module_dir = os.path.join(work_dir, module_name)
+    shutil.rmtree(module_dir, ignore_errors=True)
+    os.makedirs(os.path.join(module_dir, 'data'))
+    for ext in ('.py', '.yml'):
+        shutil.copy(os.path.join(repo_dir, module_name, module_name + ext), module_dir)
+    db_path = os.path.join(module_dir, 'data', module_name + '.sqlite')
+    if module_name == 'abraom':
+        fixtures.write_abraom_db(db_path, db_variants)
+    elif module_name == 'hgdp':
+        fixtures.write_hgdp_db(db_path, db_variants)
+    elif module_name == 'RNAseq':
+        fixtures.write_rnaseq_db(db_path, genes, hit_rate=hit_rate)
+    elif module_name == 'genelists':
+        with open(os.path.join(module_dir, module_name + '.yml')) as f:
+            module_conf = yaml.safe_load(f)
+        list_names = [col_def['name'] for col_def in module_conf['output_columns']
+                      if col_def['name'] not in ('lists', 'num_lists')]
+        fixtures.write_genelists_db(db_path, genes, list_names, hit_rate=hit_rate)
+    return os.path.join(module_dir, module_name + '.py')
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark annotators on synthetic inputs.')
+    parser.add_argument('--modules', nargs='+', default=sorted(module_defs),
+                        choices=sorted(module_defs))
+    parser.add_argument('--variants', type=int, default=100000,
+                        help='Input lines. Default 100000.')
+    parser.add_argument('--db-variants', dest='db_variants', type=int,
+                        help='Variants in the fixture databases. '\
+                             +'Default same as --variants.')
+    parser.add_argument('--genes', type=int, default=2000,
+                        help='Genes in crx and crg inputs. Default 2000.')
+    parser.add_argument('--hit-rate', dest='hit_rate', type=float, default=0.5,
+                        help='Fraction of input lines found in the databases.')
+    parser.add_argument('--order', choices=fixtures.sort_orders, default='random',
+                        help='Input order. Default random.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Runs per module.')
+    parser.add_argument('--conf', help='Job conf yml with module sections, '\
+                                       +'such as abraom: {preload: true}.')
+    parser.add_argument('--work-dir', dest='work_dir',
+                        help='Keep fixtures and outputs here. '\
+                             +'Default is a temporary directory.')
+    parser.add_argument('-o', dest='output', help='Write results here.')
+    parser.add_argument('--run-one', dest='run_one', nargs=4,
+                        metavar=('MODULE_MAIN', 'INPUT', 'OUTPUT_DIR', 'JOB_CONF'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('module_args', nargs=argparse.REMAINDER,
+                        help='Arguments for the annotators, after --.')
+    args = parser.parse_args()
+    module_args = [arg for arg in args.module_args if arg != '--']
+    if args.run_one:
+        metrics = run_annotator(*args.run_one, module_args)
+        sys.stdout.write(json.dumps(metrics) + '\n')
+        return
+    if args.work_dir:
+        work_dir = args.work_dir
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+    else:
+        work_dir = tempfile.mkdtemp(prefix='cravat_bench.')
+    try:
+        results = run_benchmarks(args, module_args, work_dir)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    report = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as wf:
+            wf.write(report + '\n')
+    print(report)
+
+def run_benchmarks(args, module_args, work_dir):
+    db_variants = fixtures.make_db_variants(args.db_variants or args.variants,
+                                            seed=args.seed)
+    variants = fixtures.make_input_variants(db_variants, args.variants,
+                                            hit_rate=args.hit_rate,
+                                            sort_order=args.order,
+                                            seed=args.seed + 1)
+    genes = fixtures.make_genes(args.genes)
+    input_paths = {'crv': os.path.join(work_dir, 'input.crv'),
+                   'crx': os.path.join(work_dir, 'input.crx'),
+                   'crg': os.path.join(work_dir, 'input.crg')}
+    fixtures.write_crv(input_paths['crv'], variants)
+    fixtures.write_crx(input_paths['crx'], variants, genes, seed=args.seed + 2)
+    fixtures.write_crg(input_paths['crg'], genes, seed=args.seed + 3)
+    job_conf = {}
+    if args.conf:
+        with open(args.conf) as f:
+            job_conf = yaml.safe_load(f) or {}
+    results = []
+    for module_name in args.modules:
+        module_def = module_defs[module_name]
+        module_main = prepare_module(module_name, work_dir, db_variants, genes,
+                                     args.hit_rate)
+        module_conf = dict(module_def['conf'])
+        module_conf.update(job_conf.get(module_name, {}))
+        job_conf_path = os.path.join(work_dir, module_name + '.job.yml')
+        with open(job_conf_path, 'w') as wf:
+            yaml.safe_dump({module_name: module_conf}, wf)
+        output_dir = os.path.join(work_dir, module_name + '_output')
+        # crg inputs have a line per gene instead of per variant.
+        if module_def['input_format'] == 'crg':
+            num_lines = args.genes
+        else:
+            num_lines = args.variants
+        for run_index in range(args.repeat):
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir)
+            cmd = [sys.executable, os.path.abspath(__file__), '--run-one',
+                   module_main, input_paths[module_def['input_format']],
+                   output_dir, job_conf_path, '--'] + module_args
+            stdout = subprocess.check_output(cmd)
+            metrics = json.loads(stdout.decode().strip().split('\n')[-1])
+            result = {'module': module_name,
+                      'run': run_index,
+                      'variants': num_lines,
+                      'hit_rate': args.hit_rate,
+                      'order': args.order,
+                      'module_args': module_args,
+                      'variants_per_sec': round(num_lines / metrics['runtime'], 1)}
+            result.update(metrics)
+            results.append(result)
+            sys.stderr.write('{module} run {run}: {variants_per_sec} variants/sec\n'\
+                .format(**result))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Bloom filters, for annotators to skip database queries for keys which are
+certainly not in their database.
+
+A filter answers whether a key may be in the set it was built from. It has
+no false negatives, and false positives at about the rate it was sized
+for, so a key it does not contain needs no query. Filters are built with
+the database and saved next to it:
+
+    bloom_filter = BloomFilter.for_capacity(num_keys, fp_rate=0.01)
+    for key in keys:
+        bloom_filter.add(key)
+    bloom_filter.save('data/abraom.bloom')
+
+    bloom_filter = BloomFilter.load('data/abraom.bloom')
+    key in bloom_filter                     # False if key was never added
+    bloom_filter.contains_many(keys)        # a bool per key
+
+Keys are bytes. Each is hashed once with BLAKE2b, and its num_hashes bit
+positions are made from the two halves of the digest (double hashing).
+"""
+import hashlib
+import math
+import struct
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+file_magic = b'CRVBLOOM'
+# Bumped when the file layout changes.
+file_version = 1
+_header = struct.Struct('<8sIQIQ')
+
+class BloomFilter(object):
+
+    def __init__(self, num_bits, num_hashes, bits=None, num_keys=0):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        if bits is None:
+            bits = bytearray((num_bits + 7) // 8)
+        self.bits = bits
+        self.num_keys = num_keys
+
+    @classmethod
+    def for_capacity(cls, num_keys, fp_rate=0.01, max_bytes=None):
+        """
+        Returns an empty filter sized for num_keys keys at a false positive
+        rate of fp_rate. With max_bytes, the filter is no larger than
+        max_bytes, and its false positive rate is higher if it had to be
+        cut down (see expected_fp_rate).
+        """
+        if not 0 < fp_rate < 1:
+            raise ValueError('fp_rate must be between 0 and 1, not {}'.format(fp_rate))
+        num_keys = max(num_keys, 1)
+        num_bits = int(math.ceil(-num_keys * math.log(fp_rate) / math.log(2) ** 2))
+        if max_bytes is not None:
+            if max_bytes < 1:
+                raise ValueError('max_bytes must be at least 1, not {}'.format(max_bytes))
+            num_bits = min(num_bits, max_bytes * 8)
+        num_bits = max(num_bits, 8)
+        num_hashes = max(int(round(num_bits / num_keys * math.log(2))), 1)
+        return cls(num_bits, num_hashes)
+
+    def expected_fp_rate(self, num_keys=None):
+        if num_keys is None:
+            num_keys = self.num_keys
+        return (1 - math.exp(-self.num_hashes * num_keys / self.num_bits)) \
+            ** self.num_hashes
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    def _get_hashes(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return h1, h2
+
+    def _get_positions(self, key):
+        h1, h2 = self._get_hashes(key)
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for position in self._get_positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.num_keys += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for position in self._get_positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def contains_many(self, keys):
+        """
+        Returns a list with key in self for each key. With NumPy, the bits
+        of all of the keys are tested at once.
+        """
+        if np is None or not keys:
+            return [key in self for key in keys]
+        hashes = np.array([self._get_hashes(key) for key in keys], dtype=np.uint64)
+        steps = np.arange(self.num_hashes, dtype=np.uint64)
+        # Same positions as _get_positions, with uint64 wrap around in
+        # place of Python's unbounded ints, taken mod num_bits in two steps.
+        num_bits = np.uint64(self.num_bits)
+        h1 = hashes[:, :1] % num_bits
+        h2 = hashes[:, 1:] % num_bits
+        positions = (h1 + (h2 * steps) % num_bits) % num_bits
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        is_set = (bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return is_set.all(axis=1).tolist()
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(_header.pack(file_magic, file_version, self.num_bits,
+                                 self.num_hashes, self.num_keys))
+            f.write(self.bits)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            header = f.read(_header.size)
+            if len(header) != _header.size:
+                raise ValueError('{} is not a Bloom filter file'.format(path))
+            magic, version, num_bits, num_hashes, num_keys = _header.unpack(header)
+            if magic != file_magic:
+                raise ValueError('{} is not a Bloom filter file'.format(path))
+            if version != file_version:
+                raise ValueError('{} has Bloom filter version {}, not {}'.format(
+                    path, version, file_version))
+            bits = bytearray(f.read())
+        if len(bits) != (num_bits + 7) // 8:
+            raise ValueError('{} is truncated'.format(path))
+        return cls(num_bits, num_hashes, bits=bits, num_keys=num_keys)
@@ -0,0 +1,251 @@
+"""
+Columnar binary format for annotator output (--output-format columnar).
+
+Values are stored by column in their declared type (int as int64, float as
+float64, string as UTF-8), in blocks of block_rows lines, so that they are
+neither formatted as text nor parsed again downstream.
+
+File layout, little-endian:
+
+    magic           b'CRVCOL\\x00\\x01'
+    header length   uint32
+    header          JSON: columns (definitions, as in #column= lines),
+                    meta (as in #key=value lines), compression
+    blocks          uint32 number of lines, then for each column a uint32
+                    chunk length and the chunk: a null bitmap of
+                    ceil(lines / 8) bytes followed by the values (int64 or
+                    float64 array, or uint32 string lengths followed by the
+                    strings), zlib compressed if the header says so
+
+Null and empty values are both stored as null and read back as None, as
+CravatReader reads empty fields.
+"""
+import json
+import struct
+import sys
+import zlib
+from array import array
+
+magic = b'CRVCOL\x00\x01'
+valid_compressions = [None, 'zlib']
+_uint32 = struct.Struct('<I')
+
+def _to_little_endian(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def _encode_nulls(nulls, num_rows):
+    mask = bytearray((num_rows + 7) // 8)
+    for i in nulls:
+        mask[i >> 3] |= 1 << (i & 7)
+    return bytes(mask)
+
+def _decode_nulls(mask, num_rows):
+    return [i for i in range(num_rows) if mask[i >> 3] & (1 << (i & 7))]
+
+class ColumnarWriter(object):
+    """
+    Writes annotator output in the columnar format. Follows the CravatWriter
+    calls BaseAnnotator makes (add_column, write_meta_line,
+    write_definition, write_titles, write_data, close) and adds write_row,
+    which takes the values in column order.
+
+    With include_definition False, only blocks are written, for files which
+    are appended to another columnar file (as the workers of --workers do).
+    """
+    valid_types = ['string', 'int', 'float']
+
+    def __init__(self, path, include_definition=True, block_rows=65536,
+                 compression='zlib', compression_level=1):
+        if compression not in valid_compressions:
+            raise ValueError('Invalid compression: %s' %compression)
+        self.path = path
+        self.wf = open(path, 'wb')
+        self.include_definition = include_definition
+        self.block_rows = block_rows
+        self.compression = compression
+        self.compression_level = compression_level
+        self.columns = {}
+        self.meta = {}
+        self._col_names = None
+        self._col_types = None
+        self._buffers = None
+        self._header_written = False
+        self._num_rows = 0
+
+    def add_column(self, col_index, col_def):
+        if col_def['type'] not in self.valid_types:
+            raise Exception('Invalid type: %s. Choose from %s' \
+                %(col_def['type'], ', '.join(self.valid_types)))
+        self.columns[int(col_index)] = col_def
+
+    def write_meta_line(self, key, value):
+        self.meta[key] = value
+
+    def write_definition(self, conf=None):
+        if conf and 'report_substitution' in conf:
+            self.meta['report_substitution'] = conf['report_substitution']
+
+    # Titles are part of the column definitions.
+    def write_titles(self):
+        pass
+
+    def _prep_for_write(self):
+        if self._buffers is not None:
+            return
+        col_defs = [self.columns[col_index] for col_index in sorted(self.columns)]
+        self._col_names = [col_def['name'] for col_def in col_defs]
+        self._col_types = [col_def['type'] for col_def in col_defs]
+        self._buffers = [[] for _ in col_defs]
+
+    def _write_header(self):
+        self._header_written = True
+        if not self.include_definition:
+            return
+        col_defs = []
+        for col_index in sorted(self.columns):
+            col_def = self.columns[col_index]
+            col_defs.append({k: col_def.get(k) for k in
+                             ('name', 'title', 'type', 'categories', 'width', 'desc',
+                              'hidden', 'category', 'filterable', 'link_format')})
+        header = json.dumps({'columns': col_defs,
+                             'meta': self.meta,
+                             'compression': self.compression}).encode('utf-8')
+        self.wf.write(magic)
+        self.wf.write(_uint32.pack(len(header)))
+        self.wf.write(header)
+
+    def write_data(self, data):
+        self._prep_for_write()
+        get = data.get
+        self.write_row([get(col_name) for col_name in self._col_names])
+
+    def write_row(self, values):
+        self._prep_for_write()
+        converted = []
+        for value, col_type in zip(values, self._col_types):
+            if value is None or value == '':
+                converted.append(None)
+            elif col_type == 'float':
+                converted.append(float(value))
+            elif col_type == 'int':
+                converted.append(int(value))
+            else:
+                converted.append(str(value))
+        for buf, value in zip(self._buffers, converted):
+            buf.append(value)
+        self._num_rows += 1
+        if self._num_rows == self.block_rows:
+            self._flush_block()
+
+    def _encode_column(self, values, col_type):
+        nulls = [i for i, value in enumerate(values) if value is None]
+        parts = [_encode_nulls(nulls, len(values))]
+        if col_type == 'string':
+            encoded = [b'' if value is None else value.encode('utf-8') for value in values]
+            parts.append(_to_little_endian(array('I', [len(v) for v in encoded])).tobytes())
+            parts.append(b''.join(encoded))
+        else:
+            if col_type == 'float':
+                typecode, fill = 'd', 0.0
+            else:
+                typecode, fill = 'q', 0
+            if nulls:
+                values = [fill if value is None else value for value in values]
+            parts.append(_to_little_endian(array(typecode, values)).tobytes())
+        chunk = b''.join(parts)
+        if self.compression == 'zlib':
+            chunk = zlib.compress(chunk, self.compression_level)
+        return chunk
+
+    def _flush_block(self):
+        if not self._header_written:
+            self._write_header()
+        if self._num_rows == 0:
+            return
+        self.wf.write(_uint32.pack(self._num_rows))
+        for i, col_type in enumerate(self._col_types):
+            chunk = self._encode_column(self._buffers[i], col_type)
+            self.wf.write(_uint32.pack(len(chunk)))
+            self.wf.write(chunk)
+            self._buffers[i] = []
+        self._num_rows = 0
+
+    def close(self):
+        self._prep_for_write()
+        self._flush_block()
+        self.wf.close()
+
+class ColumnarReader(object):
+    """
+    Reads files written by ColumnarWriter. columns, get_column_names and
+    loop_data follow CravatReader. loop_blocks gives each block as a dict
+    of column name to list of values, which is the cheapest way to read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(magic)) != magic:
+                raise Exception('%s is not a columnar annotator output' %path)
+            header_len = _uint32.unpack(f.read(4))[0]
+            header = json.loads(f.read(header_len).decode('utf-8'))
+            self._data_start = f.tell()
+        self.columns = {i: col_def for i, col_def in enumerate(header['columns'])}
+        self.meta = header['meta']
+        self.compression = header['compression']
+        self.annotator_name = self.meta.get('name', '')
+        self.annotator_displayname = self.meta.get('displayname', '')
+
+    def get_column_names(self):
+        return [self.columns[i]['name'] for i in sorted(self.columns)]
+
+    def _decode_column(self, chunk, col_type, num_rows):
+        if self.compression == 'zlib':
+            chunk = zlib.decompress(chunk)
+        mask_len = (num_rows + 7) // 8
+        nulls = _decode_nulls(chunk[:mask_len], num_rows)
+        data = chunk[mask_len:]
+        if col_type == 'string':
+            lengths = _to_little_endian(array('I', data[:4 * num_rows])).tolist()
+            strings = data[4 * num_rows:]
+            values = []
+            offset = 0
+            for length in lengths:
+                values.append(strings[offset:offset + length].decode('utf-8'))
+                offset += length
+        else:
+            values = _to_little_endian(array('d' if col_type == 'float' else 'q', data)).tolist()
+        for i in nulls:
+            values[i] = None
+        return values
+
+    def loop_blocks(self):
+        col_names = self.get_column_names()
+        col_types = [self.columns[i]['type'] for i in sorted(self.columns)]
+        with open(self.path, 'rb') as f:
+            f.seek(self._data_start)
+            while True:
+                num_rows = f.read(4)
+                if not num_rows:
+                    break
+                num_rows = _uint32.unpack(num_rows)[0]
+                block = {}
+                for col_name, col_type in zip(col_names, col_types):
+                    chunk_len = _uint32.unpack(f.read(4))[0]
+                    block[col_name] = self._decode_column(f.read(chunk_len), col_type, num_rows)
+                yield block
+
+    def loop_rows(self):
+        col_names = self.get_column_names()
+        for block in self.loop_blocks():
+            for row in zip(*[block[col_name] for col_name in col_names]):
+                yield row
+
+    # Yields (lnum, None, dict) like CravatReader.loop_data. There is no
+    # text line, and lnum counts data lines.
+    def loop_data(self):
+        col_names = self.get_column_names()
+        for lnum, row in enumerate(self.loop_rows(), 1):
+            yield lnum, None, dict(zip(col_names, row))
@@ -0,0 +1,94 @@
+"""
+Per-thread sqlite connections to an annotator database.
+
+sqlite3 connections cannot be shared between threads, and connections
+inherited by forked processes must not be used, so each thread of each
+process gets its own connection to the database, opened on first use with
+the same URI and pragmas.
+"""
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+class ConnectionPool(object):
+
+    def __init__(self, db_path, read_only=True, immutable=False, pragmas=None,
+                 cached_statements=256):
+        """
+        read_only opens the database with mode=ro, and immutable also tells
+        sqlite that the file cannot change, so that it skips locking and
+        change detection. pragmas are run on each new connection, as
+        (name, value) pairs in order.
+        """
+        self.db_path = db_path
+        self.read_only = read_only
+        self.immutable = immutable
+        self.pragmas = pragmas or []
+        self.cached_statements = cached_statements
+        self.wrapper = None
+        self._handles = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.read_only or self.immutable:
+            uri = 'file:{}?mode=ro'.format(pathname2url(self.db_path))
+            if self.immutable:
+                uri += '&immutable=1'
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   cached_statements=self.cached_statements)
+        for name, value in self.pragmas:
+            conn.execute('PRAGMA {}={};'.format(name, value))
+        return conn
+
+    def _get_handle(self):
+        key = (os.getpid(), threading.get_ident())
+        handle = self._handles.get(key)
+        if handle is None:
+            conn = self._connect()
+            handle = [conn, conn.cursor()]
+            if self.wrapper is not None:
+                handle = [self.wrapper(handle[0]), self.wrapper(handle[1])]
+            with self._lock:
+                self._handles[key] = handle
+        return handle
+
+    def get_connection(self):
+        return self._get_handle()[0]
+
+    def get_cursor(self):
+        return self._get_handle()[1]
+
+    def set_connection(self, conn):
+        self._get_handle()[0] = conn
+
+    def set_cursor(self, cursor):
+        self._get_handle()[1] = cursor
+
+    def wrap(self, wrapper):
+        """
+        Replaces the connections and cursors of this process, and those
+        opened later, with wrapper(connection) and wrapper(cursor).
+        """
+        self.wrapper = wrapper
+        pid = os.getpid()
+        with self._lock:
+            for key, handle in self._handles.items():
+                if key[0] == pid:
+                    handle[0] = wrapper(handle[0])
+                    handle[1] = wrapper(handle[1])
+
+    def close(self):
+        """
+        Closes the connections opened by this process. Those inherited from
+        a parent process are left to it.
+        """
+        pid = os.getpid()
+        with self._lock:
+            for key in [key for key in self._handles if key[0] == pid]:
+                conn, cursor = self._handles.pop(key)
+                cursor.close()
+                conn.close()
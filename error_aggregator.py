@@ -0,0 +1,150 @@
+"""
+Aggregates the runtime errors of an annotator run.
+
+Errors are grouped by exception type and the location (file, line and
+function) where they were raised, so a bad database or input which makes
+every line fail gives one error with a count instead of one entry per line.
+For each error, the traceback is formatted once and only the first
+max_samples lines are kept.
+
+Errors raised in the process workers of --pipeline are sent back as
+WorkerErrors, which carry the type, location and traceback of the original
+exception and are counted as it would be.
+"""
+import hashlib
+import os
+import threading
+import traceback
+
+class WorkerError(Exception):
+    """
+    Picklable stand-in for an exception raised in another process.
+    traceback is None when the worker has already sent the same error.
+    """
+
+    def __init__(self, error_type, location, message, traceback=None):
+        super().__init__(message)
+        self.error_type = error_type
+        self.location = location
+        self.message = message
+        self.traceback = traceback
+
+    def __reduce__(self):
+        return (WorkerError, (self.error_type, self.location, self.message,
+                              self.traceback))
+
+    @classmethod
+    def from_exception(cls, e, include_traceback=True):
+        if include_traceback:
+            formatted = ''.join(traceback.format_exception(
+                type(e), e, e.__traceback__)).rstrip()
+        else:
+            formatted = None
+        return cls(type(e).__name__, ErrorAggregator.get_location(e), str(e),
+                   traceback=formatted)
+
+class ErrorAggregator(object):
+
+    def __init__(self, max_samples=5, max_errors=100):
+        self.max_samples = max_samples
+        self.max_errors = max_errors
+        self.errors = {}
+        self.num_lines = 0
+        # The input reader thread of --pipeline logs errors too.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_location(e):
+        frames = traceback.extract_tb(e.__traceback__)
+        if not frames:
+            return ''
+        frame = frames[-1]
+        return '{}:{} ({})'.format(os.path.basename(frame.filename), frame.lineno, frame.name)
+
+    def add(self, e, lnum=None):
+        """
+        Counts exception e, raised on input line lnum. Returns
+        (error, is_new, is_sample): the error entry, whether this is its
+        first line, and whether the line was kept as a sample.
+        """
+        if isinstance(e, WorkerError):
+            return self.add_formatted(e.error_type, e.location, e.message,
+                                      lambda: e.traceback or '', lnum=lnum)
+        return self.add_formatted(type(e).__name__, self.get_location(e), str(e),
+                                  lambda: ''.join(traceback.format_exception(
+                                      type(e), e, e.__traceback__)).rstrip(),
+                                  lnum=lnum)
+
+    def add_formatted(self, error_type, location, message, get_traceback,
+                      lnum=None):
+        """
+        add for errors which are already broken down, such as errors sent
+        from another process. get_traceback is called only for new errors.
+        """
+        with self._lock:
+            return self._add_formatted(error_type, location, message,
+                                       get_traceback, lnum)
+
+    def _add_formatted(self, error_type, location, message, get_traceback, lnum):
+        self.num_lines += 1
+        error_id = hashlib.md5('{}|{}'.format(error_type, location)
+                               .encode('utf-8')).hexdigest()[:12]
+        error = self.errors.get(error_id)
+        # Errors past max_errors are counted together.
+        if error is None and len(self.errors) >= self.max_errors:
+            error_id = 'other'
+            error_type = 'Other'
+            location = ''
+            error = self.errors.get(error_id)
+        is_new = error is None
+        if is_new:
+            error = {'type': error_type,
+                     'location': location,
+                     'message': message,
+                     'traceback': get_traceback(),
+                     'count': 0,
+                     'samples': []}
+            self.errors[error_id] = error
+        error['count'] += 1
+        is_sample = len(error['samples']) < self.max_samples
+        if is_sample:
+            error['samples'].append([lnum, message])
+        return error, is_new, is_sample
+
+    def merge(self, state):
+        """
+        Adds the errors of another aggregator's get_state. Its errors past
+        max_errors are counted with 'other', as add does.
+        """
+        with self._lock:
+            self.num_lines += state['num_lines']
+            for error_id, other in state['errors'].items():
+                error = self.errors.get(error_id)
+                if error is None and len(self.errors) >= self.max_errors:
+                    error_id = 'other'
+                    error = self.errors.get(error_id)
+                    if error is None:
+                        error = dict(other, type='Other', location='')
+                        error['count'] = 0
+                        error['samples'] = []
+                        self.errors[error_id] = error
+                elif error is None:
+                    error = dict(other, count=0, samples=[])
+                    self.errors[error_id] = error
+                error['count'] += other['count']
+                room = self.max_samples - len(error['samples'])
+                error['samples'].extend(other['samples'][:max(room, 0)])
+
+    def get_state(self):
+        return {'num_lines': self.num_lines, 'errors': self.errors}
+
+    def get_summary_lines(self):
+        lines = ['{} lines failed with {} distinct errors'.format(self.num_lines,
+                                                                len(self.errors))]
+        for error_id, error in sorted(self.errors.items(),
+                                      key=lambda item: -item[1]['count']):
+            sample_lnums = ', '.join([str(lnum) for lnum, _ in error['samples']])
+            lines.append('  [{}] {} lines: {} at {}: {} (first lines {})'.format(
+                error_id, error['count'], error['type'], error['location'],
+                error['message'], sample_lnums))
+        return lines
@@ -0,0 +1,177 @@
+"""
+Runs several annotators over one read of their input.
+
+Each annotator run by itself parses the whole input with CravatReader. The
+fused runner sets up all of the annotators, reads the input once, and
+hands each block of lines to every annotator in turn. Each annotator still
+makes its own input records, annotates with its own batches and result
+cache, and writes its own output file, which is the same as when it runs
+by itself. Errors go to the same .log and .err files as well.
+
+    python -m cravat.fused_runner input.crv abraom/abraom.py hgdp/hgdp.py \\
+        -d output_dir -n job -c job.yml -- --output-format columnar
+
+Arguments after -- are passed to every annotator. The annotators must take
+the same input file. --workers, --pipeline and --sorted are not used.
+
+Each annotator parses the all_mappings column of a line itself, since
+modules may change the parser they are given. An annotator which fails is
+stopped and the others run to the end, after which the run fails.
+"""
+import argparse
+import importlib.util
+import os
+import time
+from .exceptions import ConfigurationError
+
+# Status writer for runs outside of a job, which have no status.json.
+class NullStatusWriter(object):
+
+    def queue_status_update(self, k, v, force=False):
+        pass
+
+    def add_annotator_version_to_status_json(self, annotator_name, version):
+        pass
+
+def load_annotator(module_main, cmd_args, status_writer):
+    """
+    Imports the CravatAnnotator of the module script module_main and
+    returns it made with cmd_args, which do not include the script.
+    """
+    module_name = os.path.splitext(os.path.basename(module_main))[0]
+    spec = importlib.util.spec_from_file_location(module_name, module_main)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.CravatAnnotator([module_main] + list(cmd_args), status_writer)
+
+class FusedRunner(object):
+
+    def __init__(self, annotators, block_size=None):
+        """
+        annotators are set up BaseAnnotators with the same primary input.
+        block_size is the number of lines read before they are passed to
+        the annotators, by default the largest batch_size of the
+        annotators, so that batches are the same as in separate runs.
+        """
+        self.annotators = annotators
+        if block_size is None:
+            block_size = max([annotator.batch_size for annotator in annotators])
+        self.block_size = max(block_size, 1)
+        self.failed_annotators = []
+
+    def run(self):
+        start_time = time.time()
+        for annotator in self.annotators:
+            if annotator.update_status_json_flag:
+                annotator.status_writer.queue_status_update('status', 'Started {} ({})'\
+                    .format(annotator.conf['title'], annotator.annotator_name))
+            annotator._start_run(start_time)
+            if annotator.sorted_input or annotator.workers > 1 \
+                    or annotator.pipeline_workers > 0:
+                annotator.logger.info('--sorted, --workers and --pipeline are not used in fused runs')
+        self._check_input()
+        reader = self.annotators[0].primary_input_reader
+        # Lines are read with the types of the first annotator's reader.
+        # Columns are typed by the input's definitions, so they are the same
+        # for every annotator.
+        block = []
+        for lnum, line, reader_data in reader.loop_data():
+            block.append((lnum, line, reader_data))
+            if len(block) == self.block_size:
+                self._annotate_block(block)
+                block = []
+        if block:
+            self._annotate_block(block)
+        for annotator in self._get_running_annotators():
+            try:
+                if annotator.result_cache is not None:
+                    annotator._log_cache_stats(annotator.result_cache.hits,
+                                               annotator.result_cache.misses)
+                annotator._finish_run(start_time)
+            except Exception as e:
+                self._stop_annotator(annotator, e)
+                continue
+            annotator._close_run_log()
+        if self.failed_annotators:
+            raise Exception('Fused annotator(s) %s failed' \
+                %', '.join([annotator.annotator_name
+                            for annotator in self.failed_annotators]))
+
+    def _get_running_annotators(self):
+        return [annotator for annotator in self.annotators
+                if annotator not in self.failed_annotators]
+
+    # Logs an unexpected error of an annotator, which is not run further.
+    def _stop_annotator(self, annotator, e):
+        annotator._log_exception(e, halt=False)
+        annotator._close_run_log()
+        self.failed_annotators.append(annotator)
+
+    def _check_input(self):
+        input_paths = set([annotator.primary_input_path for annotator in self.annotators])
+        if len(input_paths) > 1:
+            raise ConfigurationError('Fused annotators must have the same input, not %s' \
+                %', '.join(sorted(input_paths)))
+        defined_columns = set(self.annotators[0].primary_input_reader.get_column_names())
+        for annotator in self.annotators[1:]:
+            missing_columns = set(annotator.conf['input_columns']) - defined_columns
+            if missing_columns:
+                err_msg = 'Columns of %s not defined in input: %s' \
+                    %(annotator.annotator_name, ', '.join(sorted(missing_columns)))
+                raise ConfigurationError(err_msg)
+
+    def _annotate_block(self, block):
+        for annotator in self._get_running_annotators():
+            try:
+                self._annotate_annotator_block(annotator, block)
+            except Exception as e:
+                self._stop_annotator(annotator, e)
+
+    def _annotate_annotator_block(self, annotator, block):
+        rows = []
+        for lnum, line, reader_data in block:
+            try:
+                input_data, secondary_data = annotator._make_input(reader_data)
+            except Exception as e:
+                annotator._log_runtime_exception(lnum, line, {}, e)
+                continue
+            rows.append((lnum, line, input_data, secondary_data))
+        if annotator._use_batches():
+            for chunk in annotator._chunk_rows(rows, annotator.batch_size):
+                annotator._annotate_chunk(chunk)
+        else:
+            for lnum, line, input_data, secondary_data in rows:
+                annotator._annotate_row(lnum, line, input_data, secondary_data)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run several annotators over one read of their input.')
+    parser.add_argument('input_file', help='Input file to be annotated.')
+    parser.add_argument('modules', nargs='+',
+                        help='Annotator scripts, such as abraom/abraom.py.')
+    parser.add_argument('-n', dest='name',
+                        help='Name of job. Default is input file name.')
+    parser.add_argument('-d', dest='output_dir',
+                        help='Output directory. Default is input file directory.')
+    parser.add_argument('-c', dest='conf', help='Path to optional run conf file.')
+    parser.add_argument('--block-size', dest='block_size', type=int,
+                        help='Lines read at a time. Default is the largest '\
+                             +'batch_size of the annotators.')
+    parser.add_argument('module_args', nargs=argparse.REMAINDER,
+                        help='Arguments for the annotators, after --.')
+    args = parser.parse_args()
+    cmd_args = [args.input_file]
+    if args.name:
+        cmd_args.extend(['-n', args.name])
+    if args.output_dir:
+        cmd_args.extend(['-d', args.output_dir])
+    if args.conf:
+        cmd_args.extend(['-c', args.conf])
+    cmd_args.extend([arg for arg in args.module_args if arg != '--'])
+    status_writer = NullStatusWriter()
+    annotators = [load_annotator(os.path.abspath(module_main), cmd_args, status_writer)
+                  for module_main in args.modules]
+    FusedRunner(annotators, block_size=args.block_size).run()
+
+if __name__ == '__main__':
+    main()
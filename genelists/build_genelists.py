@@ -0,0 +1,105 @@
+"""
+Builds the gene list annotator database from the lists in data/lists/.
+
+Each list file has one HUGO symbol per line. All lists are compiled into
+one index, gene_lists, which maps each symbol to a bitmask of the lists it
+is in (bit i for the list with bit i in the lists table). The annotator
+loads the index once and answers every list with one lookup per gene.
+
+    python build_genelists.py data/lists data/genelists.sqlite
+
+Files with an extension, such as notes in .md, are skipped. The lists
+below get a short column name and a title. Other lists keep their file
+name, and need a column in genelists.yml to get their own output column.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+
+# File name: (column name, title) of the known lists, in bit order.
+list_defs = [
+    ('macarthur_autosomal_dominant_genes', 'autosomal_dominant', 'Autosomal Dominant'),
+    ('macarthur_autosomal_recessive_genes', 'autosomal_recessive', 'Autosomal Recessive'),
+    ('macarthur_dna_repair_genes', 'dna_repair', 'DNA Repair'),
+    ('macarthur_fda_drug_targets', 'fda_drug_target', 'FDA Drug Target'),
+    ('macarthur_gpcrs', 'gpcr', 'GPCR'),
+    ('uniprot_kinases', 'kinase', 'Kinase'),
+    ('minimum_incidental_findings', 'incidental_findings', 'Incidental Findings'),
+]
+# Masks are stored as sqlite integers, which are signed 64 bit.
+max_lists = 63
+
+def read_list(path):
+    """
+    Returns the symbols of a list file, without blank lines or repeats.
+    """
+    genes = []
+    seen = set()
+    with open(path) as f:
+        for line in f:
+            hugo = line.strip()
+            if hugo and hugo not in seen:
+                seen.add(hugo)
+                genes.append(hugo)
+    return genes
+
+def find_lists(list_dir):
+    """
+    Returns (file name, column name, title) of the lists in list_dir: the
+    known lists first, then the others by file name.
+    """
+    file_names = [file_name for file_name in sorted(os.listdir(list_dir))
+                  if '.' not in file_name
+                  and os.path.isfile(os.path.join(list_dir, file_name))]
+    known = {list_def[0]: list_def for list_def in list_defs}
+    lists = [list_def for list_def in list_defs if list_def[0] in file_names]
+    for file_name in file_names:
+        if file_name not in known:
+            lists.append((file_name, file_name,
+                          file_name.replace('_', ' ').title()))
+    if len(lists) > max_lists:
+        raise ValueError('{} lists found, at most {} fit in a mask'\
+            .format(len(lists), max_lists))
+    return lists
+
+def write_genelists_db(db_path, lists):
+    """
+    Writes the index of lists, a list of (name, title, source, genes), to
+    db_path. Returns the number of genes in any list.
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    masks = {}
+    for bit, (_, _, _, genes) in enumerate(lists):
+        for hugo in genes:
+            masks[hugo] = masks.get(hugo, 0) | (1 << bit)
+    conn = sqlite3.connect(db_path)
+    conn.execute('CREATE TABLE lists (bit INTEGER PRIMARY KEY, name TEXT, title TEXT, source TEXT, num_genes INT);')
+    conn.executemany('INSERT INTO lists VALUES (?, ?, ?, ?, ?);',
+                     ((bit, name, title, source, len(genes))
+                      for bit, (name, title, source, genes) in enumerate(lists)))
+    conn.execute('CREATE TABLE gene_lists (hugo TEXT PRIMARY KEY, mask INT) WITHOUT ROWID;')
+    conn.executemany('INSERT INTO gene_lists VALUES (?, ?);', sorted(masks.items()))
+    conn.commit()
+    conn.execute('VACUUM;')
+    conn.close()
+    return len(masks)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the gene list membership index.')
+    parser.add_argument('list_dir', help='Directory of gene list files.')
+    parser.add_argument('output_db', help='Database to write.')
+    args = parser.parse_args()
+    lists = []
+    for file_name, name, title in find_lists(args.list_dir):
+        genes = read_list(os.path.join(args.list_dir, file_name))
+        lists.append((name, title, file_name, genes))
+        sys.stderr.write('{}: {} genes\n'.format(name, len(genes)))
+    num_genes = write_genelists_db(args.output_db, lists)
+    print('{} lists, {} genes written to {}'.format(len(lists), num_genes,
+                                                    args.output_db))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import sys
+from cravat import BaseAnnotator
+from cravat import InvalidData
+from cravat.inout import CravatReader
+import sqlite3
+import os
+
+class GeneListIndex(object):
+    """
+    Membership of genes in every gene list, as compiled by
+    build_genelists.py. Each gene maps to a bitmask with bit i set when it
+    is in list i, so a single dict lookup per gene answers all of the lists.
+    """
+
+    def __init__(self, lists, masks):
+        # lists is [(bit, name, title)] in bit order, and masks maps hugo
+        # to its mask. Genes in no list are left out.
+        self.lists = lists
+        self.masks = masks
+
+    @classmethod
+    def from_db(cls, conn):
+        lists = conn.execute('SELECT bit, name, title FROM lists ORDER BY bit;').fetchall()
+        masks = dict(conn.execute('SELECT hugo, mask FROM gene_lists;'))
+        return cls(lists, masks)
+
+    def get_mask(self, hugo):
+        return self.masks.get(hugo, 0)
+
+    def get_list_names(self, mask):
+        return [name for bit, name, _ in self.lists if mask & (1 << bit)]
+
+    def check_genes(self, hugos):
+        """
+        Returns {list name: [hugo, ...]} for the genes of hugos in each list,
+        in the order of hugos. Each gene is looked up once, whatever the
+        number of lists.
+        """
+        members = {name: [] for _, name, _ in self.lists}
+        bit_names = [(1 << bit, name) for bit, name, _ in self.lists]
+        get_mask = self.masks.get
+        for hugo in hugos:
+            mask = get_mask(hugo)
+            if not mask:
+                continue
+            for bit, name in bit_names:
+                if mask & bit:
+                    members[name].append(hugo)
+        return members
+
+    def check_crg(self, crg_path):
+        """
+        check_genes for the genes of a crg file.
+        """
+        reader = CravatReader(crg_path)
+        return self.check_genes(input_data['hugo']
+                                for _, _, input_data in reader.loop_data())
+
+class CravatAnnotator(BaseAnnotator):
+
+    def setup(self):
+        """
+        Loads the gene list index from data/genelists.sqlite (built with
+        build_genelists.py) into memory. Each list with a column of the same
+        name in genelists.yml gets a 1 in it for its genes. lists has the
+        titles of all of a gene's lists, and num_lists their number.
+
+        Outputs only depend on the mask of a gene, and there are few
+        distinct masks, so they are made once per mask.
+        """
+        self.index = GeneListIndex.from_db(self.dbconn)
+        col_names = set([col_def['name'] for col_def in self.conf['output_columns']])
+        self.list_cols = [(1 << bit, name, title) for bit, name, title in self.index.lists
+                          if name in col_names]
+        self.outputs = {}
+
+    def annotate(self, input_data, secondary_data=None):
+        """
+        input_data has the hugo of a gene from the crg file. Genes in no
+        list get no output line.
+        """
+        mask = self.index.masks.get(input_data['hugo'])
+        if not mask:
+            return None
+        return dict(self._get_output(mask))
+
+    def annotate_batch(self, input_data_list, secondary_data=None):
+        """
+        Batched form of annotate, one dict lookup per gene.
+        """
+        get_mask = self.index.masks.get
+        out = []
+        for input_data in input_data_list:
+            mask = get_mask(input_data['hugo'])
+            if mask:
+                out.append(dict(self._get_output(mask)))
+            else:
+                out.append(None)
+        return out
+
+    def _get_output(self, mask):
+        output = self.outputs.get(mask)
+        if output is None:
+            output = {}
+            for bit, name, _ in self.list_cols:
+                if mask & bit:
+                    output[name] = 1
+            titles = [title for bit, _, title in self.index.lists if mask & (1 << bit)]
+            output['lists'] = ';'.join(titles)
+            output['num_lists'] = len(titles)
+            self.outputs[mask] = output
+        return output
+
+    def cleanup(self):
+        """
+        cleanup is called after every input line has been processed. Use it to
+        close database connections and file handlers. Automatically opened
+        database connections are also automatically closed.
+        """
+        pass
+
+if __name__ == '__main__':
+    annotator = CravatAnnotator(sys.argv)
+    annotator.run()
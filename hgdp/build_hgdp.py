@@ -0,0 +1,146 @@
+"""
+Builds the HGDP annotator database from HGDP_938.geno.
+
+HGDP_938.geno has one line per individual: population, individual ID, then
+one genotype per SNP (the number of copies of the alternate allele, or -9
+when the genotype is missing). snps is a table with the CHR, POS, ID, REF and
+ALT of each SNP, in the same order as the genotype columns.
+
+The genotype file is streamed one individual at a time, and alternate
+allele counts and called genotypes are accumulated for all seven
+populations at once. Frequencies are written straight to the compiled
+database (popfreq_db.write_frequency_db) and, with --store, to the
+memory-mapped store.
+
+    python build_hgdp.py HGDP_938.geno hgdp_snps.txt data/hgdp.sqlite --store data/hgdp_store
+
+A Bloom filter of the SNPs is written next to the database (see
+popfreq_db.py filter), sized with --fp-rate and --filter-max-kb, unless
+--no-filter is given.
+"""
+import argparse
+import csv
+import sys
+import numpy as np
+from cravat.popfreq_db import add_filter_arguments
+from cravat.popfreq_db import frequency_dbs
+from cravat.popfreq_db import write_frequency_db
+from cravat.popfreq_db import write_filter_from_args
+from cravat.popfreq_db import write_frequency_store
+
+# Populations of each group, in the order of the hgdp_table columns.
+population_groups = [
+    ('african', ['BiakaPygmy', 'BantuKenya', 'BantuSouthAfrica', 'Mandenka',
+                 'MbutiPygmy', 'Mozabite', 'San', 'Yoruba']),
+    ('european', ['Adygei', 'Basque', 'French', 'Italian', 'Orcadian',
+                  'Russian', 'Tuscan', 'Sardinian']),
+    ('middle_eastern', ['Bedouin', 'Druze', 'Palestinian']),
+    ('cs_asian', ['Balochi', 'Brahui', 'Burusho', 'Hazara', 'Kalash',
+                  'Makrani', 'Pathan', 'Sindhi', 'Uygur']),
+    ('east_asian', ['Cambodian', 'Dai', 'Daur', 'Han', 'Han-NChina', 'Hezhen',
+                    'Japanese', 'Lahu', 'Miao', 'Mongola', 'Naxi', 'Oroqen',
+                    'She', 'Tu', 'Tujia', 'Xibo', 'Yakut', 'Yi']),
+    ('oceanian', ['Melanesian', 'Papuan']),
+    ('native_american', ['Colombian', 'Karitiana', 'Maya', 'Pima', 'Surui']),
+]
+missing_genotype = -9
+
+def read_snps(snps_path):
+    """
+    Returns (CHR, POS, REF, ALT) of each SNP. The file may be comma, tab or
+    space separated, with or without a header line.
+    """
+    snps = []
+    with open(snps_path) as f:
+        sample = f.readline()
+        f.seek(0)
+        delimiter = ',' if ',' in sample else None
+        for line in f:
+            if delimiter:
+                toks = next(csv.reader([line]))
+            else:
+                toks = line.split()
+            if not toks or toks[0].upper() in ('CHR', '#CHR', 'CHROM'):
+                continue
+            chrom, pos, _, ref, alt = toks[:5]
+            snps.append((chrom, int(pos), ref, alt))
+    return snps
+
+def count_alleles(geno_path, num_snps):
+    """
+    Returns (alt_counts, called) arrays of shape (populations, SNPs): the
+    alternate allele count and the number of called genotypes of each SNP
+    in each population group.
+    """
+    group_index = {}
+    for i, (_, populations) in enumerate(population_groups):
+        for population in populations:
+            group_index[population] = i
+    alt_counts = np.zeros((len(population_groups), num_snps), dtype=np.int32)
+    called = np.zeros((len(population_groups), num_snps), dtype=np.int32)
+    skipped = set()
+    with open(geno_path) as f:
+        for lnum, line in enumerate(f, 1):
+            population, _, genotypes = line.lstrip().split(None, 2)
+            if population not in group_index:
+                skipped.add(population)
+                continue
+            genotypes = np.fromstring(genotypes, dtype=np.int8, sep=' ')
+            if len(genotypes) != num_snps:
+                raise ValueError('line {}: {} genotypes, {} SNPs expected'\
+                    .format(lnum, len(genotypes), num_snps))
+            is_called = genotypes != missing_genotype
+            i = group_index[population]
+            alt_counts[i] += np.where(is_called, genotypes, 0)
+            called[i] += is_called
+    if skipped:
+        sys.stderr.write('Skipped populations not in any group: {}\n'\
+            .format(', '.join(sorted(skipped))))
+    return alt_counts, called
+
+def allele_frequencies(alt_counts, called):
+    """
+    Alternate allele frequency of each SNP in each group, as a (SNPs,
+    populations) array. Missing genotypes count towards neither the
+    alternate nor the total alleles. SNPs not called in a group are NaN.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        freqs = alt_counts / (2.0 * called)
+    freqs[called == 0] = np.nan
+    return freqs.T
+
+def frequency_records(snps, freqs):
+    for (chrom, pos, ref, alt), snp_freqs in zip(snps, freqs):
+        yield (chrom, pos, ref, alt) \
+            + tuple([None if np.isnan(v) else float(v) for v in snp_freqs])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the HGDP allele frequency database.')
+    parser.add_argument('geno', help='HGDP_938.geno genotype file.')
+    parser.add_argument('snps',
+                        help='CHR, POS, ID, REF and ALT of each genotype column.')
+    parser.add_argument('output_db', help='Compiled database to write.')
+    parser.add_argument('--store', dest='store_dir',
+                        help='Also write the memory-mapped store here.')
+    parser.add_argument('--no-filter', dest='no_filter', action='store_true',
+                        help='Do not write the Bloom filter.')
+    add_filter_arguments(parser)
+    args = parser.parse_args()
+    db_def = frequency_dbs['hgdp']
+    snps = read_snps(args.snps)
+    alt_counts, called = count_alleles(args.geno, len(snps))
+    freqs = allele_frequencies(alt_counts, called)
+    num_rows = write_frequency_db(args.output_db, db_def['table'],
+                                  db_def['freq_columns'],
+                                  frequency_records(snps, freqs))
+    print('{} rows written to {}'.format(num_rows, args.output_db))
+    if not args.no_filter:
+        write_filter_from_args(args.output_db, db_def['table'], args)
+    if args.store_dir:
+        write_frequency_store(args.output_db, db_def['table'],
+                              db_def['freq_columns'], args.store_dir)
+        print('store written to {}'.format(args.store_dir))
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,20 @@
 import sys
 from cravat import BaseAnnotator
 from cravat import InvalidData
+from cravat.popfreq_db import chrom_to_int
+from cravat.popfreq_db import FrequencyArrays
+from cravat.popfreq_db import frequency_dbs
+from cravat.popfreq_db import get_filter_path
+from cravat.popfreq_db import load_frequency_filter
+from cravat.popfreq_db import query_frequency_regions
+from cravat.popfreq_db import variant_key
 import sqlite3
 import os
 
 class CravatAnnotator(BaseAnnotator):
 
+    batch_keys_sql = 'CREATE TEMP TABLE IF NOT EXISTS batch_keys (idx INTEGER PRIMARY KEY, chrom_int INT, pos INT, ref TEXT, alt TEXT);'
+
     def setup(self):
         """
         Set up data sources.
@@ -13,11 +22,44 @@ class CravatAnnotator(BaseAnnotator):
         data/example_annotator.sqlite using the sqlite3 python module. The
         sqlite3.Connection object is stored as self.dbconn, and the
         sqlite3.Cursor object is stored as self.cursor.
+
+        annotate_batch matches its input lines through a temporary key table.
+        BaseAnnotator gives each thread its own connection, so the table is
+        created for each connection that annotate_batch runs on.
+
+        Queries use ? placeholders and SQL made once here for the table, so
+        that sqlite3 reuses their prepared statements.
+
+        With mmap_store set in hgdp.yml, lookups instead go to the
+        memory-mapped arrays in data/hgdp_store (made with
+        popfreq_db.py store).
+
+        With a Bloom filter of the table next to the database (see
+        popfreq_db.py filter), variants which are certainly not in the table
+        are not looked up, and the run log has the number of lookups
+        skipped. presence_filter: false in hgdp.yml turns it off.
         """
         # Verify the connection and cursor exist.
         #assert isinstance(self.dbconn, sqlite3.Connection)
         #assert isinstance(self.cursor, sqlite3.Cursor)
-        pass
+        self.cursor.execute(self.batch_keys_sql)
+        self.table = frequency_dbs['hgdp']['table']
+        freq_columns = frequency_dbs['hgdp']['freq_columns']
+        self.select_sql = 'SELECT {} FROM {} WHERE chrom_int=? AND pos=? AND ref=? AND alt=?;'.format(', '.join(freq_columns), self.table)
+        self.batch_sql = 'SELECT b.idx, {} FROM batch_keys AS b JOIN {} AS h ON h.chrom_int=b.chrom_int AND h.pos=b.pos AND h.ref=b.ref AND h.alt=b.alt;'.format(', '.join(['h.' + col for col in freq_columns]), self.table)
+        self.sorted_sql = 'SELECT pos, ref, alt, {} FROM {} WHERE chrom_int=? ORDER BY pos;'.format(', '.join(freq_columns), self.table)
+        self.freq_arrays = None
+        if self.conf.get('mmap_store', False):
+            store_dir = os.path.join(self.data_dir, 'hgdp_store')
+            try:
+                self.freq_arrays = FrequencyArrays.from_store(store_dir)
+                self.logger.info('mapped {} variants from {}'.format(
+                    self.freq_arrays.num_rows, store_dir))
+            except (ImportError, IOError) as e:
+                self.logger.warning('mmap_store disabled: {}'.format(e))
+        self.presence_filter = None
+        if self.freq_arrays is None and self.conf.get('presence_filter', True):
+            self.presence_filter = self._load_presence_filter()
 
     def annotate(self, input_data, secondary_data=None):
         """
@@ -29,64 +71,145 @@ class CravatAnnotator(BaseAnnotator):
         line. input_data includes the following keys:
             ('uid', 'chrom', 'pos', 'ref_base', 'alt_base')
 
-        keys in the annotator database (one flat table):
-        CHR  POS  ID   REF  ALT    African    European    Middle_Eastern    CS_Asian     East_Asian    Oceanian    Native_American
-
+        keys in the annotator database (one flat table, compiled with
+        popfreq_db.py):
+        chrom_int  pos  ref  alt  african  european  middle_eastern  cs_asian  east_asian  oceanian  native_american
 
         should return a dictionary with keys matching the column names
         defined in example_annotator.yml. Extra column names will be ignored,
         and absent column names will be filled with None.
         """
-        out = {}
-
         # get input details
-        input_chrom = input_data['chrom'].lower()
+        input_chrom = chrom_to_int(input_data['chrom'])
         input_pos = input_data['pos']
         input_ref = input_data['ref_base']
         input_alt = input_data['alt_base']
 
-        sql_q = 'SELECT  African, European, Middle_Eastern, CS_Asian, East_Asian, Oceanian, Native_American FROM hgdp_table WHERE CHR="%s" AND POS=%s AND REF="%s" and ALT="%s";' \
-            %(input_chrom, input_pos, input_ref, input_alt)
-
-        self.cursor.execute(sql_q)
-        sql_q_result = self.cursor.fetchone()
+        if input_chrom is None:
+            return self._build_output(None)
 
-        african_allele_freq = ''
-        european_allele_freq = ''
-        middle_eastern_allele_freq = ''
-        cs_asian_allele_freq = ''
-        east_asian_allele_freq = ''
-        oceanian_allele_freq = ''
-        native_american_allele_freq = ''
-
-
-        if sql_q_result:
-            african_allele_freq += sql_q_result[0]
-            out['african_allele_freq'] = african_allele_freq
+        if self.freq_arrays is not None:
+            return self._build_output(self.freq_arrays.lookup(input_chrom, input_pos, input_ref, input_alt))
 
-            european_allele_freq += sql_q_result[1]
-            out['european_allele_freq'] = european_allele_freq
+        if self.presence_filter is not None:
+            self.add_row_run_count('variants checked by presence filter')
+            if variant_key(input_chrom, input_pos, input_ref, input_alt) not in self.presence_filter:
+                self.add_row_run_count('lookups skipped by presence filter')
+                return self._build_output(None)
 
-            middle_eastern_allele_freq += sql_q_result[2]
-            out['middle_eastern_allele_freq'] = middle_eastern_allele_freq
+        self.cursor.execute(self.select_sql, (input_chrom, input_pos, input_ref, input_alt))
+        sql_q_result = self.cursor.fetchone()
 
-            cs_asian_allele_freq += sql_q_result[3]
-            out['cs_asian_allele_freq'] = cs_asian_allele_freq
+        return self._build_output(sql_q_result)
 
-            east_asian_allele_freq += sql_q_result[4]
-            out['east_asian_allele_freq'] = east_asian_allele_freq
+    def annotate_batch(self, input_data_list, secondary_data=None):
+        """
+        Batched form of annotate. BaseAnnotator.run calls this with chunks of
+        input lines in place of one annotate call per line, and expects one
+        output dictionary per input line, in the same order.
+
+        The chunk's keys are loaded into the batch_keys temporary table and
+        matched against the table with a single join, or looked up all at
+        once in the mapped store. Keys not in the presence filter are left
+        out, and the join is skipped if none are left.
+        """
+        if self.freq_arrays is not None:
+            sql_q_results = self.freq_arrays.lookup_many(
+                [chrom_to_int(input_data['chrom']) for input_data in input_data_list],
+                [input_data['pos'] for input_data in input_data_list],
+                [input_data['ref_base'] for input_data in input_data_list],
+                [input_data['alt_base'] for input_data in input_data_list])
+            return [self._build_output(sql_q_result) for sql_q_result in sql_q_results]
+
+        batch_keys = [(idx, chrom_to_int(input_data['chrom']), input_data['pos'],
+                       input_data['ref_base'], input_data['alt_base'])
+                      for idx, input_data in enumerate(input_data_list)]
+        if self.presence_filter is not None:
+            batch_keys = self._filter_batch_keys(batch_keys)
+            if not batch_keys:
+                return [self._build_output(None) for _ in input_data_list]
+
+        self.cursor.execute(self.batch_keys_sql)
+        self.cursor.execute('DELETE FROM batch_keys;')
+        self.cursor.executemany('INSERT INTO batch_keys VALUES (?, ?, ?, ?, ?);', batch_keys)
+
+        self.cursor.execute(self.batch_sql)
+
+        # Like fetchone in annotate, only the first match of a line is used.
+        sql_q_results = {}
+        for row in self.cursor.fetchall():
+            if row[0] not in sql_q_results:
+                sql_q_results[row[0]] = row[1:]
+
+        return [self._build_output(sql_q_results.get(idx))
+                for idx in range(len(input_data_list))]
+
+    def get_sorted_records(self, chrom):
+        """
+        Used by BaseAnnotator's merge join mode (--sorted). Streams the
+        table's records of a chromosome in position order, as tuples starting
+        with the position.
+        """
+        return self.dbconn.execute(self.sorted_sql, (chrom_to_int(chrom),))
 
-            oceanian_allele_freq += sql_q_result[5]
-            out['oceanian_allele_freq'] = oceanian_allele_freq
+    def annotate_merged(self, input_data, records, secondary_data=None):
+        """
+        Merge join counterpart of annotate. records are the rows from
+        get_sorted_records at the position of input_data.
+        """
+        for record in records:
+            if record[1] == input_data['ref_base'] and record[2] == input_data['alt_base']:
+                return self._build_output(record[3:])
+        return self._build_output(None)
 
-            native_american_allele_freq += sql_q_result[6]
-            out['native_american_allele_freq'] = native_american_allele_freq
+    def query_regions(self, regions):
+        """
+        Used by BaseAnnotator's region mode (--regions). Yields the HGDP
+        records at positions in regions, with their outputs. Each merged
+        region is one range seek on the table (see
+        popfreq_db.query_frequency_regions).
+        """
+        freq_columns = frequency_dbs['hgdp']['freq_columns']
+        for record in query_frequency_regions(self.dbconn, self.table,
+                                              freq_columns, regions):
+            yield record[:4] + (self._build_output(record[4:]),)
+
+    def _load_presence_filter(self):
+        filter_path = get_filter_path(self.db_pool.db_path, self.table)
+        try:
+            presence_filter = load_frequency_filter(self.dbconn, filter_path, self.table)
+        except (IOError, ValueError) as e:
+            self.logger.warning('presence filter disabled: {}'.format(e))
+            return None
+        if presence_filter is not None:
+            self.logger.info('presence filter of {} variants, {:0.1f} KiB'.format(
+                presence_filter.num_keys, presence_filter.nbytes / 1024))
+        return presence_filter
+
+    def _filter_batch_keys(self, batch_keys):
+        # Keeps the batch_keys rows whose variants may be in the table.
+        maybe_present = self.presence_filter.contains_many(
+            [variant_key(*batch_key[1:]) for batch_key in batch_keys])
+        kept = [batch_key for batch_key, present in zip(batch_keys, maybe_present)
+                if present]
+        self.add_run_count('variants checked by presence filter', len(batch_keys))
+        self.add_run_count('lookups skipped by presence filter', len(batch_keys) - len(kept))
+        return kept
+
+    def _build_output(self, sql_q_result):
+        out = {}
 
+        if sql_q_result:
+            out['african_allele_freq'] = sql_q_result[0]
+            out['european_allele_freq'] = sql_q_result[1]
+            out['middle_eastern_allele_freq'] = sql_q_result[2]
+            out['cs_asian_allele_freq'] = sql_q_result[3]
+            out['east_asian_allele_freq'] = sql_q_result[4]
+            out['oceanian_allele_freq'] = sql_q_result[5]
+            out['native_american_allele_freq'] = sql_q_result[6]
         else:
-
             out['native_american_allele_freq'] = 999.99
 
-
         return out
 
 
@@ -0,0 +1,284 @@
+"""
+Coordinate liftover with UCSC chain files, for building annotator
+databases on another assembly than their source, such as ABRaOM (hg19) on
+hg38.
+
+A chain file is parsed once into a ChainIndex, which holds the aligned
+blocks of each source chromosome in arrays sorted by start. A position is
+found with a binary search, and convert_many converts whole arrays of
+positions at once (vectorized with NumPy when it is installed). Parsed
+indexes are kept for the process and, with cache=True, pickled next to the
+chain file, so that later builds skip parsing.
+
+    index = ChainIndex.load('hg19ToHg38.over.chain.gz')
+    index.convert('chr1', 1014143)            # (chrom, pos, strand) or None
+    index.convert_many(chroms, positions)     # a convert() result per position
+    lift_variants(index, variants)            # (chrom, pos, ref, alt) tuples
+
+Positions are 1-based, as in crv files. When a block maps to the - strand
+of the target, converted positions are on the + strand and lift_variants
+reverse complements the alleles. Where blocks of several chains overlap, the
+block of the highest scoring chain is used.
+"""
+import bisect
+import gzip
+import os
+import pickle
+from array import array
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Bumped when the pickled layout changes.
+index_version = 1
+_complements = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N',
+                'a': 't', 'c': 'g', 'g': 'c', 't': 'a', 'n': 'n'}
+_loaded = {}
+
+def reverse_complement(bases):
+    if bases in ('', '-'):
+        return bases
+    return ''.join([_complements.get(base, base) for base in reversed(bases)])
+
+def _open_chain(path):
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt')
+    return open(path)
+
+class ChainIndex(object):
+
+    def __init__(self, chroms, targets):
+        # chroms maps a source chromosome to its blocks, sorted by start:
+        #   starts, ends     0-based half-open source ranges
+        #   q_starts         0-based target start, on the target strand
+        #   target_idxs      index into targets of (name, strand, size)
+        #   scores           score of the block's chain
+        #   max_ends         highest end of this and the earlier blocks
+        #   overlaps_prev    1 if an earlier block overlaps this one
+        self.chroms = chroms
+        self.targets = targets
+        self._np_chroms = {}
+
+    @classmethod
+    def load(cls, chain_path, cache=False):
+        """
+        Returns the index of chain_path, parsing the file only if this
+        process has not loaded it and, with cache, it has no up to date
+        pickled index (chain_path + '.index').
+        """
+        chain_path = os.path.abspath(chain_path)
+        stat = os.stat(chain_path)
+        key = (chain_path, stat.st_size, stat.st_mtime)
+        index = _loaded.get(key)
+        if index is not None:
+            return index
+        cache_path = chain_path + '.index'
+        if cache:
+            index = cls._read_cache(cache_path, key)
+        if index is None:
+            index = cls.from_chain_file(chain_path)
+            if cache:
+                index._write_cache(cache_path, key)
+        _loaded[key] = index
+        return index
+
+    @classmethod
+    def _read_cache(cls, cache_path, key):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if cached.get('version') != index_version or tuple(cached.get('key', ())) != key:
+            return None
+        return cls(cached['chroms'], cached['targets'])
+
+    def _write_cache(self, cache_path, key):
+        tmp_path = cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({'version': index_version, 'key': key,
+                             'chroms': self.chroms, 'targets': self.targets},
+                            f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            # The index is still usable, only not cached.
+            pass
+
+    @classmethod
+    def from_chain_file(cls, chain_path):
+        blocks = {}
+        targets = []
+        target_idxs = {}
+        with _open_chain(chain_path) as f:
+            t_pos = q_pos = None
+            for line in f:
+                toks = line.split()
+                if not toks or toks[0].startswith('#'):
+                    continue
+                if toks[0] == 'chain':
+                    score = float(toks[1])
+                    t_name = toks[2]
+                    t_pos = int(toks[5])
+                    target = (toks[7], toks[9], int(toks[8]))
+                    if target not in target_idxs:
+                        target_idxs[target] = len(targets)
+                        targets.append(target)
+                    target_idx = target_idxs[target]
+                    q_pos = int(toks[10])
+                    chrom_blocks = blocks.setdefault(t_name, [])
+                    continue
+                size = int(toks[0])
+                chrom_blocks.append((t_pos, t_pos + size, q_pos, target_idx, score))
+                if len(toks) == 3:
+                    t_pos += size + int(toks[1])
+                    q_pos += size + int(toks[2])
+        chroms = {}
+        for chrom, chrom_blocks in blocks.items():
+            chrom_blocks.sort(key=lambda block: block[0])
+            max_ends = array('q')
+            overlaps_prev = bytearray(len(chrom_blocks))
+            max_end = -1
+            for i, block in enumerate(chrom_blocks):
+                if max_end > block[0]:
+                    overlaps_prev[i] = 1
+                max_end = max(max_end, block[1])
+                max_ends.append(max_end)
+            chroms[chrom] = {
+                'starts': array('q', [block[0] for block in chrom_blocks]),
+                'ends': array('q', [block[1] for block in chrom_blocks]),
+                'q_starts': array('q', [block[2] for block in chrom_blocks]),
+                'target_idxs': array('l', [block[3] for block in chrom_blocks]),
+                'scores': array('d', [block[4] for block in chrom_blocks]),
+                'max_ends': max_ends,
+                'overlaps_prev': overlaps_prev,
+            }
+        return cls(chroms, targets)
+
+    def _find_block(self, blocks, x):
+        # Block of the highest scoring chain containing 0-based position x,
+        # or -1. Earlier blocks can only contain x while their max_ends
+        # reach past it.
+        i = bisect.bisect_right(blocks['starts'], x) - 1
+        ends = blocks['ends']
+        max_ends = blocks['max_ends']
+        scores = blocks['scores']
+        best = -1
+        while i >= 0 and max_ends[i] > x:
+            if ends[i] > x and (best < 0 or scores[i] > scores[best]):
+                best = i
+            i -= 1
+        return best
+
+    def _convert_block(self, blocks, i, x):
+        q_name, q_strand, q_size = self.targets[blocks['target_idxs'][i]]
+        q_x = blocks['q_starts'][i] + x - blocks['starts'][i]
+        if q_strand == '-':
+            q_x = q_size - 1 - q_x
+        return q_name, q_x + 1, q_strand
+
+    def convert(self, chrom, pos):
+        """
+        Returns (chrom, pos, strand) of 1-based position pos on the target
+        assembly, or None if it is not in any chain.
+        """
+        blocks = self.chroms.get(chrom)
+        if blocks is None or pos is None:
+            return None
+        i = self._find_block(blocks, pos - 1)
+        if i < 0:
+            return None
+        return self._convert_block(blocks, i, pos - 1)
+
+    def convert_many(self, chroms, positions):
+        """
+        convert() for equal length sequences of chromosomes and positions.
+        Each chromosome's positions are searched together.
+        """
+        results = [None] * len(positions)
+        query_idxs = {}
+        for idx, (chrom, pos) in enumerate(zip(chroms, positions)):
+            if pos is not None and chrom in self.chroms:
+                query_idxs.setdefault(chrom, []).append(idx)
+        for chrom, idxs in query_idxs.items():
+            blocks = self.chroms[chrom]
+            xs = [positions[idx] - 1 for idx in idxs]
+            if np is None:
+                found = [self._find_block(blocks, x) for x in xs]
+            else:
+                found = self._find_blocks_np(chrom, blocks, xs)
+            for idx, x, i in zip(idxs, xs, found):
+                if i >= 0:
+                    results[idx] = self._convert_block(blocks, i, x)
+        return results
+
+    def _find_blocks_np(self, chrom, blocks, xs):
+        np_blocks = self._np_chroms.get(chrom)
+        if np_blocks is None:
+            np_blocks = tuple([np.frombuffer(blocks[name], dtype=dtype)
+                               for name, dtype in (('starts', np.int64),
+                                                   ('ends', np.int64),
+                                                   ('max_ends', np.int64),
+                                                   ('overlaps_prev', np.uint8))])
+            self._np_chroms[chrom] = np_blocks
+        starts, ends, max_ends, overlaps_prev = np_blocks
+        xs = np.array(xs, dtype=np.int64)
+        found = np.searchsorted(starts, xs, 'right') - 1
+        valid = found >= 0
+        safe = np.where(valid, found, 0)
+        hit = valid & (ends[safe] > xs)
+        # Positions in overlapping blocks, or in an earlier block than the
+        # last one starting before them, are searched one by one.
+        ambiguous = valid & np.where(hit, overlaps_prev[safe] == 1, max_ends[safe] > xs)
+        found = np.where(hit, found, -1)
+        for j in np.nonzero(ambiguous)[0]:
+            found[j] = self._find_block(blocks, int(xs[j]))
+        return found.tolist()
+
+def lift_variants(index, variants):
+    """
+    Lifts (chrom, pos, ref, alt) variants, with '-' for the empty allele of
+    insertions and deletions. Returns a lifted tuple per variant, or None
+    where the variant's bases do not map to one contiguous stretch of the
+    target. Variants on the - strand of the target get reverse complemented
+    alleles, at the target position of their last base.
+    """
+    chroms = []
+    starts = []
+    ends = []
+    for chrom, pos, ref, alt in variants:
+        ref_len = 0 if ref in ('', '-') else len(ref)
+        chroms.append(chrom)
+        starts.append(pos)
+        ends.append(None if pos is None else pos + max(ref_len, 1) - 1)
+    converted_starts = index.convert_many(chroms, starts)
+    converted_ends = index.convert_many(chroms, ends)
+    lifted = []
+    for i, (chrom, pos, ref, alt) in enumerate(variants):
+        start = converted_starts[i]
+        end = converted_ends[i]
+        if start is None or end is None or start[0] != end[0] or start[2] != end[2]:
+            lifted.append(None)
+            continue
+        span = ends[i] - pos
+        if start[2] == '+':
+            if end[1] - start[1] != span:
+                lifted.append(None)
+                continue
+            lifted.append((start[0], start[1], ref, alt))
+        else:
+            if start[1] - end[1] != span:
+                lifted.append(None)
+                continue
+            if ref in ('', '-'):
+                # The insertion follows the anchor base, which on the -
+                # strand puts it after the target base before it.
+                new_pos = start[1] - 1
+            else:
+                new_pos = end[1]
+            lifted.append((start[0], new_pos, reverse_complement(ref),
+                           reverse_complement(alt)))
+    return lifted
@@ -0,0 +1,105 @@
+"""
+Pipelined annotation for BaseAnnotator (--pipeline).
+
+A reader thread reads the input in chunks and submits them to a pool of
+annotate workers, which are threads or forked processes. The main thread
+takes the results in input order and writes them. At most queue_depth
+chunks are submitted but not yet written. When annotating or writing is the
+slower stage, the reader waits, so memory stays bounded.
+
+Thread workers share the annotator and get their own sqlite connections
+from its connection pool. They suit annotators which spend their time in
+sqlite, since sqlite releases the GIL. Process workers are forked when the
+pipeline starts. They have their own connections and result caches, and
+their chunks and results are pickled.
+"""
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+
+valid_worker_types = ['thread', 'process']
+
+# The function process workers call. It is set before the workers are
+# forked, so it does not need to be pickled.
+_process_func = None
+
+def _call_process_func(args):
+    return _process_func(args)
+
+class Pipeline(object):
+
+    def __init__(self, func, num_workers, queue_depth, worker_type='thread'):
+        if worker_type not in valid_worker_types:
+            raise ValueError('Invalid worker type: %s' %worker_type)
+        if num_workers < 1 or queue_depth < 1:
+            raise ValueError('num_workers and queue_depth must be at least 1')
+        self.func = func
+        self.num_workers = num_workers
+        self.queue_depth = queue_depth
+        self.worker_type = worker_type
+
+    def run(self, items, write):
+        """
+        items yields (chunk, args). func(args) is called in the workers and
+        write(chunk, result) in this thread, in the order of items.
+        Exceptions raised by items, func or write stop the pipeline and
+        are raised here.
+        """
+        global _process_func
+        if self.worker_type == 'process':
+            _process_func = self.func
+            pool = multiprocessing.get_context('fork').Pool(self.num_workers)
+            submit = lambda args: pool.apply_async(_call_process_func, (args,)).get
+        else:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.num_workers)
+            submit = lambda args: pool.submit(self.func, args).result
+        pending = queue.Queue(maxsize=self.queue_depth)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read,
+                                  args=(items, submit, pending, stop))
+        reader.daemon = True
+        reader.start()
+        completed = False
+        try:
+            while True:
+                entry = pending.get()
+                if entry is None:
+                    break
+                chunk, get_result = entry
+                if isinstance(get_result, BaseException):
+                    raise get_result
+                write(chunk, get_result())
+            completed = True
+        finally:
+            stop.set()
+            reader.join()
+            if self.worker_type == 'process':
+                if completed:
+                    pool.close()
+                else:
+                    pool.terminate()
+                pool.join()
+                _process_func = None
+            else:
+                pool.shutdown(wait=True)
+
+    # Puts entry in the queue, waiting for room unless the pipeline is
+    # stopped. Returns whether it was put.
+    def _put(self, pending, stop, entry):
+        while not stop.is_set():
+            try:
+                pending.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, items, submit, pending, stop):
+        try:
+            for chunk, args in items:
+                if not self._put(pending, stop, (chunk, submit(args))):
+                    return
+        except BaseException as e:
+            self._put(pending, stop, (None, e))
+        self._put(pending, stop, None)
@@ -0,0 +1,549 @@
+"""
+Compiled sqlite databases for the population frequency annotators
+(abraom and hgdp).
+
+Each database holds one WITHOUT ROWID table clustered on
+(chrom_int, pos, ref, alt), with one REAL column per frequency, so that a
+variant lookup is a single primary key seek. Build one from an annotator's
+original text-typed database with
+
+    python popfreq_db.py compile abraom abraom_legacy.sqlite abraom/data/abraom.sqlite
+
+A compiled database can also be written out as a memory-mapped store of
+NumPy arrays (see FrequencyArrays.from_store) with
+
+    python popfreq_db.py store hgdp hgdp/data/hgdp.sqlite hgdp/data/hgdp_store
+
+and a compiled table can be lifted to another assembly with a UCSC chain
+file (see liftover.py), into a second table of the same database
+
+    python popfreq_db.py lift abraom abraom/data/abraom.sqlite hg19ToHg38.over.chain.gz hg38
+
+Each table can have a Bloom filter of its variants next to the database
+(see bloom.py), which lets annotators skip the queries of variants that are
+not in it
+
+    python popfreq_db.py filter abraom abraom/data/abraom.sqlite --fp-rate 0.01
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+from cravat.bloom import BloomFilter
+from cravat.liftover import ChainIndex
+from cravat.liftover import lift_variants
+from cravat.regions import merge_regions
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+chrom_ints = dict([('chr' + str(n), n) for n in range(1, 23)] +
+                  [('chrx', 23), ('chry', 24), ('chrm', 25), ('chrmt', 25)])
+int_to_chroms = dict([(n, 'chr' + str(n)) for n in range(1, 23)] +
+                     [(23, 'chrX'), (24, 'chrY'), (25, 'chrM')])
+
+# Compiled table layout of each annotator, and how to read the annotator's
+# original database. assembly_tables names the table of each assembly, for
+# databases with lifted tables.
+frequency_dbs = {
+    'abraom': {
+        'table': 'abraom',
+        'freq_columns': ['allele_freq'],
+        'legacy_query': 'SELECT CHR, Start, REF, ALT, Frequencies FROM abraom',
+        'assembly_tables': {'hg19': 'abraom', 'hg38': 'abraom_hg38'},
+    },
+    'hgdp': {
+        'table': 'hgdp_table',
+        'freq_columns': ['african', 'european', 'middle_eastern', 'cs_asian',
+                         'east_asian', 'oceanian', 'native_american'],
+        'legacy_query': 'SELECT CHR, POS, REF, ALT, African, European, '\
+                        +'Middle_Eastern, CS_Asian, East_Asian, Oceanian, '\
+                        +'Native_American FROM hgdp_table',
+    },
+}
+
+def chrom_to_int(chrom):
+    """
+    Returns the integer code of a chromosome name (chr1-chr22 are 1-22,
+    chrX 23, chrY 24, chrM 25), or None for other contigs. The chr prefix
+    and case are optional.
+    """
+    if chrom is None:
+        return None
+    chrom = chrom.lower()
+    if not chrom.startswith('chr'):
+        chrom = 'chr' + chrom
+    return chrom_ints.get(chrom)
+
+def to_float(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = value.strip()
+    if value in ('', '.', 'NA', 'NaN', 'nan'):
+        return None
+    return float(value)
+
+def write_frequency_db(db_path, table, freq_columns, records, replace=True):
+    """
+    Writes records, an iterable of (chrom, pos, ref, alt, freq, ...) tuples,
+    to a new compiled database at db_path, replacing any existing file.
+    Without replace, only table is replaced and the file's other tables are
+    kept. Records on contigs without a chrom_int are skipped, and of records
+    with the same key the first one is kept. Returns the number of rows
+    written.
+
+    The Bloom filters of the replaced tables are removed, since they no
+    longer match them. write_frequency_filter writes new ones.
+
+    Rows are bulk loaded into an unindexed staging table with journaling
+    off, then copied into the clustered table in key order and ANALYZEd.
+    """
+    replaced_tables = [table]
+    if replace and os.path.exists(db_path):
+        conn = sqlite3.connect(db_path)
+        try:
+            replaced_tables.extend([row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='table';")])
+        finally:
+            conn.close()
+        os.remove(db_path)
+    for replaced_table in replaced_tables:
+        filter_path = get_filter_path(db_path, replaced_table)
+        if os.path.exists(filter_path):
+            os.remove(filter_path)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=OFF;')
+    conn.execute('PRAGMA synchronous=OFF;')
+    conn.execute('PRAGMA temp_store=MEMORY;')
+    conn.execute('PRAGMA cache_size=-131072;')
+    conn.execute('PRAGMA locking_mode=EXCLUSIVE;')
+    freq_defs = ', '.join(['{} REAL'.format(col) for col in freq_columns])
+    conn.execute('BEGIN;')
+    conn.execute('CREATE TEMP TABLE staging (chrom_int INT, pos INT, ref TEXT, alt TEXT, {});'\
+        .format(freq_defs))
+    placeholders = ', '.join(['?'] * (4 + len(freq_columns)))
+    conn.executemany('INSERT INTO staging VALUES ({});'.format(placeholders),
+                     _compile_records(records, len(freq_columns)))
+    conn.execute('DROP TABLE IF EXISTS {};'.format(table))
+    conn.execute('CREATE TABLE {} (chrom_int INT NOT NULL, pos INT NOT NULL, '\
+                 'ref TEXT NOT NULL, alt TEXT NOT NULL, {}, '\
+                 'PRIMARY KEY (chrom_int, pos, ref, alt)) WITHOUT ROWID;'\
+                 .format(table, freq_defs))
+    conn.execute('INSERT OR IGNORE INTO {} SELECT * FROM staging '\
+                 'ORDER BY chrom_int, pos, ref, alt, rowid;'.format(table))
+    conn.execute('DROP TABLE staging;')
+    conn.execute('COMMIT;')
+    conn.execute('ANALYZE;')
+    num_rows = conn.execute('SELECT count(*) FROM {};'.format(table)).fetchone()[0]
+    conn.close()
+    return num_rows
+
+def _compile_records(records, num_freqs):
+    for record in records:
+        chrom_int = chrom_to_int(record[0])
+        if chrom_int is None:
+            continue
+        yield (chrom_int, int(record[1]), record[2], record[3]) \
+            + tuple([to_float(v) for v in record[4:4 + num_freqs]])
+
+def compile_legacy_db(module_name, legacy_path, db_path):
+    """
+    Compiles an annotator's original text-typed database (as made with the
+    sqlite3 .import commands in its README) into the compiled format.
+    """
+    db_def = frequency_dbs[module_name]
+    legacy_conn = sqlite3.connect(legacy_path)
+    try:
+        records = legacy_conn.execute(db_def['legacy_query'])
+        return write_frequency_db(db_path, db_def['table'],
+                                  db_def['freq_columns'], records)
+    finally:
+        legacy_conn.close()
+
+def lift_frequency_table(db_path, table, freq_columns, lifted_table, chain_index,
+                         chunk_size=100000):
+    """
+    Lifts the compiled table in db_path with chain_index (a
+    liftover.ChainIndex) and writes the lifted variants to lifted_table of
+    the same database, replacing it. Variants are converted a chunk at a
+    time with liftover.lift_variants. Variants that do not lift, or lift to
+    contigs without a chrom_int, are left out. Returns (number of variants,
+    number of rows written).
+    """
+    counts = {'variants': 0}
+    records = _lift_records(db_path, table, freq_columns, chain_index,
+                            chunk_size, counts)
+    num_rows = write_frequency_db(db_path, lifted_table, freq_columns, records,
+                                  replace=False)
+    return counts['variants'], num_rows
+
+def _lift_records(db_path, table, freq_columns, chain_index, chunk_size, counts):
+    # Chunks are read by key ranges on a second connection, each with its
+    # own statement, so that the writing connection can take its lock once
+    # the table has been read.
+    conn = sqlite3.connect(db_path)
+    sql_q = 'SELECT chrom_int, pos, ref, alt, {} FROM {} '\
+            'WHERE (chrom_int, pos, ref, alt) > (?, ?, ?, ?) '\
+            'ORDER BY chrom_int, pos, ref, alt LIMIT ?;'\
+            .format(', '.join(freq_columns), table)
+    last_key = (0, 0, '', '')
+    try:
+        while True:
+            rows = conn.execute(sql_q, last_key + (chunk_size,)).fetchall()
+            if not rows:
+                break
+            last_key = tuple(rows[-1][:4])
+            counts['variants'] += len(rows)
+            lifted = lift_variants(chain_index,
+                                   [(int_to_chroms[row[0]], row[1], row[2], row[3])
+                                    for row in rows])
+            for row, variant in zip(rows, lifted):
+                if variant is not None:
+                    yield variant + tuple(row[4:])
+    finally:
+        conn.close()
+
+def variant_key(chrom_int, pos, ref, alt):
+    """
+    Bloom filter key of a variant.
+    """
+    return '{}:{}:{}>{}'.format(chrom_int, pos, ref, alt).encode()
+
+def get_filter_path(db_path, table):
+    """
+    Path of the Bloom filter of table in db_path, which is next to it.
+    """
+    return os.path.join(os.path.dirname(db_path), table + '.bloom')
+
+def write_frequency_filter(db_path, table, fp_rate=0.01, max_bytes=None):
+    """
+    Writes a Bloom filter of the variants of the compiled table in db_path
+    to get_filter_path(db_path, table), sized for fp_rate and at most
+    max_bytes (see BloomFilter.for_capacity). Returns the filter.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        num_rows = conn.execute('SELECT count(*) FROM {};'.format(table)).fetchone()[0]
+        bloom_filter = BloomFilter.for_capacity(num_rows, fp_rate=fp_rate,
+                                                max_bytes=max_bytes)
+        for row in conn.execute('SELECT chrom_int, pos, ref, alt FROM {};'.format(table)):
+            bloom_filter.add(variant_key(*row))
+    finally:
+        conn.close()
+    filter_path = get_filter_path(db_path, table)
+    tmp_path = filter_path + '.tmp'
+    bloom_filter.save(tmp_path)
+    os.rename(tmp_path, filter_path)
+    return bloom_filter
+
+def load_frequency_filter(conn, filter_path, table):
+    """
+    Returns the Bloom filter at filter_path, or None if there is none.
+    Raises ValueError if the filter does not have as many variants as table,
+    as when the database was rebuilt without it.
+    """
+    if not os.path.exists(filter_path):
+        return None
+    bloom_filter = BloomFilter.load(filter_path)
+    num_rows = conn.execute('SELECT count(*) FROM {};'.format(table)).fetchone()[0]
+    if num_rows != bloom_filter.num_keys:
+        raise ValueError('{} has {} variants, {} has {}'.format(filter_path,
+            bloom_filter.num_keys, table, num_rows))
+    return bloom_filter
+
+def query_frequency_regions(conn, table, freq_columns, regions):
+    """
+    Yields (chrom, pos, ref, alt, freq, ...) of the records of a compiled
+    table whose positions are in regions, (chrom, start, end) tuples in BED
+    coordinates (see regions.py), in chrom_int and position order.
+
+    Overlapping regions are merged, and each merged region is read with
+    one range seek on the table's primary key, so records in several
+    regions come once and no region scans the table.
+    """
+    int_regions = []
+    for chrom, start, end in regions:
+        chrom_int = chrom_to_int(chrom)
+        if chrom_int is not None:
+            int_regions.append((chrom_int, start, end))
+    sql_q = 'SELECT pos, ref, alt, {} FROM {} WHERE chrom_int=? AND pos>? AND pos<=? '\
+            'ORDER BY pos, ref, alt;'.format(', '.join(freq_columns), table)
+    for chrom_int, chrom_regions in sorted(merge_regions(int_regions).items()):
+        chrom = int_to_chroms[chrom_int]
+        for start, end in chrom_regions:
+            for row in conn.execute(sql_q, (chrom_int, start, end)):
+                yield (chrom,) + tuple(row)
+
+def allele_key(ref, alt):
+    """
+    Signed 64-bit hash of a ref/alt pair, used to key alleles in
+    FrequencyArrays, or None if either allele is None, as for input lines
+    with an empty allele. Such variants are never found, as with the
+    NULL comparison of a query.
+    """
+    if ref is None or alt is None:
+        return None
+    digest = hashlib.blake2b((ref + '>' + alt).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+class FrequencyArrays(object):
+    """
+    In-memory copy of a compiled frequency table, held in NumPy arrays.
+    Each chromosome has its positions (int32), allele_key hashes (int64) and
+    frequencies (float32, one column per frequency), sorted by position and
+    then key, and is searched with np.searchsorted.
+    """
+
+    def __init__(self, chroms, freq_columns):
+        # chrom_int -> (positions, keys, freqs)
+        self.chroms = chroms
+        self.freq_columns = freq_columns
+        self.num_rows = sum(len(arrays[0]) for arrays in chroms.values())
+        self.nbytes = sum(array.nbytes for arrays in chroms.values()
+                          for array in arrays)
+
+    @classmethod
+    def from_db(cls, conn, table, freq_columns):
+        if np is None:
+            raise ImportError('numpy is required for FrequencyArrays')
+        sql_q = 'SELECT chrom_int, pos, ref, alt, {} FROM {} ORDER BY chrom_int, pos;'\
+            .format(', '.join(freq_columns), table)
+        chroms = {}
+        for chrom_int, rows in _group_rows(conn.execute(sql_q)):
+            positions = np.fromiter((row[1] for row in rows), dtype=np.int32,
+                                    count=len(rows))
+            keys = np.fromiter((allele_key(row[2], row[3]) for row in rows),
+                               dtype=np.int64, count=len(rows))
+            freqs = np.array([row[4:] for row in rows], dtype=np.float32)\
+                .reshape(len(rows), len(freq_columns))
+            order = np.lexsort((keys, positions))
+            chroms[chrom_int] = (positions[order], keys[order], freqs[order])
+        return cls(chroms, freq_columns)
+
+    @classmethod
+    def from_store(cls, store_dir):
+        """
+        Opens a store written by write_frequency_store. The arrays are
+        memory-mapped read-only and each chromosome is a slice of them, so
+        nothing is copied into the process and jobs on the same host share
+        the OS page cache.
+        """
+        if np is None:
+            raise ImportError('numpy is required for FrequencyArrays')
+        with open(os.path.join(store_dir, 'index.json')) as f:
+            index = json.load(f)
+        arrays = [np.load(os.path.join(store_dir, name + '.npy'), mmap_mode='r')
+                  for name in ('positions', 'keys', 'freqs')]
+        chroms = {}
+        for chrom_int, (start, end) in index['chroms'].items():
+            chroms[int(chrom_int)] = tuple([array[start:end] for array in arrays])
+        return cls(chroms, index['freq_columns'])
+
+    def lookup(self, chrom_int, pos, ref, alt):
+        """
+        Returns the frequencies of a variant as a tuple of floats (None for
+        missing values), or None if the variant is absent.
+        """
+        arrays = self.chroms.get(chrom_int)
+        key = allele_key(ref, alt)
+        if arrays is None or pos is None or key is None:
+            return None
+        positions, keys, freqs = arrays
+        lo = positions.searchsorted(pos, 'left')
+        hi = positions.searchsorted(pos, 'right')
+        if lo == hi:
+            return None
+        for i in range(lo, hi):
+            if keys[i] == key:
+                return self.row_values(freqs[i])
+        return None
+
+    def lookup_many(self, chrom_ints, positions, refs, alts):
+        """
+        Vectorized lookup of many variants, given as equal length sequences.
+        Returns a list with a lookup() result for each variant.
+        """
+        keys = [allele_key(ref, alt) for ref, alt in zip(refs, alts)]
+        # Variants without a chromosome, position or allele key are under
+        # chrom_int -1, which has no arrays, so they are not found.
+        chrom_ints = np.array([-1 if c is None or pos is None or key is None else c
+                               for c, pos, key in zip(chrom_ints, positions, keys)],
+                              dtype=np.int64)
+        query_positions = np.array([0 if pos is None else pos for pos in positions],
+                                   dtype=np.int64)
+        query_keys = np.array([0 if key is None else key for key in keys],
+                              dtype=np.int64)
+        results = [None] * len(chrom_ints)
+        for chrom_int in np.unique(chrom_ints):
+            arrays = self.chroms.get(int(chrom_int))
+            if arrays is None:
+                continue
+            chrom_positions, chrom_keys, chrom_freqs = arrays
+            query_idxs = np.nonzero(chrom_ints == chrom_int)[0]
+            qpos = query_positions[query_idxs]
+            qkeys = query_keys[query_idxs]
+            lo = chrom_positions.searchsorted(qpos, 'left')
+            hi = chrom_positions.searchsorted(qpos, 'right')
+            found = np.full(len(query_idxs), -1, dtype=np.int64)
+            # Multi-allelic sites have several rows at a position. Step
+            # through them together for all queries.
+            for offset in range(int((hi - lo).max()) if len(lo) else 0):
+                idxs = lo + offset
+                candidates = (idxs < hi) & (found < 0)
+                candidates[candidates] = chrom_keys[idxs[candidates]] == qkeys[candidates]
+                found[candidates] = idxs[candidates]
+            for query_idx, row_idx in zip(query_idxs[found >= 0], found[found >= 0]):
+                results[query_idx] = self.row_values(chrom_freqs[row_idx])
+        return results
+
+    def row_values(self, freq_row):
+        # Shortest decimal repr of each float32, so that 0.1 stays 0.1
+        # instead of widening to 0.10000000149011612.
+        return tuple([None if np.isnan(v) else float(np.format_float_positional(v))
+                      for v in freq_row])
+
+def write_frequency_store(db_path, table, freq_columns, store_dir):
+    """
+    Writes the compiled table in db_path as a directory of .npy arrays
+    (positions, keys and freqs, sorted by chrom_int, position and key) and
+    an index.json of each chromosome's row range. Returns the number of
+    rows written.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        freq_arrays = FrequencyArrays.from_db(conn, table, freq_columns)
+    finally:
+        conn.close()
+    chrom_ints = sorted(freq_arrays.chroms.keys())
+    index = {'freq_columns': freq_columns, 'chroms': {}}
+    start = 0
+    for chrom_int in chrom_ints:
+        end = start + len(freq_arrays.chroms[chrom_int][0])
+        index['chroms'][str(chrom_int)] = [start, end]
+        start = end
+    # Written next to store_dir and moved into place at the end, so that
+    # running jobs never see a partial store.
+    tmp_dir = store_dir.rstrip(os.sep) + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for array_index, name in enumerate(('positions', 'keys', 'freqs')):
+        if chrom_ints:
+            array = np.concatenate([freq_arrays.chroms[chrom_int][array_index]
+                                    for chrom_int in chrom_ints])
+        else:
+            array = np.zeros((0, len(freq_columns)) if name == 'freqs' else 0,
+                             dtype=(np.int32, np.int64, np.float32)[array_index])
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+    return freq_arrays.num_rows
+
+def _group_rows(rows):
+    chrom_int = None
+    group = []
+    for row in rows:
+        if row[0] != chrom_int:
+            if group:
+                yield chrom_int, group
+            chrom_int = row[0]
+            group = []
+        group.append(row)
+    if group:
+        yield chrom_int, group
+
+def add_filter_arguments(parser):
+    """
+    Adds the Bloom filter size options to a build script's parser.
+    """
+    parser.add_argument('--fp-rate', dest='fp_rate', type=float, default=0.01,
+                        help='False positive rate of the Bloom filter. Default 0.01.')
+    parser.add_argument('--filter-max-kb', dest='filter_max_kb', type=int,
+                        help='Largest size of the Bloom filter in KiB, which '\
+                             +'raises its false positive rate if it is too small.')
+
+def write_filter_from_args(db_path, table, args):
+    """
+    write_frequency_filter with the options of add_filter_arguments, and
+    prints the filter's size.
+    """
+    max_bytes = args.filter_max_kb * 1024 if args.filter_max_kb else None
+    bloom_filter = write_frequency_filter(db_path, table, fp_rate=args.fp_rate,
+                                          max_bytes=max_bytes)
+    print('Bloom filter of {} written to {}: {} variants, {:0.1f} KiB, '\
+          '{:0.4f} false positive rate'.format(table, get_filter_path(db_path, table),
+        bloom_filter.num_keys, bloom_filter.nbytes / 1024,
+        bloom_filter.expected_fp_rate()))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build population frequency annotator data.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    compile_parser = subparsers.add_parser('compile',
+        help='Compile an original annotator database.')
+    compile_parser.add_argument('module', choices=sorted(frequency_dbs.keys()),
+                                help='Annotator the database is for.')
+    compile_parser.add_argument('legacy_db',
+                                help='Original sqlite database of the annotator.')
+    compile_parser.add_argument('output_db',
+                                help='Path of the compiled database.')
+    store_parser = subparsers.add_parser('store',
+        help='Write a compiled database as a memory-mapped store.')
+    store_parser.add_argument('module', choices=sorted(frequency_dbs.keys()),
+                              help='Annotator the database is for.')
+    store_parser.add_argument('db',
+                              help='Compiled sqlite database.')
+    store_parser.add_argument('store_dir',
+                              help='Directory to write the store to.')
+    lift_parser = subparsers.add_parser('lift',
+        help='Lift a compiled table to another assembly.')
+    lift_parser.add_argument('module', choices=sorted(frequency_dbs.keys()),
+                             help='Annotator the database is for.')
+    lift_parser.add_argument('db',
+                             help='Compiled sqlite database.')
+    lift_parser.add_argument('chain',
+                             help='UCSC chain file, plain or gzipped.')
+    lift_parser.add_argument('assembly',
+                             help='Assembly lifted to, such as hg38.')
+    filter_parser = subparsers.add_parser('filter',
+        help='Write the Bloom filter of a compiled table.')
+    filter_parser.add_argument('module', choices=sorted(frequency_dbs.keys()),
+                               help='Annotator the database is for.')
+    filter_parser.add_argument('db',
+                               help='Compiled sqlite database.')
+    filter_parser.add_argument('--table', dest='table',
+                               help='Table to filter. Default is the main table.')
+    add_filter_arguments(filter_parser)
+    args = parser.parse_args()
+    db_def = frequency_dbs[args.module]
+    if args.command == 'compile':
+        num_rows = compile_legacy_db(args.module, args.legacy_db, args.output_db)
+        print('{} rows written to {}'.format(num_rows, args.output_db))
+    elif args.command == 'store':
+        num_rows = write_frequency_store(args.db, db_def['table'],
+                                         db_def['freq_columns'], args.store_dir)
+        print('{} rows written to {}'.format(num_rows, args.store_dir))
+    elif args.command == 'lift':
+        lifted_table = db_def.get('assembly_tables', {}).get(args.assembly)
+        if lifted_table is None:
+            parser.error('no {} table is defined for {}'.format(args.assembly,
+                                                               args.module))
+        chain_index = ChainIndex.load(args.chain)
+        num_variants, num_rows = lift_frequency_table(args.db, db_def['table'],
+            db_def['freq_columns'], lifted_table, chain_index)
+        print('{} of {} variants lifted to {}'.format(num_rows, num_variants,
+                                                     lifted_table))
+    elif args.command == 'filter':
+        write_filter_from_args(args.db, args.table or db_def['table'], args)
+
+if __name__ == '__main__':
+    main()
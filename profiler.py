@@ -0,0 +1,215 @@
+"""
+Run profiler for BaseAnnotator (--profile).
+
+Stages are timed exclusively: time spent in a stage called from another
+stage (sqlite queries made in annotate, CravatReader parsing under
+_get_input) counts towards the inner stage only, so the stage times add up
+to the time spent in instrumented code.
+
+The report has, for a run:
+    stages     calls and seconds per stage
+    queries    calls and seconds per sqlite statement. Statements after the
+               first max_queries distinct ones are counted under '<other>'.
+    timeline   [seconds since start, line, lines/sec] samples
+    peak_rss_kb
+
+Stages are timed per thread, for the thread workers of --pipeline. The
+process workers of --pipeline are not profiled.
+"""
+import json
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class Profiler(object):
+
+    def __init__(self, max_queries=200, timeline_interval=1.0):
+        self.max_queries = max_queries
+        self.timeline_interval = timeline_interval
+        self.stages = {}
+        self.queries = {}
+        self.timeline = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+        self._last_tick_time = self.start_time
+        self._last_tick_lnum = 0
+
+    # Clears the stages, queries and timeline, as in a forked worker.
+    def reset(self):
+        self.stages = {}
+        self.queries = {}
+        self.timeline = []
+        self._local = threading.local()
+
+    # The stack of stages entered by the current thread, as
+    # [start time, time spent in inner stages].
+    def _get_stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _enter(self):
+        self._get_stack().append([time.perf_counter(), 0.0])
+
+    def _exit(self, stage, query=None):
+        stack = self._get_stack()
+        start, child_time = stack.pop()
+        elapsed = time.perf_counter() - start
+        if stack:
+            stack[-1][1] += elapsed
+        with self._lock:
+            self._add(self.stages, stage, elapsed - child_time)
+            if query is not None:
+                if query not in self.queries and len(self.queries) >= self.max_queries:
+                    query = '<other>'
+                self._add(self.queries, query, elapsed - child_time)
+
+    def _add(self, table, name, seconds):
+        entry = table.get(name)
+        if entry is None:
+            table[name] = [1, seconds]
+        else:
+            entry[0] += 1
+            entry[1] += seconds
+
+    # Returns func, timed as stage.
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            self._enter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit(stage)
+        return timed
+
+    # Returns func, which returns an iterator, with each step of the
+    # iterator timed as stage.
+    def wrap_iter(self, stage, func):
+        def timed(*args, **kwargs):
+            return self.time_iter(stage, func(*args, **kwargs))
+        return timed
+
+    def time_iter(self, stage, iterable):
+        it = iter(iterable)
+        while True:
+            self._enter()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self._exit(stage)
+            yield item
+
+    # Samples the throughput, at most once every timeline_interval seconds.
+    def tick(self, lnum):
+        cur_time = time.time()
+        if cur_time - self._last_tick_time < self.timeline_interval:
+            return
+        rate = (lnum - self._last_tick_lnum) / (cur_time - self._last_tick_time)
+        self.timeline.append([round(cur_time - self.start_time, 3), lnum, round(rate, 1)])
+        self._last_tick_time = cur_time
+        self._last_tick_lnum = lnum
+
+    # Adds the stages and queries of another report, such as a worker's.
+    def merge(self, report):
+        for table, entries in ((self.stages, report['stages']),
+                               (self.queries, report['queries'])):
+            for name, entry in entries.items():
+                if name not in table:
+                    table[name] = [0, 0.0]
+                table[name][0] += entry['calls']
+                table[name][1] += entry['seconds']
+
+    def get_peak_rss_kb(self):
+        if resource is None:
+            return None
+        peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                       resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+        if sys.platform == 'darwin':
+            peak_rss //= 1024
+        return peak_rss
+
+    def get_report(self):
+        def entries(table):
+            return {name: {'calls': entry[0], 'seconds': round(entry[1], 6)}
+                    for name, entry in sorted(table.items(),
+                                              key=lambda item: -item[1][1])}
+        return {'runtime': round(time.time() - self.start_time, 3),
+                'stages': entries(self.stages),
+                'queries': entries(self.queries),
+                'timeline': self.timeline,
+                'peak_rss_kb': self.get_peak_rss_kb()}
+
+    def get_summary(self):
+        report = self.get_report()
+        return {'runtime': report['runtime'],
+                'stages': {name: entry['seconds']
+                           for name, entry in report['stages'].items()},
+                'peak_rss_kb': report['peak_rss_kb']}
+
+    def write(self, path):
+        with open(path, 'w') as wf:
+            json.dump(self.get_report(), wf, indent=2)
+
+# Proxies a sqlite3 Connection or Cursor, timing statements as the 'sql'
+# stage of profiler and per statement. Fetching rows counts towards the
+# statement which produced them.
+class ProfilingCursor(object):
+
+    def __init__(self, target, profiler):
+        self._target = target
+        self._profiler = profiler
+        self._last_query = None
+
+    def _timed(self, query, func, *args):
+        self._profiler._enter()
+        try:
+            return func(*args)
+        finally:
+            self._profiler._exit('sql', query=query)
+
+    def execute(self, sql, *args):
+        self._last_query = sql
+        result = self._timed(sql, self._target.execute, sql, *args)
+        if result is self._target:
+            return self
+        return ProfilingCursor(result, self._profiler)._with_query(sql)
+
+    def executemany(self, sql, *args):
+        self._last_query = sql
+        self._timed(sql, self._target.executemany, sql, *args)
+        return self
+
+    def _with_query(self, sql):
+        self._last_query = sql
+        return self
+
+    def fetchone(self):
+        return self._timed(self._last_query, self._target.fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed(self._last_query, self._target.fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed(self._last_query, self._target.fetchall)
+
+    def cursor(self):
+        return ProfilingCursor(self._target.cursor(), self._profiler)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._timed(self._last_query, next, self._target)
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
@@ -0,0 +1,68 @@
+"""
+BED regions, for annotators' region queries (see BaseAnnotator's --regions
+and query_regions).
+
+Regions are (chrom, start, end) tuples with BED coordinates: start is
+0-based and end is exclusive, so a region holds the 1-based positions
+start + 1 to end. merge_regions sorts each chromosome's regions and joins
+the ones which overlap or touch, so that a query reads each record once
+however many regions it is in.
+
+    regions = read_bed('panel.bed')
+    for chrom, chrom_regions in merge_regions(regions).items():
+        for start, end in chrom_regions:
+            ...
+"""
+import gzip
+
+def _open_bed(path):
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt')
+    return open(path)
+
+def read_bed(path):
+    """
+    Returns the regions of a BED file, plain or gzipped, as (chrom, start,
+    end) tuples. Header, track, browser and comment lines are skipped.
+    Raises ValueError for lines without a valid start and end.
+    """
+    regions = []
+    with _open_bed(path) as f:
+        for lnum, line in enumerate(f, 1):
+            toks = line.split()
+            if not toks or toks[0].startswith('#') or toks[0] in ('track', 'browser'):
+                continue
+            try:
+                start, end = int(toks[1]), int(toks[2])
+            except (IndexError, ValueError):
+                raise ValueError('{} line {}: not a BED region'.format(path, lnum))
+            if start < 0 or end < start:
+                raise ValueError('{} line {}: invalid region {}-{}'.format(path, lnum,
+                                                                         start, end))
+            regions.append((toks[0], start, end))
+    return regions
+
+def merge_regions(regions):
+    """
+    Returns {chrom: [(start, end), ...]} of regions, each chromosome's
+    regions sorted and merged. Empty regions are left out.
+    """
+    chrom_regions = {}
+    for chrom, start, end in regions:
+        if end > start:
+            chrom_regions.setdefault(chrom, []).append((start, end))
+    merged = {}
+    for chrom, chrom_list in chrom_regions.items():
+        chrom_list.sort()
+        merged_list = [chrom_list[0]]
+        for start, end in chrom_list[1:]:
+            last_start, last_end = merged_list[-1]
+            if start <= last_end:
+                if end > last_end:
+                    merged_list[-1] = (last_start, end)
+            else:
+                merged_list.append((start, end))
+        merged[chrom] = merged_list
+    return merged
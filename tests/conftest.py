@@ -0,0 +1,87 @@
+"""
+Fixtures for tests which run annotators: copies of the repository's
+modules with the benchmark fixture databases, and a synthetic input.
+"""
+import os
+import sys
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class StubStatusWriter(object):
+
+    def __init__(self):
+        self.updates = []
+
+    def queue_status_update(self, k, v, force=False):
+        self.updates.append((k, v))
+
+    def add_annotator_version_to_status_json(self, annotator_name, version):
+        self.updates.append(('version', annotator_name, version))
+
+class ModuleSet(object):
+    """
+    Module copies in modules_dir, with a crv input of num_variants lines.
+    """
+
+    def __init__(self, modules_dir, input_path, db_variants, variants):
+        self.modules_dir = modules_dir
+        self.input_path = input_path
+        self.db_variants = db_variants
+        self.variants = variants
+
+    def main(self, module_name):
+        return os.path.join(self.modules_dir, module_name, module_name + '.py')
+
+    def load_module(self, module_name):
+        import importlib.util
+        spec = importlib.util.spec_from_file_location(module_name, self.main(module_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def make_annotator(self, module_name, output_dir, *args, annotator_class=None):
+        if annotator_class is None:
+            annotator_class = self.load_module(module_name).CravatAnnotator
+        cmd_args = [self.main(module_name), self.input_path, '-d', str(output_dir),
+                    '-n', 'job'] + list(args)
+        return annotator_class(cmd_args, StubStatusWriter())
+
+@pytest.fixture
+def modules(tmp_path, monkeypatch):
+    """
+    abraom and hgdp with fixture databases, read with their module confs
+    and the job conf given with -c.
+    """
+    yaml = pytest.importorskip('yaml')
+    sys.path.insert(0, os.path.join(repo_dir, 'benchmarks'))
+    try:
+        import fixtures
+        import run_benchmarks
+    finally:
+        sys.path.pop(0)
+    from cravat import base_annotator
+    work_dir = str(tmp_path / 'modules')
+    db_variants = fixtures.make_db_variants(2000, seed=0)
+    variants = fixtures.make_input_variants(db_variants, 3000, hit_rate=0.5, seed=1)
+    for module_name in ('abraom', 'hgdp'):
+        run_benchmarks.prepare_module(module_name, work_dir, db_variants, [], 0.5)
+    input_path = os.path.join(work_dir, 'input.crv')
+    fixtures.write_crv(input_path, variants)
+
+    class ModuleConfigLoader(object):
+
+        def __init__(self, job_conf_path=None):
+            self.job_conf = {}
+            if job_conf_path:
+                with open(job_conf_path) as f:
+                    self.job_conf = yaml.safe_load(f) or {}
+
+        def get_module_conf(self, module_name):
+            with open(os.path.join(work_dir, module_name, module_name + '.yml')) as f:
+                conf = yaml.safe_load(f)
+            conf.update(self.job_conf.get(module_name) or {})
+            return conf
+
+    monkeypatch.setattr(base_annotator, 'ConfigLoader', ModuleConfigLoader)
+    return ModuleSet(work_dir, input_path, db_variants, variants)
@@ -0,0 +1,105 @@
+"""
+Tests of the persistent result cache: entries are found again by later
+runs, and only while the annotator's version, conf and data are unchanged.
+"""
+import logging
+import os
+import pytest
+from cravat.annotation_cache import PersistentCache
+from cravat.annotation_cache import ResultCache
+from cravat.base_annotator import BaseAnnotator
+
+key = ('chr1', 100, 'A', 'G')
+result = {'af': 0.25}
+
+@pytest.fixture
+def module_dir(tmp_path):
+    data_dir = tmp_path / 'module' / 'data'
+    data_dir.mkdir(parents=True)
+    (data_dir / 'test.sqlite').write_bytes(b'database')
+    return tmp_path / 'module'
+
+def make_annotator(module_dir, cache_path, version='1.0.0', **conf):
+    # An annotator with only what _setup_result_cache uses.
+    annotator = BaseAnnotator.__new__(BaseAnnotator)
+    annotator.annotator_name = 'test'
+    annotator.data_dir = str(module_dir / 'data')
+    annotator.db_pool = None
+    annotator.logger = logging.getLogger('cravat.test')
+    annotator.conf = {'version': version,
+                      'input_columns': ['uid', 'chrom', 'pos', 'ref_base', 'alt_base'],
+                      'cache': {'persistent': {'path': str(cache_path)}}}
+    annotator.conf.update(conf)
+    annotator._setup_result_cache()
+    return annotator
+
+def fill(annotator):
+    annotator.persistent_cache.put(key, result)
+    annotator.persistent_cache.close()
+
+def lookup(annotator):
+    found = annotator.persistent_cache.get(key)
+    annotator.persistent_cache.close()
+    return found
+
+def test_hit_in_later_run(tmp_path, module_dir):
+    cache_path = tmp_path / 'cache.sqlite'
+    fill(make_annotator(module_dir, cache_path))
+    assert lookup(make_annotator(module_dir, cache_path)) == result
+
+def test_version_change_invalidates(tmp_path, module_dir):
+    cache_path = tmp_path / 'cache.sqlite'
+    fill(make_annotator(module_dir, cache_path, version='1.0.0'))
+    assert lookup(make_annotator(module_dir, cache_path, version='1.0.1')) \
+        is ResultCache.missing
+    assert lookup(make_annotator(module_dir, cache_path, version='1.0.0')) == result
+
+def test_data_change_invalidates(tmp_path, module_dir):
+    cache_path = tmp_path / 'cache.sqlite'
+    fill(make_annotator(module_dir, cache_path))
+    db_path = str(module_dir / 'data' / 'test.sqlite')
+    stat = os.stat(db_path)
+    # Same size, newer modification time, as a rebuilt database would be.
+    os.utime(db_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert lookup(make_annotator(module_dir, cache_path)) is ResultCache.missing
+
+def test_new_data_file_invalidates(tmp_path, module_dir):
+    cache_path = tmp_path / 'cache.sqlite'
+    fill(make_annotator(module_dir, cache_path))
+    (module_dir / 'data' / 'test.bloom').write_bytes(b'filter')
+    assert lookup(make_annotator(module_dir, cache_path)) is ResultCache.missing
+
+def test_conf_change_invalidates(tmp_path, module_dir):
+    cache_path = tmp_path / 'cache.sqlite'
+    fill(make_annotator(module_dir, cache_path, assembly='hg19'))
+    assert lookup(make_annotator(module_dir, cache_path, assembly='hg38')) \
+        is ResultCache.missing
+
+def test_neutral_conf_change_keeps_entries(tmp_path, module_dir):
+    cache_path = tmp_path / 'cache.sqlite'
+    fill(make_annotator(module_dir, cache_path, batch_size=1000))
+    assert lookup(make_annotator(module_dir, cache_path, batch_size=10,
+                                 logging_level='info')) == result
+
+def test_sqlite_side_files_ignored(tmp_path, module_dir):
+    cache_path = tmp_path / 'cache.sqlite'
+    fill(make_annotator(module_dir, cache_path))
+    (module_dir / 'data' / 'test.sqlite-wal').write_bytes(b'wal')
+    assert lookup(make_annotator(module_dir, cache_path)) == result
+
+def test_eviction_keeps_cache_under_max_size(tmp_path):
+    cache_path = str(tmp_path / 'cache.sqlite')
+    max_bytes = 256 * 1024
+    cache = PersistentCache(cache_path, PersistentCache.make_namespace('test'),
+                            max_bytes)
+    for i in range(20000):
+        cache.put(('chr1', i), {'value': 'x' * 50})
+    cache.close()
+    cache = PersistentCache(cache_path, PersistentCache.make_namespace('test'),
+                            max_bytes)
+    conn = cache._get_conn()
+    assert cache._get_used_bytes(conn) <= max_bytes
+    # The most recently written entries are kept.
+    assert cache.get(('chr1', 19999)) == {'value': 'x' * 50}
+    assert cache.get(('chr1', 0)) is ResultCache.missing
+    cache.close()
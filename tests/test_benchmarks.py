@@ -0,0 +1,41 @@
+"""
+Runs the benchmark harness on a small input, so that every module still
+runs with the fixture databases and default arguments.
+"""
+import json
+import os
+import subprocess
+import sys
+import pytest
+
+pytest.importorskip('yaml')
+
+benchmark_script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'benchmarks', 'run_benchmarks.py')
+
+def run_harness(tmp_path, *args):
+    output_path = str(tmp_path / 'results.json')
+    subprocess.check_call([sys.executable, benchmark_script, '--variants', '300',
+                           '--genes', '50', '--work-dir', str(tmp_path / 'work'),
+                           '-o', output_path] + list(args),
+                          stdout=subprocess.DEVNULL)
+    with open(output_path) as f:
+        return json.load(f)
+
+def test_default_arguments(tmp_path):
+    results = run_harness(tmp_path)
+    assert sorted([result['module'] for result in results]) \
+        == ['RNAseq', 'abraom', 'genelists', 'hgdp']
+    for result in results:
+        assert result['variants_per_sec'] > 0
+    # Every input line was annotated.
+    work_dir = tmp_path / 'work'
+    for module_name in ('abraom', 'hgdp'):
+        output_path = work_dir / (module_name + '_output') / 'bench.{}.var'.format(module_name)
+        with open(str(output_path)) as f:
+            assert len([l for l in f if not l.startswith('#')]) == 300
+
+def test_module_args(tmp_path):
+    results = run_harness(tmp_path, '--modules', 'abraom', 'hgdp', '--order', 'sorted',
+                          '--', '--sorted')
+    assert len(results) == 2
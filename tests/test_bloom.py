@@ -0,0 +1,137 @@
+"""
+Tests of the Bloom filters which let annotators skip lookups of variants
+which are not in their database.
+"""
+import random
+import sqlite3
+import pytest
+from cravat import bloom
+from cravat.bloom import BloomFilter
+from cravat.popfreq_db import chrom_to_int
+from cravat.popfreq_db import load_frequency_filter
+from cravat.popfreq_db import variant_key
+from cravat.popfreq_db import write_frequency_db
+from cravat.popfreq_db import write_frequency_filter
+
+def make_keys(num_keys, seed):
+    rnd = random.Random(seed)
+    return [variant_key(rnd.randint(1, 25), rnd.randrange(1, 250000000),
+                        rnd.choice('ACGT'), rnd.choice('ACGT'))
+            for _ in range(num_keys)]
+
+@pytest.fixture(params=['numpy', 'no numpy'])
+def use_numpy(request, monkeypatch):
+    if request.param == 'no numpy':
+        monkeypatch.setattr(bloom, 'np', None)
+    elif bloom.np is None:
+        pytest.skip('numpy is not installed')
+
+@pytest.mark.parametrize('fp_rate, max_bytes', [(0.01, None), (0.001, None),
+                                                (0.01, 64), (0.5, None)])
+def test_no_false_negatives(use_numpy, fp_rate, max_bytes):
+    keys = make_keys(5000, seed=1)
+    bloom_filter = BloomFilter.for_capacity(len(keys), fp_rate=fp_rate,
+                                            max_bytes=max_bytes)
+    for key in keys:
+        bloom_filter.add(key)
+    assert all(key in bloom_filter for key in keys)
+    assert bloom_filter.contains_many(keys) == [True] * len(keys)
+    if max_bytes is not None:
+        assert bloom_filter.nbytes <= max_bytes
+
+def test_contains_many_matches_contains(use_numpy):
+    bloom_filter = BloomFilter.for_capacity(1000, fp_rate=0.05)
+    for key in make_keys(1000, seed=2):
+        bloom_filter.add(key)
+    queries = make_keys(5000, seed=3)
+    assert bloom_filter.contains_many(queries) == [key in bloom_filter for key in queries]
+    assert bloom_filter.contains_many([]) == []
+
+def test_false_positive_rate():
+    keys = make_keys(20000, seed=4)
+    bloom_filter = BloomFilter.for_capacity(len(keys), fp_rate=0.01)
+    for key in keys:
+        bloom_filter.add(key)
+    absent = set(make_keys(20000, seed=5)) - set(keys)
+    fp_rate = sum(key in bloom_filter for key in absent) / len(absent)
+    assert fp_rate < 0.02
+    assert bloom_filter.expected_fp_rate() == pytest.approx(0.01, rel=0.2)
+
+def test_save_and_load(tmp_path):
+    keys = make_keys(3000, seed=6)
+    bloom_filter = BloomFilter.for_capacity(len(keys))
+    for key in keys:
+        bloom_filter.add(key)
+    path = str(tmp_path / 'test.bloom')
+    bloom_filter.save(path)
+    loaded = BloomFilter.load(path)
+    assert (loaded.num_bits, loaded.num_hashes, loaded.num_keys) \
+        == (bloom_filter.num_bits, bloom_filter.num_hashes, len(keys))
+    assert loaded.bits == bloom_filter.bits
+    assert all(key in loaded for key in keys)
+
+def test_load_bad_files(tmp_path):
+    path = tmp_path / 'test.bloom'
+    path.write_bytes(b'CRVBL')
+    with pytest.raises(ValueError):
+        BloomFilter.load(str(path))
+    path.write_bytes(b'NOTBLOOM' + bytes(40))
+    with pytest.raises(ValueError):
+        BloomFilter.load(str(path))
+    bloom_filter = BloomFilter.for_capacity(100)
+    bloom_filter.save(str(path))
+    path.write_bytes(path.read_bytes()[:-1])
+    with pytest.raises(ValueError):
+        BloomFilter.load(str(path))
+
+def test_invalid_sizes():
+    with pytest.raises(ValueError):
+        BloomFilter.for_capacity(100, fp_rate=0)
+    with pytest.raises(ValueError):
+        BloomFilter.for_capacity(100, fp_rate=1)
+    with pytest.raises(ValueError):
+        BloomFilter.for_capacity(100, max_bytes=0)
+
+def test_frequency_filter(tmp_path):
+    rnd = random.Random(7)
+    records = set()
+    while len(records) < 2000:
+        records.add(('chr' + rnd.choice(['1', '2', 'X']), rnd.randrange(1, 1000000),
+                     rnd.choice('ACGT'), rnd.choice('ACGT')))
+    records = sorted(records)
+    db_path = str(tmp_path / 'test.sqlite')
+    write_frequency_db(db_path, 'test', ['af'],
+                       [record + ('0.1',) for record in records])
+    write_frequency_filter(db_path, 'test')
+    conn = sqlite3.connect(db_path)
+    bloom_filter = load_frequency_filter(conn, str(tmp_path / 'test.bloom'), 'test')
+    keys = [variant_key(chrom_to_int(chrom), pos, ref, alt)
+            for chrom, pos, ref, alt in records]
+    assert bloom_filter.contains_many(keys) == [True] * len(keys)
+    # Rebuilding the table removes its filter, and a filter of another
+    # build of the table is refused.
+    filter_data = (tmp_path / 'test.bloom').read_bytes()
+    write_frequency_db(db_path, 'test', ['af'],
+                       [record + ('0.1',) for record in records[:-1]])
+    assert not (tmp_path / 'test.bloom').exists()
+    (tmp_path / 'test.bloom').write_bytes(filter_data)
+    conn = sqlite3.connect(db_path)
+    with pytest.raises(ValueError):
+        load_frequency_filter(conn, str(tmp_path / 'test.bloom'), 'test')
+    assert load_frequency_filter(conn, str(tmp_path / 'none.bloom'), 'test') is None
+
+def test_rebuild_removes_filters(tmp_path):
+    # As a build script run again with --no-filter, after a run with the
+    # filters of the table and its lifted table.
+    records = [('chr1', pos, 'A', 'G', '0.1') for pos in range(1, 100)]
+    db_path = str(tmp_path / 'test.sqlite')
+    write_frequency_db(db_path, 'test', ['af'], records)
+    write_frequency_db(db_path, 'test_hg38', ['af'], records, replace=False)
+    write_frequency_filter(db_path, 'test')
+    write_frequency_filter(db_path, 'test_hg38')
+    other_filter = tmp_path / 'other.bloom'
+    other_filter.write_bytes((tmp_path / 'test.bloom').read_bytes())
+    write_frequency_db(db_path, 'test', ['af'], [record[:1] + (record[1] + 1,) + record[2:]
+                                                 for record in records])
+    assert sorted(path.name for path in tmp_path.iterdir()) \
+        == ['other.bloom', 'test.sqlite']
@@ -0,0 +1,98 @@
+"""
+Round trip tests of the columnar output format, including the files
+appended together by --workers.
+"""
+import pytest
+from cravat.columnar import ColumnarReader
+from cravat.columnar import ColumnarWriter
+
+col_defs = [{'name': 'uid', 'title': 'UID', 'type': 'int'},
+            {'name': 'freq', 'title': 'Frequency', 'type': 'float'},
+            {'name': 'note', 'title': 'Note', 'type': 'string', 'width': 40}]
+
+rows = [(1, 0.25, 'plain'),
+        (2, None, None),
+        (3, 0.0, ''),
+        (-(2 ** 62), 1e-300, 'ünïcødé ✓'),
+        (2 ** 62, -3.5, 'tab\tin value'),
+        (6, 1.0, 'x' * 1000),
+        (7, 2.5, None)]
+# Empty strings are read back as None, as CravatReader reads empty fields.
+read_rows = [tuple(None if value == '' else value for value in row) for row in rows]
+
+def write(path, rows, include_definition=True, **kwargs):
+    writer = ColumnarWriter(str(path), include_definition=include_definition, **kwargs)
+    for col_index, col_def in enumerate(col_defs):
+        writer.add_column(col_index, col_def)
+    writer.write_meta_line('name', 'test')
+    writer.write_meta_line('displayname', 'Test')
+    writer.write_definition()
+    writer.write_titles()
+    for row in rows:
+        writer.write_data(dict(zip(['uid', 'freq', 'note'], row)))
+    writer.close()
+
+@pytest.mark.parametrize('compression', ['zlib', None])
+@pytest.mark.parametrize('block_rows', [1, 3, 65536])
+def test_round_trip(tmp_path, compression, block_rows):
+    path = tmp_path / 'test.var.col'
+    write(path, rows, compression=compression, block_rows=block_rows)
+    reader = ColumnarReader(str(path))
+    assert reader.get_column_names() == ['uid', 'freq', 'note']
+    assert reader.columns[2]['width'] == 40
+    assert (reader.annotator_name, reader.annotator_displayname) == ('test', 'Test')
+    assert list(reader.loop_rows()) == read_rows
+    assert [len(block['uid']) for block in reader.loop_blocks()] \
+        == [min(block_rows, len(rows) - start) for start in range(0, len(rows), block_rows)]
+    assert [(lnum, line, data) for lnum, line, data in reader.loop_data()][1] \
+        == (2, None, {'uid': 2, 'freq': None, 'note': None})
+
+def test_no_rows(tmp_path):
+    path = tmp_path / 'test.var.col'
+    write(path, [])
+    reader = ColumnarReader(str(path))
+    assert reader.get_column_names() == ['uid', 'freq', 'note']
+    assert list(reader.loop_rows()) == []
+
+def test_appended_blocks(tmp_path):
+    # As --workers does: the first file has the definition, and the
+    # workers' files, with blocks only, are appended to it.
+    parts = [rows[:2], rows[2:3], [], rows[3:]]
+    path = tmp_path / 'test.var.col'
+    write(path, parts[0], block_rows=2)
+    with open(str(path), 'ab') as wf:
+        for i, part in enumerate(parts[1:]):
+            part_path = tmp_path / '{}.out'.format(i)
+            write(part_path, part, include_definition=False, block_rows=2)
+            wf.write(part_path.read_bytes())
+    assert list(ColumnarReader(str(path)).loop_rows()) == read_rows
+
+def test_not_columnar(tmp_path):
+    path = tmp_path / 'test.var'
+    path.write_text('#name=test\n')
+    with pytest.raises(Exception):
+        ColumnarReader(str(path))
+
+def test_invalid_type(tmp_path):
+    writer = ColumnarWriter(str(tmp_path / 'test.var.col'))
+    with pytest.raises(Exception):
+        writer.add_column(0, {'name': 'x', 'title': 'X', 'type': 'blob'})
+    writer.close()
+
+def test_workers_run(modules, tmp_path):
+    from cravat.inout import CravatReader
+    conf_path = tmp_path / 'job.yml'
+    conf_path.write_text('abraom:\n  columnar_block_rows: 100\n')
+    modules.make_annotator('abraom', tmp_path / 'text', '-c', str(conf_path)).run()
+    for name, args in [('single', []), ('workers', ['--workers', '3'])]:
+        modules.make_annotator('abraom', tmp_path / name, '-c', str(conf_path),
+                               '--output-format', 'columnar', *args).run()
+    text_reader = CravatReader(str(tmp_path / 'text' / 'job.abraom.var'))
+    text_rows = [(data['uid'], data['allele_freq']) for _, _, data in text_reader.loop_data()]
+    single_rows = list(ColumnarReader(str(tmp_path / 'single' / 'job.abraom.var.col')).loop_rows())
+    worker_reader = ColumnarReader(str(tmp_path / 'workers' / 'job.abraom.var.col'))
+    assert list(worker_reader.loop_rows()) == single_rows
+    # Each of the workers wrote blocks of its own.
+    assert len(list(worker_reader.loop_blocks())) >= 3
+    assert len(single_rows) == len(modules.variants)
+    assert [(row[0], row[1]) for row in single_rows] == text_rows
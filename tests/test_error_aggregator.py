@@ -0,0 +1,131 @@
+"""
+Tests of runtime error aggregation, and of merging the errors of several
+workers as --workers and process pipelines do.
+"""
+import json
+import pickle
+from cravat.error_aggregator import ErrorAggregator
+from cravat.error_aggregator import WorkerError
+
+def raise_key_error(lnum):
+    raise KeyError('missing {}'.format(lnum))
+
+def raise_value_error(lnum):
+    raise ValueError('bad {}'.format(lnum))
+
+def add_raised(aggregator, func, lnum):
+    try:
+        func(lnum)
+    except Exception as e:
+        return aggregator.add(e, lnum=lnum)
+
+def add_error(aggregator, error_num, lnum):
+    # Distinct errors, by location.
+    return aggregator.add_formatted('KeyError', 'module.py:{} (annotate)'.format(error_num),
+                                    'error {}'.format(error_num),
+                                    lambda: 'Traceback {}'.format(error_num), lnum=lnum)
+
+def test_add_groups_by_type_and_location():
+    aggregator = ErrorAggregator(max_samples=2)
+    results = [add_raised(aggregator, raise_key_error, lnum) for lnum in range(1, 6)]
+    add_raised(aggregator, raise_value_error, 6)
+    assert len(aggregator.errors) == 2
+    assert aggregator.num_lines == 6
+    assert [(is_new, is_sample) for _, is_new, is_sample in results] \
+        == [(True, True), (False, True), (False, False), (False, False), (False, False)]
+    error = results[0][0]
+    assert error['count'] == 5
+    assert error['type'] == 'KeyError'
+    assert 'raise_key_error' in error['location']
+    assert 'Traceback' in error['traceback']
+    assert [lnum for lnum, _ in error['samples']] == [1, 2]
+
+def test_add_past_max_errors():
+    aggregator = ErrorAggregator(max_samples=3, max_errors=2)
+    for lnum in range(10):
+        add_error(aggregator, lnum % 5, lnum)
+    assert len(aggregator.errors) == 3
+    other = aggregator.errors['other']
+    assert (other['type'], other['count'], len(other['samples'])) == ('Other', 6, 3)
+    assert sum(error['count'] for error in aggregator.errors.values()) == 10
+
+def make_worker_states(num_workers, lines_per_worker, num_errors):
+    states = []
+    for worker in range(num_workers):
+        aggregator = ErrorAggregator(max_samples=3, max_errors=4)
+        for i in range(lines_per_worker):
+            lnum = worker * lines_per_worker + i
+            add_error(aggregator, (worker * 3 + i) % num_errors, lnum)
+        # Sent through a file, as by --workers shards.
+        states.append(json.loads(json.dumps(aggregator.get_state())))
+    return states
+
+def test_merge_workers_past_max_errors_and_samples():
+    states = make_worker_states(num_workers=4, lines_per_worker=50, num_errors=12)
+    merged = ErrorAggregator(max_samples=3, max_errors=4)
+    for state in states:
+        merged.merge(state)
+    assert merged.num_lines == 200
+    assert len(merged.errors) == 5
+    assert 'other' in merged.errors
+    assert sum(error['count'] for error in merged.errors.values()) == 200
+    for error in merged.errors.values():
+        assert len(error['samples']) <= 3
+    # The first worker's errors are kept, the rest counted with other.
+    assert set(merged.errors) - set(['other']) == set(states[0]['errors']) - set(['other'])
+    assert merged.errors['other']['type'] == 'Other'
+    assert merged.errors['other']['location'] == ''
+
+def test_merge_does_not_change_worker_states():
+    states = make_worker_states(num_workers=2, lines_per_worker=5, num_errors=2)
+    before = json.dumps(states, sort_keys=True)
+    merged = ErrorAggregator(max_samples=3, max_errors=4)
+    for state in states:
+        merged.merge(state)
+    add_error(merged, 0, 1000)
+    assert json.dumps(states, sort_keys=True) == before
+
+def test_merge_same_as_one_process():
+    # Workers with the errors of one run, split by line, merge into the
+    # counts of the run made in one process.
+    single = ErrorAggregator(max_samples=2)
+    workers = [ErrorAggregator(max_samples=2) for _ in range(3)]
+    for lnum in range(30):
+        add_error(single, lnum % 4, lnum)
+        add_error(workers[lnum // 10], lnum % 4, lnum)
+    merged = ErrorAggregator(max_samples=2)
+    for worker in workers:
+        merged.merge(worker.get_state())
+    assert merged.get_state() == single.get_state()
+    assert merged.get_summary_lines() == single.get_summary_lines()
+
+def test_worker_error():
+    try:
+        raise_value_error(7)
+    except Exception as e:
+        original = e
+        worker_error = pickle.loads(pickle.dumps(WorkerError.from_exception(e)))
+    worker_aggregator = ErrorAggregator()
+    error, is_new, _ = worker_aggregator.add(worker_error, lnum=7)
+    aggregator = ErrorAggregator()
+    original_error, _, _ = aggregator.add(original, lnum=7)
+    assert is_new
+    assert set(worker_aggregator.errors) == set(aggregator.errors)
+    assert (error['type'], error['location'], error['message']) \
+        == (original_error['type'], original_error['location'], original_error['message'])
+    assert error['traceback'] == original_error['traceback']
+    # Later errors are sent without the traceback.
+    repeat = WorkerError.from_exception(original, include_traceback=False)
+    error, is_new, _ = worker_aggregator.add(repeat, lnum=8)
+    assert not is_new
+    assert error['count'] == 2
+
+def test_summary_lines():
+    aggregator = ErrorAggregator(max_samples=2)
+    for lnum in range(1, 4):
+        add_error(aggregator, 1, lnum)
+    add_error(aggregator, 2, 4)
+    lines = aggregator.get_summary_lines()
+    assert lines[0] == '4 lines failed with 2 distinct errors'
+    assert '3 lines: KeyError at module.py:1 (annotate): error 1 (first lines 1, 2)' in lines[1]
+    assert '1 lines: KeyError at module.py:2 (annotate)' in lines[2]
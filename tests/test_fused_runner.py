@@ -0,0 +1,60 @@
+"""
+Tests that fused runs write the same output as separate runs of each
+annotator, and that a failing annotator does not stop the others.
+"""
+import filecmp
+import os
+import pytest
+from cravat.fused_runner import FusedRunner
+
+module_names = ['abraom', 'hgdp']
+
+def output_path(output_dir, module_name, output_format):
+    path = os.path.join(str(output_dir), 'job.{}.var'.format(module_name))
+    if output_format == 'columnar':
+        path += '.col'
+    return path
+
+@pytest.mark.parametrize('output_format', ['text', 'columnar'])
+@pytest.mark.parametrize('job_conf', ['', 'abraom:\n  batch_size: 1\n',
+                                      'abraom:\n  fast_rows: true\nhgdp:\n  cache: true\n'])
+def test_same_output_as_separate_runs(modules, tmp_path, output_format, job_conf):
+    conf_path = tmp_path / 'job.yml'
+    conf_path.write_text(job_conf or '{}\n')
+    args = ['-c', str(conf_path), '--output-format', output_format]
+    for module_name in module_names:
+        modules.make_annotator(module_name, tmp_path / 'separate', *args).run()
+    annotators = [modules.make_annotator(module_name, tmp_path / 'fused', *args)
+                  for module_name in module_names]
+    FusedRunner(annotators).run()
+    for module_name in module_names:
+        assert filecmp.cmp(output_path(tmp_path / 'separate', module_name, output_format),
+                           output_path(tmp_path / 'fused', module_name, output_format),
+                           shallow=False)
+
+def test_failing_annotator(modules, tmp_path):
+    for module_name in module_names:
+        modules.make_annotator(module_name, tmp_path / 'separate').run()
+    abraom = modules.make_annotator('abraom', tmp_path / 'fused')
+    hgdp = modules.make_annotator('hgdp', tmp_path / 'fused')
+    # abraom fails on its third block, outside of any one line.
+    calls = []
+    annotate_chunk = abraom._annotate_chunk
+    annotate_row = abraom._annotate_row
+    def failing(annotate):
+        def wrapper(*args):
+            calls.append(1)
+            if len(calls) == 3:
+                raise RuntimeError('abraom broke')
+            return annotate(*args)
+        return wrapper
+    abraom._annotate_chunk = failing(annotate_chunk)
+    abraom._annotate_row = failing(annotate_row)
+    with pytest.raises(Exception) as exc_info:
+        FusedRunner([abraom, hgdp], block_size=500).run()
+    assert 'abraom' in str(exc_info.value)
+    assert 'hgdp' not in str(exc_info.value)
+    assert filecmp.cmp(output_path(tmp_path / 'separate', 'hgdp', 'text'),
+                       output_path(tmp_path / 'fused', 'hgdp', 'text'), shallow=False)
+    with open(os.path.join(str(tmp_path / 'fused'), 'job.log')) as f:
+        assert 'abraom broke' in f.read()
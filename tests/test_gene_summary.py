@@ -0,0 +1,124 @@
+"""
+Tests of per-gene summaries: the incremental gene_summary_init/fold/finish
+hooks, finished in worker processes, and the build_gene_collection path.
+"""
+import asyncio
+import os
+import random
+import pytest
+from cravat.base_annotator import BaseAnnotator
+
+class VariantSource(object):
+    """
+    Stands in for the cravat filter, with get_variant_iterator_filtered_uids_cols.
+    """
+
+    def __init__(self, variants):
+        self.variants = variants
+        self.cols = None
+
+    async def get_variant_iterator_filtered_uids_cols(self, cols):
+        self.cols = cols
+        for d in self.variants:
+            yield dict(d)
+
+def make_variants(num_variants, num_genes, seed=0):
+    rnd = random.Random(seed)
+    variants = []
+    for _ in range(num_variants):
+        hugo = 'GENE{}'.format(rnd.randrange(num_genes)) if rnd.random() < 0.95 else None
+        variants.append({'hugo': hugo, 'score': round(rnd.random(), 3),
+                         'pos': rnd.randrange(1, 1000)})
+    return variants
+
+def make_annotator(annotator_class, **conf):
+    annotator = annotator_class.__new__(annotator_class)
+    annotator.annotator_name = 'test'
+    annotator.conf = {'output_columns': [{'name': 'uid'}, {'name': 'score'},
+                                         {'name': 'pos'}]}
+    annotator.conf.update(conf)
+    return annotator
+
+class FoldingAnnotator(BaseAnnotator):
+    # Count, sum and distinct positions of each gene. Genes with one
+    # variant have no summary.
+
+    def gene_summary_init(self, hugo):
+        return [0, 0.0, set()]
+
+    def gene_summary_fold(self, state, d):
+        state[0] += 1
+        state[1] += d['score']
+        state[2].add(d['pos'])
+        return state
+
+    def gene_summary_finish(self, hugo, state):
+        count, score_sum, positions = state
+        if count < 2:
+            return None
+        return {'count': count, 'mean_score': round(score_sum / count, 6),
+                'distinct_positions': len(positions), 'pid': os.getpid()}
+
+class CollectingAnnotator(BaseAnnotator):
+
+    def build_gene_collection(self, hugo, d, gene_collection):
+        gene_collection[hugo]['score'].append(d['score'])
+
+    def summarize_by_gene(self, hugo, gene_collection):
+        scores = gene_collection[hugo]['score']
+        if len(scores) < 2:
+            return None
+        return {'count': len(scores)}
+
+def expected_summaries(variants):
+    genes = {}
+    for d in variants:
+        if d['hugo'] is not None:
+            genes.setdefault(d['hugo'], []).append(d)
+    summaries = {}
+    for hugo, gene_variants in genes.items():
+        if len(gene_variants) < 2:
+            continue
+        summaries[hugo] = {'count': len(gene_variants),
+                           'mean_score': round(sum(d['score'] for d in gene_variants)
+                                               / len(gene_variants), 6),
+                           'distinct_positions': len(set(d['pos'] for d in gene_variants))}
+    return summaries
+
+def get_summaries(annotator, variants):
+    source = VariantSource(variants)
+    data = asyncio.run(annotator.get_gene_summary_data(source))
+    assert source.cols == ['base__hugo', 'test__score', 'test__pos']
+    return data
+
+@pytest.mark.parametrize('summary_workers', [1, 4])
+def test_folded_summaries(summary_workers):
+    variants = make_variants(5000, 700)
+    annotator = make_annotator(FoldingAnnotator, summary_workers=summary_workers)
+    data = get_summaries(annotator, variants)
+    pids = set(summary.pop('pid') for summary in data.values())
+    assert data == expected_summaries(variants)
+    if summary_workers == 1:
+        assert pids == set([os.getpid()])
+    else:
+        assert os.getpid() not in pids
+
+def test_folded_summaries_in_chunks(monkeypatch):
+    variants = make_variants(300, 40, seed=1)
+    annotator = make_annotator(FoldingAnnotator, summary_workers=3)
+    monkeypatch.setattr(FoldingAnnotator, 'gene_summary_chunk_size', 7)
+    data = get_summaries(annotator, variants)
+    for summary in data.values():
+        del summary['pid']
+    assert data == expected_summaries(variants)
+
+def test_no_genes():
+    annotator = make_annotator(FoldingAnnotator, summary_workers=4)
+    assert get_summaries(annotator, [{'hugo': None, 'score': 0.5, 'pos': 1}]) == {}
+
+def test_collected_summaries():
+    variants = make_variants(2000, 300, seed=2)
+    annotator = make_annotator(CollectingAnnotator)
+    data = get_summaries(annotator, variants)
+    assert data == dict([(hugo, {'count': summary['count']})
+                         for hugo, summary in expected_summaries(variants).items()])
@@ -0,0 +1,123 @@
+"""
+Tests of chain file liftover, on a small chain whose conversions are
+worked out by hand.
+"""
+import gzip
+import pytest
+from cravat import liftover
+from cravat.liftover import ChainIndex, lift_variants, reverse_complement
+
+# chr1 [10, 110) -> chr1 [20, 120) and chr1 [120, 170) -> chr1 [125, 175),
+# on the + strand, with a gap of 10 source and 5 target bases between.
+# chr2 [0, 100) -> chr5 [100, 200) on the - strand of a 500 base chr5, so
+# 1-based chr2 position p is chr5 position 401 - p.
+# A lower scoring chain maps chr1 [0, 50) to chr9, and is used only where
+# the first chain has no block.
+chain_text = '''\
+chain 1000 chr1 1000 + 10 170 chr1 2000 + 20 175 1
+100 10 5
+50
+
+chain 900 chr2 1000 + 0 100 chr5 500 - 100 200 2
+100
+
+chain 500 chr1 1000 + 0 50 chr9 1000 + 0 50 3
+50
+'''
+
+cases = [
+    (('chr1', 10), ('chr9', 10, '+')),
+    (('chr1', 11), ('chr1', 21, '+')),
+    (('chr1', 50), ('chr1', 60, '+')),
+    (('chr1', 51), ('chr1', 61, '+')),
+    (('chr1', 110), ('chr1', 120, '+')),
+    (('chr1', 111), None),
+    (('chr1', 120), None),
+    (('chr1', 121), ('chr1', 126, '+')),
+    (('chr1', 170), ('chr1', 175, '+')),
+    (('chr1', 171), None),
+    (('chr2', 1), ('chr5', 400, '-')),
+    (('chr2', 10), ('chr5', 391, '-')),
+    (('chr2', 100), ('chr5', 301, '-')),
+    (('chr2', 101), None),
+    (('chr3', 5), None),
+    (('chr1', None), None),
+]
+
+@pytest.fixture(params=['numpy', 'no numpy'])
+def index(request, tmp_path, monkeypatch):
+    if request.param == 'no numpy':
+        monkeypatch.setattr(liftover, 'np', None)
+    elif liftover.np is None:
+        pytest.skip('numpy is not installed')
+    chain_path = tmp_path / 'test.over.chain'
+    chain_path.write_text(chain_text)
+    return ChainIndex.from_chain_file(str(chain_path))
+
+@pytest.mark.parametrize('query, expected', cases)
+def test_convert(index, query, expected):
+    assert index.convert(*query) == expected
+
+def test_convert_many(index):
+    chroms = [query[0] for query, _ in cases]
+    positions = [query[1] for query, _ in cases]
+    assert index.convert_many(chroms, positions) == [expected for _, expected in cases]
+
+def test_lift_plus_strand(index):
+    variants = [('chr1', 50, 'A', 'G'),
+                ('chr1', 108, 'AC', '-'),
+                ('chr1', 50, '-', 'TT'),
+                # Ends in the gap between blocks.
+                ('chr1', 109, 'ACG', 'T'),
+                # Both ends map, but the bases between do not.
+                ('chr1', 110, 'A' * 12, 'T')]
+    assert lift_variants(index, variants) == [('chr1', 60, 'A', 'G'),
+                                              ('chr1', 118, 'AC', '-'),
+                                              ('chr1', 60, '-', 'TT'),
+                                              None,
+                                              None]
+
+def test_lift_minus_strand(index):
+    variants = [('chr2', 10, 'A', 'G'),
+                ('chr2', 10, 'AC', '-'),
+                ('chr2', 10, '-', 'TT'),
+                ('chr2', 100, 'AC', 'G')]
+    # Alleles are reverse complemented, at the target position of the
+    # variant's last base.
+    assert lift_variants(index, variants) == [('chr5', 391, 'T', 'C'),
+                                              ('chr5', 390, 'GT', '-'),
+                                              ('chr5', 390, '-', 'AA'),
+                                              None]
+
+def test_lift_unmapped(index):
+    assert lift_variants(index, [('chr3', 5, 'A', 'G'), (None, None, 'A', 'G')]) \
+        == [None, None]
+
+def test_reverse_complement():
+    assert reverse_complement('ACGTN') == 'NACGT'
+    assert reverse_complement('acg') == 'cgt'
+    assert reverse_complement('-') == '-'
+    assert reverse_complement('') == ''
+
+def test_gzipped_chain(tmp_path):
+    chain_path = tmp_path / 'test.over.chain.gz'
+    with gzip.open(str(chain_path), 'wt') as f:
+        f.write(chain_text)
+    index = ChainIndex.from_chain_file(str(chain_path))
+    for query, expected in cases:
+        assert index.convert(*query) == expected
+
+def test_cached_index(tmp_path, monkeypatch):
+    chain_path = tmp_path / 'test.over.chain'
+    chain_path.write_text(chain_text)
+    monkeypatch.setattr(liftover, '_loaded', {})
+    ChainIndex.load(str(chain_path), cache=True)
+    assert (tmp_path / 'test.over.chain.index').exists()
+    # A new process reads the pickled index instead of the chain file.
+    monkeypatch.setattr(liftover, '_loaded', {})
+    def fail(cls, path):
+        raise AssertionError('chain file parsed again')
+    monkeypatch.setattr(ChainIndex, 'from_chain_file', classmethod(fail))
+    index = ChainIndex.load(str(chain_path), cache=True)
+    for query, expected in cases:
+        assert index.convert(*query) == expected
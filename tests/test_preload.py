@@ -0,0 +1,67 @@
+"""
+Tests of preload_tables, the small tables loaded into memory before setup.
+"""
+import logging
+import sqlite3
+import pytest
+from cravat.base_annotator import BaseAnnotator
+from cravat.exceptions import ConfigurationError
+
+def make_annotator(preload_tables, conn):
+    annotator = BaseAnnotator.__new__(BaseAnnotator)
+    annotator.annotator_name = 'test'
+    annotator.logger = logging.getLogger('cravat.test')
+    annotator.conf = {'preload_tables': preload_tables}
+    annotator.db_pool = None
+    annotator.dbconn = conn
+    return annotator
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE nucleotide_names (abbreviation TEXT, full_name TEXT);')
+    conn.executemany('INSERT INTO nucleotide_names VALUES (?, ?);',
+                     [('A', 'Adenine'), ('C', 'Cytosine'), ('A', 'Repeated')])
+    conn.execute('CREATE TABLE "some table" (hugo TEXT, length INT, name TEXT);')
+    conn.execute('INSERT INTO "some table" VALUES (?, ?, ?);', ('TP53', 19149, 'tumor protein'))
+    return conn
+
+def test_preload(conn):
+    annotator = make_annotator({'nucleotide_names': {'key': 'abbreviation',
+                                                     'columns': ['full_name']},
+                                'some table': {'key': 'hugo',
+                                               'columns': ['length', 'name']}},
+                               conn)
+    annotator._preload_tables()
+    assert annotator.preloaded == {
+        'nucleotide_names': {'A': ('Adenine',), 'C': ('Cytosine',)},
+        'some table': {'TP53': (19149, 'tumor protein')}}
+
+def test_no_preload_tables(conn):
+    annotator = make_annotator(None, None)
+    annotator._preload_tables()
+    assert annotator.preloaded == {}
+
+@pytest.mark.parametrize('preload_tables, message', [
+    ({'missing': {'key': 'abbreviation', 'columns': ['full_name']}},
+     'Preload table missing not in data/test.sqlite'),
+    ({'nucleotide_names': {'key': 'abbreviation', 'columns': ['full_name', 'code']}},
+     'Columns of preload table nucleotide_names not found: code'),
+    ({'nucleotide_names': {'key': 'abbr', 'columns': ['full_name']}},
+     'Columns of preload table nucleotide_names not found: abbr'),
+    ({'nucleotide_names': {'columns': ['full_name']}},
+     'preload_tables nucleotide_names needs a key and columns'),
+])
+def test_bad_preload_tables(conn, preload_tables, message):
+    annotator = make_annotator(preload_tables, conn)
+    with pytest.raises(ConfigurationError) as exc_info:
+        annotator._preload_tables()
+    assert str(exc_info.value) == message
+
+def test_no_database():
+    annotator = make_annotator({'nucleotide_names': {'key': 'abbreviation',
+                                                     'columns': ['full_name']}},
+                               None)
+    with pytest.raises(ConfigurationError) as exc_info:
+        annotator._preload_tables()
+    assert 'data/test.sqlite' in str(exc_info.value)
@@ -0,0 +1,130 @@
+"""
+Tests of BED regions and region queries (--regions), against a brute force
+scan of the records.
+"""
+import gzip
+import random
+import sqlite3
+import pytest
+from cravat.popfreq_db import chrom_to_int
+from cravat.popfreq_db import query_frequency_regions
+from cravat.popfreq_db import write_frequency_db
+from cravat.regions import merge_regions
+from cravat.regions import read_bed
+
+bed_text = '''\
+browser position chr1:1-1000
+track name=panel
+# comment
+chr1\t10\t20\tfirst
+chr1\t0\t5
+1\t100\t200\tbare chromosome name
+
+chrX\t7\t7\tempty
+'''
+
+def test_read_bed(tmp_path):
+    path = tmp_path / 'regions.bed'
+    path.write_text(bed_text)
+    assert read_bed(str(path)) == [('chr1', 10, 20), ('chr1', 0, 5), ('1', 100, 200),
+                                   ('chrX', 7, 7)]
+
+def test_read_gzipped_bed(tmp_path):
+    path = tmp_path / 'regions.bed.gz'
+    with gzip.open(str(path), 'wt') as f:
+        f.write(bed_text)
+    assert read_bed(str(path)) == [('chr1', 10, 20), ('chr1', 0, 5), ('1', 100, 200),
+                                   ('chrX', 7, 7)]
+
+@pytest.mark.parametrize('line', ['chr1\t10\n', 'chr1\tten\t20\n', 'chr1\t-1\t20\n',
+                                  'chr1\t20\t10\n'])
+def test_read_bad_bed(tmp_path, line):
+    path = tmp_path / 'regions.bed'
+    path.write_text('chr1\t1\t2\n' + line)
+    with pytest.raises(ValueError) as exc_info:
+        read_bed(str(path))
+    assert 'line 2' in str(exc_info.value)
+
+@pytest.mark.parametrize('regions, merged', [
+    # Overlapping
+    ([('chr1', 10, 20), ('chr1', 15, 30)], {'chr1': [(10, 30)]}),
+    # Touching: 11-20 and 21-30 in 1-based positions
+    ([('chr1', 10, 20), ('chr1', 20, 30)], {'chr1': [(10, 30)]}),
+    # One base apart
+    ([('chr1', 10, 20), ('chr1', 21, 30)], {'chr1': [(10, 20), (21, 30)]}),
+    # Contained, unsorted
+    ([('chr1', 50, 60), ('chr1', 0, 100), ('chr1', 10, 20)], {'chr1': [(0, 100)]}),
+    # Empty regions are left out.
+    ([('chr1', 10, 10), ('chr2', 5, 5), ('chr1', 1, 2)], {'chr1': [(1, 2)]}),
+    # Chromosomes are kept apart.
+    ([('chr2', 0, 10), ('chr1', 5, 15), ('chr2', 10, 20)],
+     {'chr1': [(5, 15)], 'chr2': [(0, 20)]}),
+    ([], {}),
+])
+def test_merge_regions(regions, merged):
+    assert merge_regions(regions) == merged
+
+def brute_force(records, regions):
+    # Records with a 1-based position in a BED region: start < pos <= end.
+    found = []
+    for record in records:
+        chrom_int = chrom_to_int(record[0])
+        for chrom, start, end in regions:
+            if chrom_to_int(chrom) == chrom_int and start < record[1] <= end:
+                found.append(record)
+                break
+    return sorted(found, key=lambda record: (chrom_to_int(record[0]),) + record[1:4])
+
+def test_query_frequency_regions(tmp_path):
+    rnd = random.Random(0)
+    chroms = ['chr1', 'chr2', 'chrX']
+    records = set()
+    while len(records) < 3000:
+        records.add((rnd.choice(chroms), rnd.randrange(1, 20000),
+                     rnd.choice('ACGT'), rnd.choice('ACGT')))
+    records = sorted([record + (round(rnd.random(), 4),) for record in records])
+    db_path = str(tmp_path / 'test.sqlite')
+    write_frequency_db(db_path, 'test', ['af'], records)
+    regions = []
+    for _ in range(200):
+        start = rnd.randrange(0, 20000)
+        regions.append((rnd.choice(chroms + ['1', 'X', 'chrUn_gl000220']),
+                        start, start + rnd.randrange(0, 300)))
+    # Regions exactly at records' positions, and ending just before them.
+    for chrom, pos, _, _, _ in records[:20]:
+        regions.append((chrom, pos - 1, pos))
+    for chrom, pos, _, _, _ in records[20:40]:
+        regions.append((chrom, pos - 10, pos - 1))
+    conn = sqlite3.connect(db_path)
+    found = list(query_frequency_regions(conn, 'test', ['af'], regions))
+    expected = brute_force(records, regions)
+    assert len(found) > 40
+    assert [record[:4] for record in found] == [record[:4] for record in expected]
+    assert [record[4] for record in found] == pytest.approx([record[4] for record in expected])
+
+def test_region_run(modules, tmp_path):
+    from cravat.inout import CravatReader
+    rnd = random.Random(1)
+    db_variants = modules.db_variants
+    regions = []
+    for _ in range(50):
+        chrom, pos, _, _ = rnd.choice(db_variants)
+        start = max(pos - rnd.randrange(0, 2000000), 0)
+        if rnd.random() < 0.5:
+            chrom = chrom[3:]
+        regions.append((chrom, start, start + rnd.randrange(0, 4000000)))
+    bed_path = tmp_path / 'panel.bed'
+    bed_path.write_text(''.join(['{}\t{}\t{}\n'.format(*region) for region in regions]))
+    modules.input_path = str(bed_path)
+    conf_path = tmp_path / 'job.yml'
+    conf_path.write_text('abraom:\n  title: ABRaOM\n')
+    annotator = modules.make_annotator('abraom', tmp_path / 'output', '--regions',
+                                       '-c', str(conf_path))
+    annotator.run()
+    reader = CravatReader(str(tmp_path / 'output' / 'job.abraom.regions'))
+    found = [(data['chrom'], data['pos'], data['ref_base'], data['alt_base'])
+             for _, _, data in reader.loop_data()]
+    assert found == [record[:4] for record in brute_force(db_variants, regions)]
+    assert len(found) > 50
+    assert annotator.status_writer.updates[-1] == ('status', 'Finished ABRaOM (abraom)')
+    assert ('version', 'abraom', annotator.conf['version']) in annotator.status_writer.updates
@@ -0,0 +1,79 @@
+"""
+Tests of SecondaryInputFetcher's memory, disk and stream modes, and of
+reopening a fetcher in a forked worker.
+"""
+import multiprocessing
+import random
+import pytest
+from cravat.base_annotator import SecondaryInputFetcher
+from cravat.constants import crv_def
+from cravat.inout import CravatWriter
+
+fetch_modes = ['memory', 'disk', 'stream']
+
+@pytest.fixture
+def input_path(tmp_path):
+    # Sorted by uid, with some uids missing and some repeated.
+    rnd = random.Random(0)
+    path = str(tmp_path / 'secondary.crv')
+    writer = CravatWriter(path)
+    for col_index, col_def in enumerate(crv_def):
+        writer.add_column(col_index, col_def)
+    writer.write_definition()
+    for uid in range(1, 200):
+        for _ in range(rnd.choice([0, 1, 1, 2])):
+            writer.write_data({'uid': uid, 'chrom': rnd.choice(['chr1', 'chr2']),
+                               'pos': rnd.randrange(1, 1000), 'ref_base': 'A',
+                               'alt_base': 'G'})
+    writer.close()
+    return path
+
+def make_fetcher(input_path, mode, tmp_path):
+    return SecondaryInputFetcher(input_path, 'uid', fetch_cols=['chrom', 'pos'],
+                                 mode=mode, index_dir=str(tmp_path))
+
+def test_modes_agree(input_path, tmp_path):
+    fetchers = dict([(mode, make_fetcher(input_path, mode, tmp_path))
+                     for mode in fetch_modes])
+    for uid in range(0, 205):
+        results = [fetchers[mode].get(uid) for mode in fetch_modes]
+        assert results[0] == results[1] == results[2]
+    for fetcher in fetchers.values():
+        fetcher.close()
+    assert [path for path in tmp_path.iterdir() if path.name.startswith('.secondary')] == []
+
+def _get_in_child(fetcher, uids, results):
+    fetcher.reopen()
+    results.extend([fetcher.get(uid) for uid in uids])
+    fetcher.close()
+
+@pytest.mark.parametrize('mode', ['disk', 'stream'])
+def test_reopen_in_forked_worker(input_path, tmp_path, mode):
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        pytest.skip('fork is not available')
+    fetcher = make_fetcher(input_path, mode, tmp_path)
+    expected = [fetcher.get(uid) for uid in range(1, 100)]
+    mp_context = multiprocessing.get_context('fork')
+    manager = mp_context.Manager()
+    results = manager.list()
+    proc = mp_context.Process(target=_get_in_child,
+                              args=(fetcher, list(range(1, 100)), results))
+    proc.start()
+    proc.join()
+    assert proc.exitcode == 0
+    assert list(results) == expected
+    # The child's close left the parent's index and connection alone.
+    if mode == 'disk':
+        assert [fetcher.get(uid) for uid in range(1, 100)] == expected
+    fetcher.close()
+    manager.shutdown()
+
+def test_reopen_keeps_parent_connection(input_path, tmp_path):
+    fetcher = make_fetcher(input_path, 'disk', tmp_path)
+    parent_conn = fetcher.index_conn
+    fetcher.reopen()
+    assert fetcher.index_conn is not parent_conn
+    assert fetcher._parent_conns == [parent_conn]
+    assert not fetcher.owns_index
+    fetcher.index_conn.close()
+    parent_conn.close()
@@ -0,0 +1,71 @@
+"""
+Tests of how --workers splits the primary input into shards.
+"""
+from types import SimpleNamespace
+import pytest
+from cravat.base_annotator import BaseAnnotator
+
+header = b'#fmt=crv\n#uid\tchrom\tpos\tref_base\talt_base\n'
+
+def write_input(tmp_path, data, header=header):
+    path = tmp_path / 'input.crv'
+    path.write_bytes(header + data)
+    return str(path)
+
+def make_data(num_lines):
+    # Lines of different lengths, so that split offsets fall mid-line.
+    return b''.join([b'%d\tchr1\t%d\tA\t%s\n' % (i, i * 7, b'G' * (i % 13 + 1))
+                     for i in range(1, num_lines + 1)])
+
+def split(path, num_shards):
+    annotator = SimpleNamespace(primary_input_path=path)
+    shards = BaseAnnotator._split_primary_input(annotator, num_shards)
+    return shards, annotator._shard_header
+
+@pytest.mark.parametrize('num_lines', [1, 2, 5, 100, 1001])
+@pytest.mark.parametrize('num_shards', [1, 2, 3, 4, 7, 16])
+def test_shards_cover_data_lines(tmp_path, num_lines, num_shards):
+    data = make_data(num_lines)
+    path = write_input(tmp_path, data)
+    shards, shard_header = split(path, num_shards)
+    content = header + data
+    assert shard_header == header
+    assert 1 <= len(shards) <= num_shards
+    assert shards[0][0] == len(header)
+    assert shards[-1][1] == len(content)
+    for prev_shard, shard in zip(shards, shards[1:]):
+        assert prev_shard[1] == shard[0]
+    for start, end, lines_before in shards:
+        assert start < end
+        # Shards start at the beginning of a line.
+        assert content[start - 1:start] == b'\n'
+        assert lines_before == content[:start].count(b'\n')
+    assert b''.join([content[start:end] for start, end, _ in shards]) == data
+
+def test_last_line_without_newline(tmp_path):
+    data = make_data(50).rstrip(b'\n')
+    path = write_input(tmp_path, data)
+    shards, _ = split(path, 4)
+    content = header + data
+    assert b''.join([content[start:end] for start, end, _ in shards]) == data
+    last_lines = content[shards[-1][0]:].split(b'\n')
+    assert last_lines[-1].startswith(b'50\t')
+
+def test_long_line_spans_several_offsets(tmp_path):
+    # A line longer than a shard's share of the input gives fewer shards,
+    # not an empty or split one.
+    data = b'1\tchr1\t1\tA\t' + b'G' * 10000 + b'\n2\tchr1\t2\tA\tC\n'
+    path = write_input(tmp_path, data)
+    shards, _ = split(path, 8)
+    content = header + data
+    assert [content[start:end] for start, end, _ in shards] == data.splitlines(True)
+    assert [lines_before for _, _, lines_before in shards] == [2, 3]
+
+def test_no_header(tmp_path):
+    data = make_data(20)
+    path = write_input(tmp_path, data, header=b'')
+    shards, shard_header = split(path, 3)
+    assert shard_header == b''
+    assert shards[0][0] == 0
+    assert shards[0][2] == 0
+    assert b''.join([data[start:end] for start, end, _ in shards]) == data